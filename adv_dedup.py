@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  ble-dump: advertiser deduplication and per-device aggregates
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import csv
+import os
+import zlib
+from collections import OrderedDict
+from time import time
+
+from proto import ns_to_datetime
+
+# off: every copy is reported; collapse: the first copy stands for the duplicates on the
+# console and in the PCAP file; suppress: duplicates are dropped from every output
+DEDUP_POLICIES = ('off', 'collapse', 'suppress')
+
+DEVICE_CSV_FIELDS = ['AdvA', 'Packets', 'Duplicates', 'Channels', 'First_seen', 'Last_seen']
+
+DEVICES_INTERVAL = 10.0
+
+
+class Device(object):
+    """
+     Aggregates of an advertiser.
+
+            packets     --- advertising packets received, duplicates included
+            duplicates  --- copies of a PDU already received within the dedup window
+            channels    --- BLE channels the advertiser was received on
+            first_ns, last_ns --- reception time of the first and last packet (ns)
+    """
+
+    def __init__(self, address, time_ns):
+        self.address = address
+        self.packets = 0
+        self.duplicates = 0
+        self.channels = set()
+        self.first_ns = time_ns
+        self.last_ns = time_ns
+
+
+class AdvertiserCache(object):
+    """
+     Recently received advertising PDUs, keyed on the advertiser address and a hash
+     of the PDU: a copy received less than 'window' seconds after the reported one
+     is a duplicate, the next copy after the window is reported again. Both the PDU
+     cache and the device table are LRU bounded, the least recently received
+     entries are forgotten first.
+    """
+
+    def __init__(self, window=1.0, max_entries=4096, max_devices=4096):
+        self.window_ns = int(window * 1e9)
+        self.max_entries = max_entries
+        self.max_devices = max_devices
+        self.devices = OrderedDict()
+        self.duplicates = 0
+        self.forgotten_devices = 0
+        # (address, PDU hash) -> reception time of the reported copy
+        self._reported = OrderedDict()
+
+    # Record an advertising packet, returns True if it is a duplicate
+    def add(self, address, pdu, channel, time_ns):
+        key = (address, zlib.crc32(bytes(bytearray(pdu))))
+        reported = self._reported.pop(key, None)
+        duplicate = reported is not None and time_ns - reported < self.window_ns
+        self._reported[key] = reported if duplicate else time_ns
+        while len(self._reported) > self.max_entries:
+            self._reported.popitem(last=False)
+        # Least recently received first: stop at the first PDU still inside the window
+        while self._reported:
+            key = next(iter(self._reported))
+            if time_ns - self._reported[key] < self.window_ns:
+                break
+            del self._reported[key]
+
+        device = self.devices.pop(address, None)
+        if device is None:
+            device = Device(address, time_ns)
+            if len(self.devices) >= self.max_devices:
+                self.devices.popitem(last=False)
+                self.forgotten_devices += 1
+        self.devices[address] = device
+        device.packets += 1
+        device.channels.add(channel)
+        device.last_ns = max(device.last_ns, time_ns)
+        if duplicate:
+            device.duplicates += 1
+            self.duplicates += 1
+        return duplicate
+
+    # Write the device aggregates into a csv file, most recently received first. The file
+    # is replaced at once, a reader never sees a partial table
+    def write_csv(self, filename):
+        temp_file = filename + '.tmp'
+        with open(temp_file, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(DEVICE_CSV_FIELDS)
+            for device in reversed(list(self.devices.values())):
+                writer.writerow([':'.join('{:02x}'.format(b) for b in bytearray(device.address)), device.packets,
+                                 device.duplicates, ' '.join(str(channel) for channel in sorted(device.channels)),
+                                 ns_to_datetime(device.first_ns), ns_to_datetime(device.last_ns)])
+        os.rename(temp_file, filename)
+
+
+class DeviceLog(object):
+    """
+     Dump the device aggregates of an AdvertiserCache into a csv file every 'interval' seconds.
+    """
+
+    def __init__(self, filename, cache, interval=DEVICES_INTERVAL):
+        self.filename = filename
+        self.cache = cache
+        self.interval = interval
+        self._last = time()
+
+    def poll(self):
+        if time() - self._last >= self.interval:
+            self.write()
+
+    def write(self):
+        self.cache.write_csv(self.filename)
+        self._last = time()
+
+    def close(self):
+        self.write()
@@ -0,0 +1,270 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+#  ble-dump: decoder benchmarks on synthetic BLE advertising data
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from __future__ import print_function
+
+import json
+from optparse import OptionParser, OptionGroup
+from time import time
+
+import numpy as np
+
+from ble_parser import Stat, decode_buffer
+from ble_synth import random_pdu, synth_bits, synth_capture
+from gfsk_demod import BleDecoder, CHUNK_SAMPLES, GfskDemodulator, read_samples
+from metrics import Metrics
+from proto import *
+from ring_buffer import RingBuffer
+
+BENCHMARKS = ('dewhitening', 'crc', 'parse', 'decode')
+
+
+# Latency percentiles (microseconds) of a list of durations in seconds
+
+
+def latency_stats(latencies):
+    if not latencies:
+        return {'p50_us': 0.0, 'p99_us': 0.0, 'max_us': 0.0}
+    latencies = np.array(latencies) * 1e6
+    return {'p50_us': float(np.percentile(latencies, 50)), 'p99_us': float(np.percentile(latencies, 99)),
+            'max_us': float(latencies.max())}
+
+
+# Match decoded packets to the generated ones: same PDU, start within 'tolerance' (samples or bits)
+# Returns the detection and false positive counts
+
+
+def match_packets(truth, decoded, tolerance):
+    expected = {}
+    for start, pdu in truth:
+        expected.setdefault(bytes(bytearray(pdu)), []).append(start)
+    detected = 0
+    false_positives = 0
+    for start, pdu in decoded:
+        starts = expected.get(bytes(bytearray(pdu)), [])
+        found = [s for s in starts if abs(s - start) <= tolerance]
+        if found:
+            starts.remove(found[0])
+            detected += 1
+        else:
+            false_positives += 1
+    return detected, false_positives
+
+
+def accuracy(truth, detected, false_positives, decoded):
+    return {'packets': len(truth), 'decoded': decoded, 'detected': detected, 'false_positives': false_positives,
+            'detection_rate': detected / float(len(truth)) if truth else 0.0,
+            'false_positive_rate': false_positives / float(decoded) if decoded else 0.0}
+
+
+# proto.dewhitening of whitened PDUs (with CRC)
+
+
+def bench_dewhitening(opts):
+    rng = np.random.RandomState(opts.seed)
+    pdus = [dewhitening(bytearray(pdu) + bytearray(crc(list(pdu), len(pdu))), opts.channel)
+            for pdu in (random_pdu(rng) for _ in range(opts.packets))]
+    size = sum(len(pdu) for pdu in pdus)
+    started = time()
+    for _ in range(opts.repeat):
+        for pdu in pdus:
+            dewhitening(pdu, opts.channel)
+    elapsed = time() - started
+    count = len(pdus) * opts.repeat
+    return {'pdus': count, 'seconds': elapsed, 'pdus_per_second': count / elapsed,
+            'bytes_per_second': size * opts.repeat / elapsed, 'latency_us': elapsed / count * 1e6}
+
+
+# proto.crc of PDUs, each result is checked against the generated CRC
+
+
+def bench_crc(opts):
+    rng = np.random.RandomState(opts.seed)
+    pdus = [list(random_pdu(rng)) for _ in range(opts.packets)]
+    crcs = [crc(pdu, len(pdu)) for pdu in pdus]
+    size = sum(len(pdu) for pdu in pdus)
+    errors = 0
+    started = time()
+    for _ in range(opts.repeat):
+        for pdu, value in zip(pdus, crcs):
+            if crc(pdu, len(pdu)) != value:
+                errors += 1
+    elapsed = time() - started
+    count = len(pdus) * opts.repeat
+    return {'pdus': count, 'seconds': elapsed, 'pdus_per_second': count / elapsed,
+            'bytes_per_second': size * opts.repeat / elapsed, 'latency_us': elapsed / count * 1e6,
+            'errors': errors}
+
+
+# ble_dump.py parse loop (ble_parser.decode_buffer) over a demodulated bit stream, fed by
+# messages of 'message_bits'. The latency of a packet is measured from the message holding its
+# last bit to its decoding
+
+
+def bench_parse(opts):
+    bits, truth = synth_bits(opts.packets, opts.density, opts.channel, opts.seed)
+
+    stat = Stat()
+    metrics = Metrics()
+    gr_buffer = RingBuffer(BLE_MAX_PACKET_BITS)
+    message_times = []
+    latencies = []
+    decoded = []
+    started = time()
+    for first in range(0, len(bits), opts.message_bits):
+        message_times.append(time())
+        gr_buffer.append(bits[first:first + opts.message_bits])
+        eof = first + opts.message_bits >= len(bits)
+        if gr_buffer.ready < opts.min_buffer_size * 8 and not eof:
+            continue
+        search_len = len(gr_buffer) if eof else gr_buffer.ready
+        for index, _, packet in decode_buffer(gr_buffer, search_len, lambda index: opts.channel,
+                                              opts, stat, metrics, lambda *args: None):
+            last_bit = index + packet_bits(packet) - 1
+            latencies.append(time() - message_times[last_bit // opts.message_bits])
+            decoded.append((index, packet.data[:-BLE_CRC_LEN]))
+        gr_buffer.consume(search_len)
+        stat.bits += search_len
+    elapsed = time() - started
+
+    detected, false_positives = match_packets(truth, decoded, 0)
+    result = {'bits': len(bits), 'seconds': elapsed, 'bits_per_second': len(bits) / elapsed,
+              'real_time': len(bits) / 1e6 / elapsed, 'latency': latency_stats(latencies)}
+    result.update(accuracy(truth, detected, false_positives, len(decoded)))
+    return result
+
+
+# Full decode of an IQ capture: gfsk_demod demodulation and decoding, chunk by chunk as
+# gfsk_demod.decode_iq. The latency of a packet is measured from the read of the chunk holding
+# its last sample to its decoding
+
+
+def bench_decode(opts):
+    iq_samples, truth = synth_capture(opts.packets, opts.sample_rate, opts.density, opts.snr, opts.cfo,
+                                      opts.freq_offset, opts.channel, opts.seed)
+    fmt = IQ_FORMATS[opts.iq_format]
+    iq_data = iq_from_complex(iq_samples, fmt).reshape(-1, 2)
+    truth = [(packet.start_frame, packet.pdu) for packet in truth]
+
+    demod = GfskDemodulator(opts.sample_rate, freq_offset=opts.freq_offset)
+    decoder = BleDecoder(demod.sps, [(0, opts.channel)], opts.access_addresses, opts.max_bit_errors)
+    sps = demod.sps
+    chunk_samples = max(sps, opts.chunk_samples // sps * sps)
+    chunk_times = []
+    latencies = []
+    decoded = []
+
+    def collect(packets):
+        for start, end, _, packet in packets:
+            latencies.append(time() - chunk_times[min((end - 1) // chunk_samples, len(chunk_times) - 1)])
+            decoded.append((start, packet.data[:-BLE_CRC_LEN]))
+
+    started = time()
+    for first in range(0, len(iq_data), chunk_samples):
+        chunk_times.append(time())
+        samples = read_samples(iq_data, first - demod.history, first + chunk_samples + demod.lookahead, fmt)
+        collect(decoder.feed(demod.demodulate(samples, first), first))
+    collect(decoder.flush())
+    elapsed = time() - started
+
+    detected, false_positives = match_packets(truth, decoded, 2 * sps)
+    result = {'samples': len(iq_data), 'seconds': elapsed, 'samples_per_second': len(iq_data) / elapsed,
+              'real_time': len(iq_data) / opts.sample_rate / elapsed, 'latency': latency_stats(latencies),
+              'stat': decoder.stat}
+    result.update(accuracy(truth, detected, false_positives, len(decoded)))
+    return result
+
+
+def report(name, result):
+    line = '{:<12s}'.format(name)
+    for key, unit in (('pdus_per_second', 'PDU/s'), ('bytes_per_second', 'B/s'),
+                      ('bits_per_second', 'bit/s'), ('samples_per_second', 'samples/s')):
+        if key in result:
+            line += ' {:>12.0f} {}'.format(result[key], unit)
+    if 'real_time' in result:
+        line += ' ({:.1f}x real time)'.format(result['real_time'])
+    if 'latency_us' in result:
+        line += ', {:.2f} us/PDU'.format(result['latency_us'])
+    if 'latency' in result:
+        line += ', latency p50 {p50_us:.0f} us p99 {p99_us:.0f} us'.format(**result['latency'])
+    print(line)
+    if 'detection_rate' in result:
+        print('{:<12s} detected {:d}/{:d} ({:.2%}), false positives {:d} ({:.2%})'.format(
+            '', result['detected'], result['packets'], result['detection_rate'],
+            result['false_positives'], result['false_positive_rate']))
+
+
+def init_opts():
+    parser = OptionParser(usage="%prog: [opts]")
+    parser.add_option("-b", "--benchmarks", type="string", default=','.join(BENCHMARKS),
+                      help="Benchmarks to run (comma separated) [default=%default]")
+    parser.add_option("-o", "--json-file", type="string", default='',
+                      help="Write the results as JSON into this file")
+    parser.add_option("-r", "--repeat", type="int", default=10,
+                      help="Passes over the PDUs of the dewhitening and crc benchmarks [default=%default]")
+
+    synth = OptionGroup(parser, 'Synthetic data:')
+    synth.add_option("-n", "--packets", type="int", default=1000,
+                     help="Packets to generate [default=%default]")
+    synth.add_option("-s", "--sample-rate", type="float", default=5e6,
+                     help="Sample rate, a multiple of 1 MHz [default=%default]")
+    synth.add_option("-d", "--density", type="float", default=500.0,
+                     help="Packets per second [default=%default]")
+    synth.add_option("--snr", type="float", default=20.0,
+                     help="Signal to noise ratio (dB) [default=%default]")
+    synth.add_option("--cfo", type="float", default=0.0,
+                     help="Carrier frequency offset (Hz) [default=%default]")
+    synth.add_option("-f", "--freq-offset", type="float", default=1e6,
+                     help="Offset of the capture center above the BLE channel [default=%default]")
+    synth.add_option("-F", "--iq-format", type="choice", choices=sorted(IQ_FORMATS), default=IQ_FORMAT_DEFAULT,
+                     help="IQ format the samples are converted to before decoding [default=%default]")
+    synth.add_option("-c", "--channel", type="int", default=37,
+                     help="BLE channel [default=%default]")
+    synth.add_option("--seed", type="int", default=0,
+                     help="Random seed [default=%default]")
+    parser.add_option_group(synth)
+
+    decoder = OptionGroup(parser, 'Decoder:')
+    decoder.add_option("-m", "--min_buffer_size", type="int", default=65,
+                       help="Minimum buffer size of the parse loop [default=%default]")
+    decoder.add_option("-M", "--message-bits", type="int", default=4096,
+                       help="Bits of the messages fed to the parse loop [default=%default]")
+    decoder.add_option("-N", "--chunk-samples", type="int", default=CHUNK_SAMPLES,
+                       help="Samples demodulated at once by the full decode [default=%default]")
+    decoder.add_option("-e", "--max_bit_errors", type="int", default=1,
+                       help="Bit errors allowed in preamble and access address [default=%default]")
+    parser.add_option_group(decoder)
+
+    (opts, args) = parser.parse_args()
+    opts.benchmarks = [name for name in opts.benchmarks.split(',') if name]
+    opts.access_addresses = [BLE_ACCESS_ADDR]
+    opts.crc_init = BLE_CRC_INIT
+    opts.disable_crc = False
+    opts.disable_dewhitening = False
+    return opts, args
+
+
+if __name__ == '__main__':
+    (opts, _) = init_opts()
+    unknown = [name for name in opts.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        print('\nerror: unknown benchmarks: {} (choose from {})'.format(', '.join(unknown), ', '.join(BENCHMARKS)))
+        exit(1)
+
+    results = {'options': {'packets': opts.packets, 'sample_rate': opts.sample_rate, 'density': opts.density,
+                           'snr': opts.snr, 'cfo': opts.cfo, 'iq_format': opts.iq_format, 'seed': opts.seed}}
+    for name in opts.benchmarks:
+        results[name] = globals()['bench_' + name](opts)
+        report(name, results[name])
+
+    if opts.json_file:
+        with open(opts.json_file, 'w') as json_fd:
+            json.dump(results, json_fd, indent=2, sort_keys=True)
+        print('Results written into:', opts.json_file)
@@ -12,40 +12,157 @@
 
 from __future__ import print_function
 
-import binascii
 import csv
 import os
-from collections import namedtuple
-from datetime import datetime, timedelta
+import threading
 from optparse import OptionGroup, OptionParser
+from time import time
 
 from gnuradio.eng_option import eng_option
 
-from grc.gr_ble import gr_ble as gr_block
+from grc.gr_ble import RETUNE_MODES, gr_ble as gr_block
+from grc.gr_ble_wideband import gr_ble_wideband as gr_wideband_block
+from ble_parser import TAG_MESSAGE, SampleClock, Stat, decode_buffer, fetch_bits, report_packet
+from adv_dedup import DEDUP_POLICIES, DEVICES_INTERVAL, AdvertiserCache, DeviceLog
+from dataset import LiveDataset, open_positions
+from hop_scheduler import HOP_POLICIES, HopScheduler, parse_addresses
+from iq_recorder import TriggeredRecorder
+from metrics import METRICS_INTERVAL, Metrics, MetricsLog, start_metrics_server
+from packet_store import PacketStore
 from proto import *
+from ring_buffer import OVERFLOW_POLICIES, MessageReader, RingBuffer, SampleRing
+
+
+# Copy the IQ samples of the Gnu Radio IQ tap into the sample ring until the end of the stream
+
+
+def iq_reader(iq_queue, sample_ring):
+    while True:
+        message = iq_queue.delete_head()
+        if message.type() == 1:
+            break
+        sample_ring.append(message.to_string())
+
+# Parse the bits of one channelizer output (wideband mode)
+
+
+def wideband_parser(gr, reader, channel, opts, stat, pcap, packet_index, start_ns, lock, metrics, advertisers,
+                    store, debug):
+    gr_buffer = RingBuffer(BLE_MAX_PACKET_BITS)
+    # IQ samples (of the wideband capture) of the bits
+    clock = SampleClock(gr.get_sample_rate() / gr.get_data_rate(), gr.get_sample_rate(), start_ns,
+                        gr.get_sample_delay(), metrics, channel=channel)
+
+    while True:
+        search_len, eof = fetch_bits(reader, gr_buffer, opts.min_buffer_size, metrics, channel=channel)
+        clock.read_tags(reader.tags)
+        if search_len is None:
+            continue
+
+        started = time()
+        for index_buffer_bits, _, packet in decode_buffer(gr_buffer, search_len, lambda index: channel,
+                                                          opts, stat, metrics, debug):
+            with lock:
+                report_packet(packet, channel, index_buffer_bits, clock, gr.get_sample_rate(),
+                              pcap, packet_index, metrics, advertisers, opts.dedup, store)
+        gr_buffer.consume(search_len)
+        clock.forget(gr_buffer.offset)
+        stat.bits += search_len
+        stat.busy += time() - started
+        if not opts.replay:
+            metrics.set('parser_lag_seconds', time() - clock.time_ns(clock.sample_at(gr_buffer.offset)) / 1e9,
+                        channel=channel)
+
+        if eof:
+            break
+
+# Capture all BLE channels at once, one parser thread per channel
+
+
+def wideband_capture(gr, opts, pcap, packet_index, start_ns, metrics, metrics_log, advertisers, device_log, store,
+                     debug):
+    lock = threading.Lock()
+    stats = [Stat() for _ in opts.scan_channels]
+    readers = [MessageReader(message_queue, opts.buffer_depth, opts.overflow, TAG_MESSAGE)
+               for message_queue in gr.message_queues]
+    threads = []
+    for n in range(len(opts.scan_channels)):
+        thread = threading.Thread(target=wideband_parser, args=(
+            gr, readers[n], opts.scan_channels[n], opts, stats[n], pcap, packet_index, start_ns, lock, metrics,
+            advertisers, store, debug))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Report packets per second and parser CPU use (fraction of a core) per channel
+    started = time()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            deadline = started + opts.ble_scan_window
+            # Wake up at least every flush interval to write pending records
+            alive = [thread for thread in threads if thread.is_alive()]
+            while alive and time() < deadline:
+                alive[0].join(min(deadline - time(), opts.flush_interval))
+                with lock:
+                    pcap.poll()
+                    packet_index.poll()
+                    if device_log:
+                        device_log.poll()
+                    if store:
+                        store.poll()
+                if metrics_log:
+                    metrics_log.poll()
+                alive = [thread for thread in threads if thread.is_alive()]
+            elapsed = max(time() - started, 1e-3)
+            started = time()
+            for n in range(len(opts.scan_channels)):
+                print("BLE channel [ {:d} ]: {:.1f} pkt/s, cpu:{:.1f}% ({})".format(
+                    opts.scan_channels[n], stats[n].ok / elapsed, 100.0 * stats[n].busy / elapsed, stats[n].dump()))
+                stats[n].reset()
+    finally:
+        # Parser threads still running wait here, the output files can be closed
+        lock.acquire()
+
+# Write the last metrics line and stop the metrics endpoint
+
+
+def close_metrics(metrics_log, metrics_server):
+    if metrics_log:
+        metrics_log.close()
+    if metrics_server:
+        metrics_server.shutdown()
+
+# Write the last device aggregates and print the advertiser summary
+
+
+def close_advertisers(advertisers, device_log, opts):
+    if device_log:
+        device_log.close()
+        print("Advertiser aggregates written into:", opts.devices_file)
+    if advertisers:
+        print("Advertisers: {:d} devices ({:d} forgotten), {:d} duplicates ({})".format(
+            len(advertisers.devices), advertisers.forgotten_devices, advertisers.duplicates, opts.dedup))
+
+# Print current Gnu Radio wideband capture settings
+
+
+def print_wideband_settings(gr, opts):
+    print('\n ble-dump:  SDR Bluetooth LE packet dumper')
+    print('\nWideband capture settings:')
+    print(' %-22s: %s Hz' % ('Center Frequency', '{:d}'.format(int(gr.get_freq()))))
+    print(' %-22s: %s Hz' % ('Sample rate', '{:d}'.format(int(gr.get_sample_rate()))))
+    print(' %-22s: %s' % ('Channelizer bins', '{:d}'.format(gr.get_num_chans())))
+    print(' %-22s: %s' % ('Samples per Symbol', '{:d}'.format(gr.get_gmsk_sps())))
 
+    print('\nBluetooth LE:')
+    for channel in opts.scan_channels:
+        print(' %-22s: %s' % ('Channel {:d}'.format(channel), '{:d} MHz, output {:d}'.format(
+            int(ble_channel_freq(channel) / 1000000), gr.get_channel_output(BLE_CHANS[channel]))))
+    if opts.dedup != 'off':
+        print(' %-22s: %s' % ('Dedup', '{} within {:.2f}s'.format(opts.dedup, opts.dedup_window)))
 
-class Stat(object):
-    FIELDS = ['ok', 'err_crc', 'err_len', 'err_pdu', 'err_llid']
-
-    def __init__(self):
-        self.reset()
-
-    def dump(self):
-        output = ""
-        err_total = 0
-        for field in self.FIELDS:
-            if output:
-                output += ", "
-            value = getattr(self, field)
-            output += "{}:{}".format(field, value)
-            if field.startswith('err_'):
-                err_total += value
-        return output + ", err_total:{}".format(err_total)
-
-    def reset(self):
-        for field in self.FIELDS:
-            setattr(self, field, 0)
+    print('\n%-23s: %s\n' %
+          ('PCAP output file', '{:s}'.format(opts.pcap_file)))
 
 # Print current Gnu Radio capture settings
 
@@ -79,13 +196,60 @@ def print_settings(gr, opts):
                           '{:s}'.format(opts.current_ble_channels.replace(',', ', '))))
     print(' %-22s: %ss' %
           ('Scanning Window', '{:.2f}'.format(opts.ble_scan_window)))
+    print(' %-22s: %s' % ('Hopping policy', opts.hop_policy))
+    print(' %-22s: %s' % ('Retune', opts.retune))
+    if opts.target_addresses:
+        print(' %-22s: %s' % ('Target devices', ', '.join(
+            ':'.join('{:02x}'.format(b) for b in bytearray(address)) for address in sorted(opts.target_addresses))))
     print(' %-22s: %s' % ('Disable CRC check', '{0}'.format(opts.disable_crc)))
+    print(' %-22s: %s' % ('Data CRC init', '0x{:06x}'.format(opts.crc_init)))
+    print(' %-22s: %s' % ('Access addresses', ', '.join(
+        '0x{:08x}'.format(x) for x in opts.access_addresses)))
+    print(' %-22s: %s' % ('Max sync bit errors', '{:d}'.format(opts.max_bit_errors)))
     print(' %-22s: %s' % ('Disable De-Whitening',
                           '{0}'.format(opts.disable_dewhitening)))
 
+    if opts.replay:
+        print(' %-22s: %s' % ('Replay IQ file', '{:s}'.format(opts.replay)))
+        print(' %-22s: %s' % ('Replay throttle', '{0}'.format(opts.replay_throttle)))
+    if opts.triggered:
+        print(' %-22s: %s' % ('Triggered recording', '-{:.0f}us / +{:.0f}us'.format(
+            opts.pre_trigger * 1e6, opts.post_trigger * 1e6)))
+    if opts.dedup != 'off':
+        print(' %-22s: %s' % ('Dedup', '{} within {:.2f}s'.format(opts.dedup, opts.dedup_window)))
+
     print('\n%-23s: %s\n' %
           ('PCAP output file', '{:s}'.format(opts.pcap_file)))
 
+# Open the buffered PCAP writer with the command line flush policy
+
+
+def open_pcap_writer(opts):
+    return PcapWriter(opts.pcap_file, opts.pcapng, opts.flush_packets, opts.flush_bytes, opts.flush_interval)
+
+# Open the packet store and add the capture to it, with the IQ file holding the sample
+# ranges of its packets (none for a triggered recording, which only holds windows)
+
+
+def open_store(gr, opts, start_ns):
+    if not opts.store:
+        return None
+    store = PacketStore(opts.store, flush_interval=opts.flush_interval)
+    iq_file, fmt = (opts.replay, opts.replay_format) if opts.replay else (opts.iq_output, opts.output_format)
+    if opts.triggered or iq_file == os.devnull:
+        iq_file = None
+    store.add_capture(iq_file and os.path.abspath(iq_file), fmt.name, gr.get_sample_rate(), start_ns)
+    return store
+
+# Time of the first IQ sample in nanoseconds: now for a live capture, estimated
+# from the file modification time for a replay
+
+
+def capture_start_ns(gr, opts):
+    if opts.replay:
+        return int(capture_start(opts.replay, gr.get_sample_rate(), opts.replay_format) * 1e6) * 1000
+    return time_ns()
+
 # Setup Gnu Radio with defined command line arguments
 
 
@@ -114,8 +278,35 @@ def init_opts(gr):
     capture = OptionGroup(parser, 'Capture settings')
     capture.add_option("-o", "--pcap_file", type="string",
                        default='', help="PCAP output file or named pipe (FIFO)")
+    capture.add_option("--pcapng", action="store_true", default=False,
+                       help="Write PCAPNG with nanosecond timestamps and the IQ sample index of each packet [default=%default]")
+    capture.add_option("--flush_packets", type="int", default=PCAP_FLUSH_PACKETS,
+                       help="Write the PCAP file every N packets, every packet for a named pipe [default=%default]")
+    capture.add_option("--flush_bytes", type="int", default=PCAP_FLUSH_BYTES,
+                       help="Write the PCAP file every N bytes [default=%default]")
+    capture.add_option("--flush_interval", type="eng_float", default=PCAP_FLUSH_INTERVAL,
+                       help="Write the PCAP file at least every N seconds [default=%default]")
+    capture.add_option("--store", type="string", default='',
+                       help="Also record the packets into this SQLite packet store, queried by ble_query.py")
+    capture.add_option("--dedup", type="choice", choices=DEDUP_POLICIES, default='off',
+                       help="Copies of an advertising PDU within the dedup window: off (all reported), collapse "
+                       "(only in the packet index) or suppress (dropped) [default=%default]")
+    capture.add_option("--dedup_window", type="eng_float", default=1.0,
+                       help="Dedup window (seconds) [default=%default]")
+    capture.add_option("--dedup_entries", type="int", default=4096,
+                       help="PDUs and devices held by the dedup cache [default=%default]")
+    capture.add_option("--devices_file", type="string", default='',
+                       help="Write the advertiser aggregates (packets, duplicates, channels, first/last seen) into this csv file")
+    capture.add_option("--devices_interval", type="eng_float", default=DEVICES_INTERVAL,
+                       help="Interval of the advertiser aggregates file (seconds) [default=%default]")
     capture.add_option("-m", "--min_buffer_size", type="int",
                        default=65, help="Minimum buffer size [default=%default]")
+    capture.add_option("--queue_depth", type="int", default=gr.queue_depth,
+                       help="Gnu Radio message queue depth (messages, 0 for no limit) [default=%default]")
+    capture.add_option("--buffer_depth", type="int", default=256,
+                       help="Messages buffered by the reader thread for the parser [default=%default]")
+    capture.add_option("--overflow", type="choice", choices=OVERFLOW_POLICIES, default='block',
+                       help="When the reader buffer is full: block (the flowgraph waits), drop-oldest or drop-newest [default=%default]")
     capture.add_option("-s", "--sample-rate", type="eng_float",
                        default=gr.sample_rate, help="Sample rate [default=%default]")
     capture.add_option("-t", "--squelch_threshold", type="eng_float", default=gr.squelch_threshold,
@@ -149,10 +340,30 @@ def init_opts(gr):
                    default='37,38,39', help="BLE channels to scan [default=%default]")
     ble.add_option("-w", "--ble_scan_window", type="eng_float",
                    default=10.24, help="BLE scan window [default=%default]")
+    ble.add_option("--hop_policy", type="choice", choices=HOP_POLICIES, default='fixed',
+                   help="Dwell times: fixed (the scan window) or adaptive (longer on busy channels and "
+                   "channels of the target devices) [default=%default]")
+    ble.add_option("--min_dwell", type="eng_float", default=None,
+                   help="Minimum dwell time on a channel with adaptive hopping (seconds) [default=scan window / 4]")
+    ble.add_option("--max_dwell", type="eng_float", default=None,
+                   help="Maximum dwell time on a channel with adaptive hopping (seconds) [default=scan window * channels]")
+    ble.add_option("--target_addresses", type="string", default='',
+                   help="Advertiser addresses of the target devices (aa:bb:cc:dd:ee:ff, comma separated)")
+    ble.add_option("--target_weight", type="eng_float", default=10.0,
+                   help="Packets a target device packet counts for with adaptive hopping [default=%default]")
+    ble.add_option("--retune", type="choice", choices=RETUNE_MODES, default=gr.retune,
+                   help="Channel changes: lo (retune the USRP) or digital (move the frequency translating "
+                   "filter when the channel is inside the captured band, else retune the USRP) [default=%default]")
     ble.add_option("-x", "--disable_crc", action="store_true",
                    default=False, help="Disable CRC verification [default=%default]")
     ble.add_option("-y", "--disable_dewhitening", action="store_true",
                    default=False, help="Disable De-Whitening [default=%default]")
+    ble.add_option("-a", "--access_addresses", type="string", default='0x8e89bed6',
+                   help="Access addresses to detect (comma separated) [default=%default]")
+    ble.add_option("-e", "--max_bit_errors", type="int", default=1,
+                   help="Bit errors allowed in preamble and access address [default=%default]")
+    ble.add_option("-k", "--crc_init", type="int", default=BLE_CRC_INIT,
+                   help="CRC init value of data channel packets [default=0x555555]")
 
     # Misc
     misc = OptionGroup(parser, "Misc")
@@ -160,6 +371,38 @@ def init_opts(gr):
                     help="Activate debug (dump wrong packets)")
     misc.add_option('-i', '--iq-output', type='string', default=gr.iq_output,
                     help="Filename for IQ data [default=%default]")
+    misc.add_option('--iq_format', type='choice', choices=sorted(IQ_FORMATS), default=None,
+                    help="Format of the IQ data files (-i, -r): cf32, sc16 or sc8 [default=from the file extension, else cf32]")
+    misc.add_option('-b', '--binary_index', action='store_true', default=False,
+                    help="Record the packet index as fixed-width binary records (.idx) instead of CSV [default=%default]")
+    misc.add_option('--dataset', type='string', default='',
+                    help="Build the tagged SigMF archive DATASET.sigmf while capturing (packet IQ data and robot positions)")
+    misc.add_option('--robot_csv', type='string', default='',
+                    help="Robot positions of the dataset from a csv file recorded by get_robot_position.py")
+    misc.add_option('--robot_url', type='string', default='',
+                    help="Robot positions of the dataset polled from this position server")
+    misc.add_option('--robot_nodes', type='string', default='5',
+                    help="Robot nodes polled with --robot_url [default=%default]")
+    misc.add_option('--iq_history', type='eng_float', default=2.0,
+                    help="IQ samples held in memory for --dataset and --triggered (seconds) [default=%default]")
+    misc.add_option('--triggered', action='store_true', default=False,
+                    help="Only record the IQ data around decoded packets, with a window index (-windows.csv) [default=%default]")
+    misc.add_option('--pre_trigger', type='eng_float', default=20e-6,
+                    help="IQ data recorded before a packet with --triggered (seconds) [default=%default]")
+    misc.add_option('--post_trigger', type='eng_float', default=20e-6,
+                    help="IQ data recorded after a packet with --triggered (seconds) [default=%default]")
+    misc.add_option('--metrics_file', type='string', default='',
+                    help="Append the pipeline metrics (stage timings, queue depths, rates) to this file as JSON lines")
+    misc.add_option('--metrics_interval', type='eng_float', default=METRICS_INTERVAL,
+                    help="Interval of the JSON lines metrics (seconds) [default=%default]")
+    misc.add_option('--metrics_port', type='int', default=0,
+                    help="Serve the metrics in Prometheus text format on http://127.0.0.1:PORT/metrics")
+    misc.add_option('-W', '--wideband', action='store_true', default=False,
+                    help="Capture all BLE channels at once with a polyphase channelizer [default=%default]")
+    misc.add_option('-r', '--replay', type='string', default='',
+                    help="Decode a recorded IQ file instead of capturing, following its channel hops")
+    misc.add_option('--replay_throttle', action='store_true', default=False,
+                    help="Replay at the sample rate instead of as fast as possible [default=%default]")
 
     parser.add_option_group(capture)
     parser.add_option_group(filters)
@@ -172,201 +415,325 @@ def init_opts(gr):
 if __name__ == '__main__':
     MIN_BUFFER_LEN = 65
 
-    # Initialize Gnu Radio
-    gr_block = gr_block()
-    gr_block.start()
-
     # Initialize command line arguments
     (opts, args) = init_opts(gr_block)
 
-    # Initialize CSV file  to record start/end of BLE packets and robot positions
-    csv_file = opts.iq_output.split('.')[0]+'.csv'
-    base_csv = os.path.dirname(csv_file)
-    if not os.path.exists(base_csv):
-        os.makedirs(base_csv)
-    with open(csv_file, 'w') as csvfile:
-        fieldnames = ['Time', 'Start_trame', 'End_trame',
-                      'Channel_frequency', 'Sample_rate']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+    # Prepare BLE channels argument
+    opts.scan_channels = [int(x) for x in opts.current_ble_channels.split(',') if x]
+
+    # Prepare access addresses argument
+    opts.access_addresses = [int(x, 0) for x in opts.access_addresses.split(',')]
+    opts.target_addresses = parse_addresses(opts.target_addresses)
+
+    # IQ formats of the recorded and replayed IQ data
+    opts.output_format = iq_format(opts.iq_output, opts.iq_format)
+    opts.replay_format = iq_format(opts.replay, opts.iq_format)
+
+    # Initialize Gnu Radio
+    if opts.replay and opts.replay.split('.')[0] == opts.iq_output.split('.')[0]:
+        print('\nerror: please specify another IQ output file (-i) to name the replay CSV file')
+        exit(1)
+    if opts.wideband and (opts.dataset or opts.triggered):
+        print('\nerror: --dataset and --triggered are not supported in wideband mode')
+        exit(1)
+    if opts.wideband:
+        gr_block = gr_wideband_block([BLE_CHANS[x] for x in opts.scan_channels],
+                                     iq_input=opts.replay, throttle=opts.replay_throttle,
+                                     iq_format=(opts.replay_format if opts.replay else opts.output_format).name,
+                                     queue_depth=opts.queue_depth)
+    else:
+        gr_block = gr_block(iq_input=opts.replay, throttle=opts.replay_throttle,
+                            iq_tap=bool(opts.dataset or opts.triggered), iq_file_sink=not opts.triggered,
+                            iq_format=(opts.replay_format if opts.replay else opts.output_format).name,
+                            queue_depth=opts.queue_depth, retune=opts.retune)
 
     if not opts.pcap_file:
         print('\nerror: please specify pcap output file (-o)')
         exit(1)
 
-    # Verify BLE channels argument
-    if ',' not in opts.current_ble_channels:
-        opts.current_ble_channels += ','
+    # Initialize packet index (CSV or binary) to record start/end of BLE packets
+    index_file = packet_index_file(opts.iq_output, opts.binary_index)
+    base_index = os.path.dirname(index_file)
+    if base_index and not os.path.exists(base_index):
+        os.makedirs(base_index)
+    packet_index = PacketIndexWriter(index_file, opts.binary_index, opts.flush_packets, opts.flush_interval)
 
-    # Prepare BLE channels argument
-    opts.scan_channels = [int(x) for x in opts.current_ble_channels.split(',')]
+    if opts.debug:
+        def debug(*args):
+            print(*args)
+    else:
+        def debug(*args):
+            pass
+
+    # Pipeline metrics, written as JSON lines and served to Prometheus if requested
+    metrics = Metrics()
+    metrics_log = MetricsLog(opts.metrics_file, metrics, opts.metrics_interval) if opts.metrics_file else None
+    metrics_server = start_metrics_server(metrics, opts.metrics_port) if opts.metrics_port else None
+
+    # Advertiser dedup cache and per-device aggregates
+    advertisers = None
+    device_log = None
+    if opts.dedup != 'off' or opts.devices_file:
+        advertisers = AdvertiserCache(opts.dedup_window, opts.dedup_entries, opts.dedup_entries)
+    if opts.devices_file:
+        device_log = DeviceLog(opts.devices_file, advertisers, opts.devices_interval)
+
+    if opts.wideband:
+        gr_block.set_rf_gain(opts.rf_gain)
+        gr_block.set_iq_output(opts.iq_output)
+        gr_block.set_duration_seconds(opts.duration_seconds)
+        start_ns = capture_start_ns(gr_block, opts)
+        store = open_store(gr_block, opts, start_ns)
+        gr_block.start()
+        if opts.replay:
+            eof_thread = threading.Thread(target=gr_block.notify_eof)
+            eof_thread.daemon = True
+            eof_thread.start()
+        print_wideband_settings(gr_block, opts)
+        pcap = open_pcap_writer(opts)
+        try:
+            wideband_capture(gr_block, opts, pcap, packet_index, start_ns, metrics, metrics_log, advertisers,
+                             device_log, store, debug)
+        except KeyboardInterrupt:
+            print("Stopping...")
+        pcap.close()
+        packet_index.close()
+        if store:
+            store.close()
+        gr_block.stop()
+        gr_block.wait()
+        close_metrics(metrics_log, metrics_server)
+        close_advertisers(advertisers, device_log, opts)
+        exit(0)
 
     # Set Gnu Radio opts
     init_args(gr_block, opts)
+    start_ns = capture_start_ns(gr_block, opts)
+    store = open_store(gr_block, opts, start_ns)
+    gr_block.start()
+
+    # Reader thread draining the message queue, parser stalls do not hold up the flowgraph
+    reader = MessageReader(gr_block.message_queue, opts.buffer_depth, opts.overflow, TAG_MESSAGE)
+    # IQ sample index and time of the bits, from the stream tags
+    clock = SampleClock(gr_block.get_gmsk_sps(), gr_block.get_sample_rate(), start_ns, gr_block.get_sample_delay(),
+                        metrics)
 
     # Print capture settings
     print_settings(gr_block, opts)
 
-    # Open PCAP file descriptor
-    pcap_fd = open_pcap(opts.pcap_file)
+    # Open PCAP file
+    pcap = open_pcap_writer(opts)
 
-    current_hop = 1
-    hopping_time = datetime.now() + timedelta(seconds=opts.ble_scan_window)
+    # Dwell time of each scanned channel, from its decoding statistics with the adaptive policy
+    scheduler = HopScheduler(opts.scan_channels, opts.ble_scan_window, opts.min_dwell, opts.max_dwell,
+                             opts.hop_policy, opts.target_addresses, opts.target_weight)
+    # Retune count, host latency and samples lost per retune mode
+    retunes = {}
 
     # Set initial BLE channel
-    current_ble_chan = opts.scan_channels[0]
+    current_ble_chan = scheduler.channel
     gr_block.set_ble_channel(BLE_CHANS[current_ble_chan])
 
-    # Prepare Gnu Radio receive buffers
-    gr_buffer = ''
-    lost_data = ''
+    if opts.replay:
+        # Follow the channel hops of the recording, the flowgraph stops at the end of the file
+        hops = read_hops(opts.replay)
+        if hops:
+            current_ble_chan = hops[0][1]
+            gr_block.set_ble_channel(BLE_CHANS[current_ble_chan])
+        # Channel offset of a recording retuned digitally, the filter follows the first one only
+        offsets = read_hop_offsets(opts.replay)
+        if offsets:
+            gr_block.set_freq_offset(offsets[0][1])
+            if len(set(offset for _, offset in offsets)) > 1:
+                print("Warning: the recording was retuned digitally, only the hops at {:.0f} Hz from the capture "
+                      "center are decoded (gfsk_demod.py follows all of them)".format(offsets[0][1]))
+        eof_thread = threading.Thread(target=gr_block.notify_eof)
+        eof_thread.daemon = True
+        eof_thread.start()
+    else:
+        # Record channel hops next to the IQ data, they are followed in replay mode
+        hops = [(0, current_ble_chan)]
+        hops_fd = open(hops_file(opts.iq_output), 'w')
+        hops_writer = csv.writer(hops_fd)
+        hops_writer.writerow(['Start_trame', 'Channel', 'Freq_offset'])
+        hops_writer.writerow([0, current_ble_chan, gr_block.get_lo_freq() - gr_block.get_freq()])
+    hop_starts = [start for start, _ in hops]
+
+    # Prepare Gnu Radio receive buffer (demodulated bits), it keeps one maximum
+    # packet length for the next pass: packets starting there are decoded once
+    # the following message arrived
+    gr_buffer = RingBuffer(BLE_MAX_PACKET_BITS)
 
     print('Capturing on BLE channel [ {:d} ] @ {:d} MHz'.format(
         current_ble_chan, int(gr_block.get_freq() / 1000000)))
 
     stat = Stat()
 
-    if opts.debug:
-        def debug(*args):
-            print(*args)
-    else:
-        def debug(*args):
-            pass
-    global_buffer_len = 0
-    lost_data_len = 0
+    # Tagged SigMF dataset and triggered recording: packet samples are read back
+    # from a ring of recent IQ samples
+    dataset = None
+    recorder = None
+    if gr_block.iq_queue is not None:
+        sample_ring = SampleRing(int(opts.iq_history * gr_block.get_sample_rate()))
+        reader_thread = threading.Thread(target=iq_reader, args=(gr_block.iq_queue, sample_ring))
+        reader_thread.daemon = True
+        reader_thread.start()
+    if opts.triggered:
+        recorder = TriggeredRecorder(opts.iq_output, opts.pre_trigger * gr_block.get_sample_rate(),
+                                     opts.post_trigger * gr_block.get_sample_rate(), opts.output_format)
+    if opts.dataset:
+        dataset = LiveDataset(opts.dataset, open_positions(
+            opts.robot_csv, opts.robot_url, [int(x) for x in opts.robot_nodes.split(',') if x]),
+            fmt=opts.output_format)
+
+    # BLE channel of a bit of the stream: bits demodulated before a hop belong to the previous channel
+    def channel_at(index_buffer_bits):
+        if hops:
+            return hop_channel(hops, hop_starts, clock.sample_at(index_buffer_bits))
+        return current_ble_chan
+
+    replay_started = time()
     try:
         while True:
             # Move to the next BLE scanning channel
-            if datetime.now() >= hopping_time:
-                current_ble_chan = opts.scan_channels[current_hop % len(
-                    opts.scan_channels)]
+            if not opts.replay and scheduler.due():
+                previous_ble_chan = current_ble_chan
+                current_ble_chan = scheduler.hop()
                 gr_block.set_ble_channel(BLE_CHANS[current_ble_chan])
-                hopping_time = datetime.now() + timedelta(seconds=opts.ble_scan_window)
-                current_hop += 1
-                print("Switching to BLE channel [ {:d} ] @ {:d} MHz ({})".format(
-                    current_ble_chan, int(gr_block.get_freq() / 1000000), stat.dump()))
+                retune, retune_latency, samples_lost = gr_block.get_last_retune()
+                print("Switching to BLE channel [ {:d} ] @ {:d} MHz for {:.2f}s, {} retune {:.0f} us, {:d} samples "
+                      "lost ({})".format(current_ble_chan, int(gr_block.get_freq() / 1000000), scheduler.current_dwell,
+                                         retune, retune_latency * 1e6, samples_lost, stat.dump()))
                 stat.reset()
+                metrics.observe('retune_' + retune, retune_latency)
+                metrics.add('retunes', mode=retune)
+                metrics.add('retune_samples_lost', samples_lost, mode=retune)
+                retune_stat = retunes.setdefault(retune, [0, 0.0, 0])
+                retune_stat[0] += 1
+                retune_stat[1] += retune_latency
+                retune_stat[2] += samples_lost
+                channel_stat = scheduler.stats[previous_ble_chan]
+                metrics.set('channel_yield', channel_stat.yield_rate, channel=previous_ble_chan)
+                metrics.set('channel_dwell_seconds', channel_stat.dwell, channel=previous_ble_chan)
+                metrics.add('hops')
+                if scheduler.index == 0:
+                    print("Channel yield: {}".format(scheduler.summary()))
+                # The bits still queued were demodulated before the retune took effect
+                retune_sample, retune_time_ns = gr_block.get_retune_start()
+                if retune_sample is None:
+                    retune_sample = clock.sample_of_time(retune_time_ns)
+                hops.append((max(retune_sample, hops[-1][0]), current_ble_chan))
+                hop_starts.append(hops[-1][0])
+                # Only the hops of the bits still buffered are looked up
+                if len(hops) > 64:
+                    del hops[:32]
+                    del hop_starts[:32]
+                hops_writer.writerow([hops[-1][0], current_ble_chan, gr_block.get_lo_freq() - gr_block.get_freq()])
+                hops_fd.flush()
 
             # Fetch data from Gnu Radio message queue
-            gr_buffer += gr_block.message_queue.delete_head().to_string()
-
-            if len(gr_buffer) < opts.min_buffer_size:
+            search_len, eof = fetch_bits(reader, gr_buffer, opts.min_buffer_size, metrics)
+            clock.read_tags(reader.tags)
+            if search_len is None:
                 continue
 
-            # Prepend lost data
-            if len(lost_data) > 0:
-                gr_buffer = ''.join(str(x) for x in lost_data) + gr_buffer
-                lost_data = ''
-
-            # Search for BLE_PREAMBLE in received data
-            for pos in [position for position, byte, in enumerate(gr_buffer) if byte == BLE_PREAMBLE]:
-                pos += BLE_PREAMBLE_LEN
-                samples_per_symbol = gr_block.get_gmsk_sps()
-                byte_len = 8
-                # Position index of BLE  packet beginning in the global buffer of bytes
-                index_buffer_byte = pos+global_buffer_len - lost_data_len-1
-
-                # Position index in term of bits
-                index_buffer_bits = index_buffer_byte * byte_len
-
-                # Position index of BLE packet beginning in IQ data
-                # Note: GFSK demodulator uses  '$samples_per_symbol' samples for 1 bit symbol
-                start_frame = index_buffer_bits * samples_per_symbol
-
-                # Check enough data is available for parsing the BLE Access Address
-                if len(gr_buffer[pos:]) < (BLE_ADDR_LEN + BLE_PDU_HDR_LEN):
-                    continue
-
-                debug("Found something @{}/{}".format(pos, len(gr_buffer)))
-
-                # Extract BLE Access Address
-                ble_access_address = unpack(
-                    'I', gr_buffer[pos:pos + BLE_ADDR_LEN])[0]
-                pos += BLE_ADDR_LEN
-
-                # Dewhitening received BLE Header
-                if opts.disable_dewhitening == False:
-                    ble_header = dewhitening(
-                        gr_buffer[pos:pos + BLE_PDU_HDR_LEN], current_ble_chan)
-                else:
-                    ble_header = gr_buffer[pos:pos + BLE_PDU_HDR_LEN]
-
-                # Check BLE PDU type
-                ble_pdu_type = ble_header[0] & 0x0f
-                if ble_pdu_type not in BLE_PDU_TYPE.values():
-                    debug("Invalid ble_pdu_type: {:x}".format(ble_pdu_type))
-                    stat.err_pdu += 1
+            started = time()
+
+            for index_buffer_bits, channel, packet in decode_buffer(gr_buffer, search_len, channel_at,
+                                                                    opts, stat, metrics, debug):
+                # Channel of the recording at this position
+                if channel != current_ble_chan:
+                    current_ble_chan = channel
+                    gr_block.set_ble_channel(BLE_CHANS[current_ble_chan])
+                    print("Replaying BLE channel [ {:d} ] @ {:d} MHz ({})".format(
+                        current_ble_chan, int(gr_block.get_freq() / 1000000), stat.dump()))
+                    stat.reset()
+
+                scheduler.record(channel, adv_address(packet))
+                reported = report_packet(packet, channel, index_buffer_bits, clock, gr_block.get_sample_rate(),
+                                         pcap, packet_index, metrics, advertisers, opts.dedup, store)
+                if reported is None:
                     continue
-
-                if ble_access_address == BLE_ACCESS_ADDR:
-                    # Extract BLE Length
-                    ble_len = ble_header[1] & 0x3f
-                else:
-                    ble_llid = ble_header[0] & 0x3
-                    if ble_llid == 0:
-                        debug("Invalid LLID")
-                        stat.err_llid += 1
-                        continue
-
-                    # Extract BLE Length
-                    ble_len = ble_header[1] & 0x1f
-
-                # Dewhitening BLE packet
-                if opts.disable_dewhitening == False:
-                    ble_data = dewhitening(
-                        gr_buffer[pos:pos + BLE_PDU_HDR_LEN + BLE_CRC_LEN + ble_len], current_ble_chan)
-                else:
-                    ble_data = gr_buffer[pos:pos +
-                                         BLE_PDU_HDR_LEN + BLE_CRC_LEN + ble_len]
-
-                # Verify BLE data length
-                if len(ble_data) != (BLE_PDU_HDR_LEN + BLE_CRC_LEN + ble_len):
-                    lost_data = gr_buffer[pos - BLE_PREAMBLE_LEN - BLE_ADDR_LEN:pos +
-                                          BLE_PREAMBLE_LEN + BLE_ADDR_LEN + BLE_PDU_HDR_LEN + BLE_CRC_LEN + ble_len]
-                    debug("Invalid len: {} vs. {}".format(
-                        len(ble_data), ble_len))
-                    stat.err_len += 1
-                    continue
-
-                # Verify BLE packet checksum
-                if opts.disable_crc == False:
-                    if ble_data[-3:] != crc(ble_data, BLE_PDU_HDR_LEN + ble_len):
-                        stat.err_crc += 1
-                        continue
-
-                if ble_pdu_type in [BLE_PDU_TYPE[t] for t in ['ADV_IND', 'ADV_DIRECT_IND', 'ADV_NONCONN_IND']]:
-                    print("BLE-ADV: t:0x{:x}, {}".format(ble_pdu_type,
-                                                         binascii.hexlify(bytearray(reversed(ble_data[2:8])))))
-                    print("Index of BLE beginning ADV packet in IQ data: ", start_frame)
-                    frame_iq_len = (BLE_ADDR_LEN+BLE_PREAMBLE_LEN +
-                                    BLE_PDU_HDR_LEN + BLE_CRC_LEN + ble_len)*8*samples_per_symbol
-                    # End of a detected BLE ADV
-                    end_frame = start_frame+frame_iq_len
-                    record_ble_iq_information(start_frame, end_frame, int(gr_block.get_freq()), int(
-                        gr_block.get_sample_rate()), csv_file)
-
-                else:
-                    print("BLE-pkt: {}".format(binascii.hexlify(bytearray(ble_data))))
-                    print("Index of BLE beginning ADV packet in IQ data:", start_frame)
-                    frame_iq_len = (BLE_ADDR_LEN+BLE_PREAMBLE_LEN +
-                                    BLE_PDU_HDR_LEN + BLE_CRC_LEN + ble_len)*8*samples_per_symbol
-                    # End of a detected BLE packet
-                    end_frame = start_frame+frame_iq_len
-                    record_ble_iq_information(start_frame, end_frame, int(gr_block.get_freq()), int(
-                        gr_block.get_sample_rate()), csv_file)
-
-                # Write BLE packet to PCAP file descriptor
-                write_pcap(pcap_fd, current_ble_chan,
-                           ble_access_address, ble_data)
-                stat.ok += 1
-            global_buffer_len += len(gr_buffer)
-            lost_data_len += len(lost_data)
-            gr_buffer = ''
+                start_frame, end_frame, timestamp_ns = reported
+                if dataset:
+                    dataset.add_packet(start_frame, end_frame, int(ble_channel_freq(channel)),
+                                       int(gr_block.get_sample_rate()), timestamp_ns)
+                if recorder:
+                    recorder.add_packet(start_frame, end_frame)
+
+            # Carry the unsearched tail over to the next pass
+            gr_buffer.consume(search_len)
+            clock.forget(gr_buffer.offset)
+            stat.bits += search_len
+            stat.busy += time() - started
+            pcap.poll()
+            packet_index.poll()
+            if store:
+                store.poll()
+            if dataset:
+                dataset.process(sample_ring)
+                metrics.set('dataset_packets_lost', dataset.lost)
+            if recorder:
+                recorder.process(sample_ring)
+                metrics.set('triggered_windows_truncated', recorder.truncated)
+            if gr_block.iq_queue is not None:
+                metrics.set('iq_queue_depth', gr_block.iq_queue.count())
+            if not opts.replay:
+                # Time between the arrival of the last parsed sample and now
+                metrics.set('parser_lag_seconds', time() - clock.time_ns(clock.sample_at(gr_buffer.offset)) / 1e9)
+            if device_log:
+                device_log.poll()
+            if advertisers:
+                metrics.set('advertisers', len(advertisers.devices))
+            if metrics_log:
+                metrics_log.poll()
+
+            if eof:
+                break
+
+        if opts.replay:
+            elapsed = time() - replay_started
+            samples = clock.sample_at(gr_buffer.offset)
+            print("Replayed {:d} samples in {:.2f}s ({:.0f} samples/s, {})".format(
+                int(samples), elapsed, samples / elapsed, stat.dump()))
 
     except KeyboardInterrupt:
         print("Stopping...")
         pass
 
-pcap_fd.close()
-gr_block.stop()
-gr_block.wait()
+    if not opts.replay:
+        scheduler.stop()
+        print("Channel yield ({} hopping, {:d} hops): {}".format(opts.hop_policy, scheduler.hops, scheduler.summary()))
+        for retune in sorted(retunes):
+            count, retune_latency, samples_lost = retunes[retune]
+            print("{} retunes: {:d}, {:.0f} us on average, {:d} samples lost ({:.0f} per hop)".format(
+                retune.capitalize(), count, retune_latency / count * 1e6, samples_lost, samples_lost / float(count)))
+        if clock.overflows:
+            print("UHD overflows: {:d}, {:d} samples dropped".format(clock.overflows, clock.dropped_samples))
+
+    if reader.dropped_messages:
+        print("Reader buffer full: {:d} messages ({:d} bits) dropped ({}), up to {:d} messages buffered".format(
+            reader.dropped_messages, reader.dropped_bytes, opts.overflow, reader.high_water))
+    pcap.close()
+    packet_index.close()
+    if store:
+        store.close()
+    if not opts.replay:
+        hops_fd.close()
+    gr_block.stop()
+    gr_block.wait()
+
+    if gr_block.iq_queue is not None:
+        # The IQ tap ends with the flowgraph, its last samples complete the dataset and recording
+        if not opts.replay:
+            gr_block.notify_eof()
+        reader_thread.join()
+    if recorder:
+        recorder.close(sample_ring)
+        print("Triggered recording: {:d} windows, {:d} samples ({:d} truncated) into {}".format(
+            recorder.windows, recorder.offset, recorder.truncated, opts.iq_output))
+    if dataset:
+        archive_path = dataset.close(sample_ring)
+        print("Dataset: {:d} packets, {:d} lost, archive: {}".format(dataset.packets, dataset.lost, archive_path))
+    close_metrics(metrics_log, metrics_server)
+    close_advertisers(advertisers, device_log, opts)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  ble-dump: BLE packet search in the demodulated bit stream
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import binascii
+from bisect import bisect_right
+from struct import unpack
+from time import time
+
+import numpy as np
+
+from proto import (BLE_ADV_PDU_TYPES, adv_address, ble_channel_freq, find_access_address, packet_bits,
+                   parse_packet, sample_time_ns)
+
+# Message type of the anchors sent by the flowgraph with the demodulated bits (see grc/gr_stream_tags.py)
+# Anchor: bit index, IQ sample index, rx_time in ns (-1 if unknown)
+TAG_MESSAGE = 2
+ANCHOR_FORMAT = '<QQq'
+
+
+class Stat(object):
+    FIELDS = ['sync', 'ok', 'err_crc', 'err_len', 'err_pdu', 'err_llid']
+
+    def __init__(self):
+        self.reset()
+
+    def dump(self):
+        output = ""
+        err_total = 0
+        for field in self.FIELDS:
+            if output:
+                output += ", "
+            value = getattr(self, field)
+            output += "{}:{}".format(field, value)
+            if field.startswith('err_'):
+                err_total += value
+        # Parsing time per second of air time (1 Mbit/s)
+        load = self.busy / (self.bits / 1e6) if self.bits else 0.0
+        return output + ", err_total:{}, load:{:.4f}".format(err_total, load)
+
+    def reset(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+        self.bits = 0
+        self.busy = 0.0
+
+
+class SampleClock(object):
+    """
+     IQ sample index and capture time of the demodulated bits. The flowgraph tags
+     the IQ samples with their index and the demodulator carries the tags to the
+     bits, the anchors (bit index, sample index, UHD rx_time) received are
+     interpolated: the clock recovery, squelch and dropped messages do not move the
+     packet positions. Without anchors, a bit lasts 'samples_per_bit' samples.
+     UHD sends a new rx_time after an overflow: a time jump larger than the
+     sample count between two rx_time anchors is counted as an overflow and the
+     missing samples as dropped (into 'metrics' if given).
+
+            delay       --- filter delay (samples) between the tagged samples and the demodulator input
+            start_ns    --- time of sample 0 when no rx_time was received
+            labels      --- labels of the overflow metrics
+    """
+
+    def __init__(self, samples_per_bit, sample_rate, start_ns, delay=0, metrics=None, **labels):
+        self.samples_per_bit = samples_per_bit
+        self.sample_rate = sample_rate
+        self.start_ns = start_ns
+        self.delay = delay
+        self.metrics = metrics
+        self.labels = labels
+        self.anchors = 0
+        self.overflows = 0
+        self.dropped_samples = 0
+        self._bits = []
+        self._samples = []
+        self._time_samples = []
+        self._times = []
+
+    def add_anchor(self, bit_index, sample_index, time_ns=-1):
+        if self._bits and bit_index <= self._bits[-1]:
+            return
+        self._bits.append(bit_index)
+        self._samples.append(sample_index)
+        if time_ns >= 0:
+            if self._times:
+                self._check_overflow(sample_index, time_ns)
+            self._time_samples.append(sample_index)
+            self._times.append(time_ns)
+        self.anchors += 1
+
+    # Count the samples missing between the last rx_time and the one of 'sample_index'
+    def _check_overflow(self, sample_index, time_ns):
+        elapsed = (time_ns - self._times[-1]) * 1e-9 * self.sample_rate
+        dropped = int(round(elapsed - (sample_index - self._time_samples[-1])))
+        if dropped < 1:
+            return
+        self.overflows += 1
+        self.dropped_samples += dropped
+        if self.metrics:
+            self.metrics.add('uhd_overflows', **self.labels)
+            self.metrics.add('dropped_samples', dropped, **self.labels)
+
+    # Add the anchor messages received by a MessageReader
+    def read_tags(self, tags):
+        while tags:
+            self.add_anchor(*unpack(ANCHOR_FORMAT, tags.popleft()))
+
+    # IQ sample index of a bit
+    def sample_at(self, bit_index):
+        bits, samples = self._bits, self._samples
+        n = bisect_right(bits, bit_index)
+        if not bits:
+            sample = bit_index * self.samples_per_bit
+        elif n == 0:
+            sample = samples[0] - (bits[0] - bit_index) * self.samples_per_bit
+        elif n == len(bits):
+            sample = samples[-1] + (bit_index - bits[-1]) * self.samples_per_bit
+        else:
+            sample = samples[n - 1] + (samples[n] - samples[n - 1]) * \
+                float(bit_index - bits[n - 1]) / (bits[n] - bits[n - 1])
+        return max(0, int(round(sample)) - self.delay)
+
+    # Time in ns of an IQ sample, from the last rx_time before it
+    def time_ns(self, sample_index):
+        n = bisect_right(self._time_samples, sample_index)
+        if not n:
+            return sample_time_ns(self.start_ns, sample_index, self.sample_rate)
+        return self._times[n - 1] + (sample_index - self._time_samples[n - 1]) * 1000000000 // int(self.sample_rate)
+
+    # IQ sample index of a time in ns (UHD time), from the last rx_time
+    def sample_of_time(self, time_ns):
+        if not self._times:
+            return int(round((time_ns - self.start_ns) * 1e-9 * self.sample_rate))
+        return self._time_samples[-1] + int(round((time_ns - self._times[-1]) * 1e-9 * self.sample_rate))
+
+    # Forget the anchors before a bit index, the last one before it is kept
+    def forget(self, bit_index):
+        n = bisect_right(self._bits, bit_index) - 1
+        if n > 0:
+            del self._bits[:n]
+            del self._samples[:n]
+        n = bisect_right(self._time_samples, self.sample_at(bit_index)) - 1
+        if n > 0:
+            del self._time_samples[:n]
+            del self._times[:n]
+
+# Append the next Gnu Radio message (from its MessageReader) to the receive buffer
+# Returns the number of bits to search (None while waiting for more data) and
+# whether the stream ended, everything left is searched at the end of a replay
+
+
+def fetch_bits(reader, gr_buffer, min_buffer_size, metrics, **labels):
+    started = time()
+    data, dropped = reader.get()
+    metrics.observe('fetch', time() - started)
+    metrics.set('message_queue_depth', reader.message_queue.count(), **labels)
+    metrics.set('reader_buffer_depth', len(reader), **labels)
+    metrics.set('reader_dropped_messages', reader.dropped_messages, **labels)
+    if data is None:
+        return len(gr_buffer), True
+
+    if dropped:
+        # Bits were dropped before this message: the buffered ones are searched first
+        if len(gr_buffer):
+            reader.unget(data, dropped)
+            return len(gr_buffer), False
+        metrics.add('dropped_bits', dropped, **labels)
+        gr_buffer.skip(dropped)
+    metrics.add('demod_bits', len(data), **labels)
+    gr_buffer.append(data)
+    if gr_buffer.ready < min_buffer_size * 8:
+        return None, False
+    return gr_buffer.ready, False
+
+# Search and decode BLE packets starting in the first 'search_len' bits of the receive buffer
+# Yields (bit index in the stream, BLE channel, packet) tuples, 'channel_at' gives the
+# BLE channel of a bit index
+
+
+def decode_buffer(gr_buffer, search_len, channel_at, opts, stat, metrics, debug):
+    # Search for BLE preamble and access address in received bits
+    started = time()
+    bits = gr_buffer.array()
+    positions = []
+    matched = []
+    for access_address in opts.access_addresses:
+        found = find_access_address(bits, access_address, opts.max_bit_errors, search_len)
+        positions.append(found)
+        matched.append(np.full(len(found), access_address, dtype=np.uint32))
+    positions = np.concatenate(positions)
+    matched = np.concatenate(matched)
+    metrics.observe('detect', time() - started)
+    order = np.argsort(positions, kind='mergesort')
+    for pos, access_address in zip(positions[order], matched[order]):
+        stat.sync += 1
+        # Position index of BLE packet beginning in the bit stream
+        index_buffer_bits = gr_buffer.offset + int(pos)
+        channel = channel_at(index_buffer_bits)
+
+        debug("Found something @{}/{}".format(pos, len(bits)))
+
+        status, packet = parse_packet(bits, pos, channel,
+                                      dewhiten=not opts.disable_dewhitening,
+                                      check_crc=not opts.disable_crc,
+                                      crc_init=opts.crc_init,
+                                      metrics=metrics,
+                                      access_address=int(access_address))
+        metrics.add('packets', status=status)
+        if status != 'ok':
+            debug("Invalid packet: {}".format(status))
+            setattr(stat, status, getattr(stat, status) + 1)
+            continue
+
+        stat.ok += 1
+        yield index_buffer_bits, channel, packet
+
+# Print a decoded BLE packet and record it into the PCAP file and packet index, with its
+# IQ sample positions and reception time given by the sample clock of the stream tags.
+# Advertising packets are added to 'advertisers' (AdvertiserCache), the duplicates are
+# handled according to the 'dedup' policy; returns None for a suppressed duplicate.
+# Reported packets are also recorded into 'store' (PacketStore)
+
+
+def report_packet(packet, channel, index_buffer_bits, clock, sample_rate, pcap, packet_index, metrics,
+                  advertisers=None, dedup='off', store=None):
+    # Position index of BLE packet beginning and end in IQ data
+    start_frame = clock.sample_at(index_buffer_bits)
+    end_frame = clock.sample_at(index_buffer_bits + packet_bits(packet))
+    timestamp_ns = clock.time_ns(start_frame)
+
+    ble_data = packet.data
+    address = adv_address(packet)
+    duplicate = False
+    if advertisers is not None and address is not None:
+        duplicate = advertisers.add(address, ble_data, channel, timestamp_ns)
+    if duplicate:
+        metrics.add('duplicates', policy=dedup)
+        if dedup == 'suppress':
+            return None
+    # Collapsed duplicates are only recorded in the packet index, their IQ samples differ
+    collapsed = duplicate and dedup == 'collapse'
+
+    if not collapsed and packet.pdu_type in BLE_ADV_PDU_TYPES:
+        print("BLE-ADV: t:0x{:x}, {}".format(packet.pdu_type,
+                                             binascii.hexlify(bytearray(reversed(ble_data[2:8])))))
+        print("Index of BLE beginning ADV packet in IQ data: ", start_frame)
+    elif not collapsed:
+        print("BLE-pkt: {}".format(binascii.hexlify(bytearray(ble_data))))
+        print("Index of BLE beginning ADV packet in IQ data:", start_frame)
+
+    started = time()
+    packet_index.write(start_frame, end_frame, int(ble_channel_freq(channel)), int(sample_rate),
+                       timestamp_ns, channel, address)
+    metrics.observe('index_write', time() - started)
+    if store and not collapsed:
+        started = time()
+        store.write(packet, channel, start_frame, end_frame, int(ble_channel_freq(channel)), timestamp_ns)
+        metrics.observe('store_write', time() - started)
+    if collapsed:
+        return start_frame, end_frame, timestamp_ns
+
+    # Write BLE packet to PCAP file
+    started = time()
+    pcap_bytes = pcap.bytes
+    pcap.write(channel, packet.access_address, ble_data, timestamp_ns,
+               'IQ samples {:d}-{:d}'.format(int(start_frame), int(end_frame)), packet.aa_errors)
+    metrics.observe('pcap_write', time() - started)
+    metrics.add('pcap_bytes', pcap.bytes - pcap_bytes)
+    return start_frame, end_frame, timestamp_ns
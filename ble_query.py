@@ -0,0 +1,176 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+#  ble-dump: query the packet store written by ble_dump.py and gfsk_demod.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from __future__ import print_function
+
+import binascii
+import csv
+import os
+from datetime import datetime
+from optparse import OptionGroup, OptionParser
+from time import time
+
+from hop_scheduler import parse_addresses
+from iq_save import iq_save
+from packet_store import STORE_FIELDS, PacketStore
+from proto import *
+
+PDU_TYPE_NAMES = dict((value, name) for name, value in BLE_PDU_TYPE.items())
+
+
+# Time of a query bound: nanoseconds since the epoch or local time ('%Y-%m-%d %H:%M:%S[.%f]')
+
+
+def parse_time(value):
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    for time_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime_to_ns(datetime.strptime(value, time_format))
+        except ValueError:
+            pass
+    raise ValueError('unknown time format: {}'.format(value))
+
+
+def format_address(address):
+    return ':'.join('{:02x}'.format(b) for b in bytearray(address)) if address else ''
+
+
+def print_packets(packets):
+    for packet in packets:
+        print('{} ch {:2d} {:<15s} {:<17s} {:>12d}-{:<12d} {}'.format(
+            ns_to_datetime(packet.time_ns), packet.channel, PDU_TYPE_NAMES.get(packet.pdu_type, '0x{:08x}'.format(
+                packet.access_address)), format_address(packet.adv_address), packet.start_frame, packet.end_frame,
+            binascii.hexlify(packet.pdu).decode()))
+
+
+def write_csv(csv_file, packets):
+    with open(csv_file, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(STORE_FIELDS)
+        for packet in packets:
+            writer.writerow([packet.time_ns, packet.capture, packet.channel, '0x{:08x}'.format(packet.access_address),
+                             PDU_TYPE_NAMES.get(packet.pdu_type, ''), format_address(packet.adv_address),
+                             binascii.hexlify(packet.pdu).decode(), packet.start_frame, packet.end_frame,
+                             packet.frequency])
+
+
+# Write packets as a packet index (binary for a .idx file), which iq_save.py extracts
+
+
+def write_index(index_file, packets, captures):
+    with PacketIndexWriter(index_file, index_file.endswith('.idx')) as packet_index:
+        for packet in packets:
+            capture = captures.get(packet.capture)
+            packet_index.write(packet.start_frame, packet.end_frame, packet.frequency,
+                               capture.sample_rate if capture else 0, packet.time_ns, packet.channel,
+                               packet.adv_address)
+
+
+# Extract the IQ samples of the packets from the IQ file of their capture, or 'iq_file', into
+# <iq>-query-BLE_IQ.sigmf-data, next to the packet index of the query (<iq>-query.idx): the
+# extraction of the whole packet index (<iq>-BLE_IQ.sigmf-data) is left untouched
+
+
+def extract(store, packets, opts):
+    captures = store.captures()
+    for capture_id in sorted(set(packet.capture for packet in packets)):
+        capture = captures.get(capture_id)
+        iq_file = opts.iq_file or (capture and capture.iq_file)
+        if not iq_file or not os.path.exists(iq_file):
+            print('Capture {}: no IQ file, use -i'.format(capture_id))
+            continue
+        fmt = iq_format(iq_file, opts.iq_format or (capture and capture.iq_format))
+        output = os.path.splitext(iq_file)[0] + '-query'
+        index_file = output + '.idx'
+        write_index(index_file, [packet for packet in packets if packet.capture == capture_id], captures)
+        iq_save(index_file, iq_file, opts.jobs, fmt, output=output + '-BLE_IQ')
+
+
+def init_opts():
+    parser = OptionParser(usage="%prog: -d STORE [opts]")
+    parser.add_option("-d", "--store", type="string", default='',
+                      help="Packet store written by ble_dump.py or gfsk_demod.py (--store)")
+
+    query = OptionGroup(parser, 'Query:')
+    query.add_option("-a", "--adv-address", type="string", default='',
+                     help="Advertiser addresses (aa:bb:cc:dd:ee:ff, comma separated)")
+    query.add_option("-c", "--channels", type="string", default='',
+                     help="BLE channels (comma separated)")
+    query.add_option("-s", "--start", type="string", default='',
+                     help="First reception time: ns since the epoch or local time (YYYY-mm-dd HH:MM:SS[.ffffff])")
+    query.add_option("-e", "--end", type="string", default='',
+                     help="Reception time after the last packet, same formats as --start")
+    query.add_option("-t", "--pdu-types", type="string", default='',
+                     help="Advertising PDU types ({}, comma separated)".format(', '.join(sorted(BLE_PDU_TYPE))))
+    query.add_option("--access-address", type="string", default='',
+                     help="Access address (0x8e89bed6 for advertising packets)")
+    query.add_option("--capture", type="string", default='',
+                     help="Capture ids (comma separated)")
+    query.add_option("-n", "--limit", type="int", default=0,
+                     help="Return at most N packets")
+    query.add_option("--count", action="store_true", default=False,
+                     help="Only count the matching packets [default=%default]")
+    parser.add_option_group(query)
+
+    output = OptionGroup(parser, 'Output:')
+    output.add_option("-o", "--csv-file", type="string", default='',
+                      help="Write the matching packets into this csv file instead of printing them")
+    output.add_option("-x", "--index-file", type="string", default='',
+                      help="Write the matching packets as a packet index (binary if .idx) for iq_save.py")
+    output.add_option("-X", "--extract", action="store_true", default=False,
+                      help="Extract the IQ samples of the matching packets with iq_save.py [default=%default]")
+    output.add_option("-i", "--iq-file", type="string", default='',
+                      help="IQ file to extract from [default=the IQ file of the capture]")
+    output.add_option("-F", "--iq-format", type="choice", choices=sorted(IQ_FORMATS), default=None,
+                      help="IQ file format [default=the format of the capture]")
+    output.add_option("-j", "--jobs", type="int", default=1,
+                      help="Processes copying the packets with --extract [default=%default]")
+    parser.add_option_group(output)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    (opts, _) = init_opts()
+    if not opts.store or not os.path.exists(opts.store):
+        print('\nerror: please specify an existing packet store (-d)')
+        exit(1)
+
+    criteria = {
+        'addresses': parse_addresses(opts.adv_address),
+        'channels': [int(x) for x in opts.channels.split(',') if x],
+        'start_ns': parse_time(opts.start),
+        'end_ns': parse_time(opts.end),
+        'pdu_types': [BLE_PDU_TYPE[x.strip().upper()] for x in opts.pdu_types.split(',') if x.strip()],
+        'access_address': int(opts.access_address, 0) if opts.access_address else None,
+        'captures': [int(x) for x in opts.capture.split(',') if x],
+    }
+
+    store = PacketStore(opts.store)
+    started = time()
+    if opts.count:
+        print('{:d} packets ({:.1f} ms)'.format(store.count(**criteria), (time() - started) * 1e3))
+        exit(0)
+    packets = store.query(limit=opts.limit, **criteria)
+    elapsed = time() - started
+
+    if opts.csv_file:
+        write_csv(opts.csv_file, packets)
+    else:
+        print_packets(packets)
+    print('{:d} packets ({:.1f} ms)'.format(len(packets), elapsed * 1e3))
+    if opts.csv_file:
+        print('Packets written into:', opts.csv_file)
+    if opts.index_file:
+        write_index(opts.index_file, packets, store.captures())
+    if opts.extract:
+        extract(store, packets, opts)
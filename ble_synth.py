@@ -0,0 +1,192 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+#  ble-dump: synthetic BLE advertising IQ data with known packets
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from __future__ import print_function
+
+import binascii
+import csv
+from collections import namedtuple
+from optparse import OptionParser
+
+import numpy as np
+
+from proto import *
+
+# PDU types generated, all of them start with the advertiser address
+SYNTH_PDU_TYPES = ['ADV_IND', 'ADV_NONCONN_IND', 'ADV_SCAN_IND', 'SCAN_RSP']
+
+TRUTH_CSV_FIELDS = ['Start_trame', 'End_trame', 'Channel', 'PDU']
+
+# A generated packet: first/end IQ sample, BLE channel and PDU (header and payload, without CRC)
+SynthPacket = namedtuple('SynthPacket', ['start_frame', 'end_frame', 'channel', 'pdu'])
+
+
+# Advertising PDU (header and payload): advertiser address (6 bytes) and advertising data
+
+
+def advertising_pdu(pdu_type, adv_address, adv_data):
+    payload = bytearray(adv_address) + bytearray(adv_data)
+    return bytearray([BLE_PDU_TYPE[pdu_type], len(payload)]) + payload
+
+
+# Random advertising PDU: type, advertiser address and up to 31 bytes of advertising data
+
+
+def random_pdu(rng):
+    return advertising_pdu(SYNTH_PDU_TYPES[rng.randint(len(SYNTH_PDU_TYPES))],
+                           rng.randint(0, 256, 6).astype(np.uint8),
+                           rng.randint(0, 256, rng.randint(0, 32)).astype(np.uint8))
+
+
+# Bits on air of a PDU: preamble, access address, whitened PDU and CRC, in transmission order
+
+
+def air_bits(pdu, channel, access_address=BLE_ACCESS_ADDR, crc_init=BLE_CRC_INIT):
+    pdu = bytearray(pdu)
+    data = pdu + bytearray(crc(list(pdu), len(pdu), crc_init))
+    return np.concatenate((sync_bits(access_address), unpack_bits(dewhiten_array(data, channel))))
+
+
+# Gaussian pulse of the GFSK modulation (bandwidth-time product 'bt'), 'sps' samples per bit
+
+
+def gaussian_taps(sps, bt=0.5, span=4):
+    t = np.arange(-span * sps // 2, span * sps // 2 + 1) / float(sps)
+    alpha = np.sqrt(2 / np.log(2)) * np.pi * bt
+    taps = np.exp(-(alpha * t) ** 2)
+    return taps / taps.sum()
+
+
+# GFSK modulation of bits into unit amplitude complex baseband samples, modulation index 'h'
+
+
+def gfsk_modulate(bits, sps, bt=0.5, h=0.5):
+    nrz = np.repeat(np.asarray(bits, dtype=np.float64) * 2 - 1, sps)
+    freq = np.convolve(nrz, gaussian_taps(sps, bt), 'same')
+    return np.exp(1j * np.pi * h / sps * np.cumsum(freq))
+
+
+def synth_capture(packets=100, sample_rate=5e6, density=500.0, snr_db=20.0, cfo=0.0, freq_offset=1e6,
+                  channel=37, seed=0):
+    """
+     Generate an IQ capture of random advertising packets, as ble_dump.py records it.
+
+            density     --- packets per second of capture, the gaps between packets are random (Poisson)
+            snr_db      --- signal to noise ratio over the sample rate bandwidth
+            cfo         --- carrier frequency offset of the emitters (Hz)
+            freq_offset --- the BLE channel is 'freq_offset' Hz below the capture center
+
+     Returns the complex64 samples and the generated packets (SynthPacket), in sample order.
+    """
+    rng = np.random.RandomState(seed)
+    sps = int(sample_rate / 1e6)
+
+    parts = []
+    truth = []
+    position = 0
+    for n in range(packets):
+        gap = int(rng.exponential(sample_rate / density)) + 100 * sps
+        parts.append(np.zeros(gap, dtype=np.complex128))
+        position += gap
+        pdu = random_pdu(rng)
+        samples = gfsk_modulate(air_bits(pdu, channel), sps)
+        truth.append(SynthPacket(position, position + len(samples), channel, pdu))
+        parts.append(samples)
+        position += len(samples)
+    parts.append(np.zeros(BLE_MAX_PACKET_BITS * sps, dtype=np.complex128))
+
+    iq_samples = np.concatenate(parts)
+    n = np.arange(len(iq_samples))
+    iq_samples *= np.exp(2j * np.pi * ((cfo - freq_offset) / sample_rate * n % 1.0))
+    sigma = np.sqrt(0.5 * 10 ** (-snr_db / 10.0))
+    iq_samples += sigma * (rng.randn(len(iq_samples)) + 1j * rng.randn(len(iq_samples)))
+    return iq_samples.astype(np.complex64), truth
+
+
+# Bits of a demodulated stream (one bit per byte, as the Gnu Radio demodulator sends them)
+# holding random advertising packets between random bits, and the (bit position, PDU) of the packets
+
+
+def synth_bits(packets=100, density=500.0, channel=37, seed=0):
+    rng = np.random.RandomState(seed)
+    parts = []
+    truth = []
+    position = 0
+    for n in range(packets):
+        gap = int(rng.exponential(1e6 / density)) + 100
+        parts.append(rng.randint(0, 2, gap).astype(np.uint8))
+        position += gap
+        pdu = random_pdu(rng)
+        bits = air_bits(pdu, channel)
+        truth.append((position, pdu))
+        parts.append(bits)
+        position += len(bits)
+    parts.append(rng.randint(0, 2, BLE_MAX_PACKET_BITS).astype(np.uint8))
+    return np.concatenate(parts), truth
+
+
+# Write the generated packets: first/end IQ sample, BLE channel and PDU (hex)
+
+
+def write_truth(truth_file, truth):
+    with open(truth_file, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(TRUTH_CSV_FIELDS)
+        for packet in truth:
+            writer.writerow([packet.start_frame, packet.end_frame, packet.channel,
+                             binascii.hexlify(bytes(packet.pdu)).decode()])
+
+
+# Generated packets file of an IQ file
+
+
+def truth_file(iq_file):
+    return iq_file.split('.')[0] + '-truth.csv'
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog: [opts]")
+    parser.add_option("-o", "--iq-file", type="string", default='',
+                      help="IQ output file, cf32, sc16 or sc8 from the extension (see -F)")
+    parser.add_option("-F", "--iq-format", type="choice", choices=sorted(IQ_FORMATS), default=None,
+                      help="IQ file format [default=from the file extension, else cf32]")
+    parser.add_option("-n", "--packets", type="int", default=1000,
+                      help="Packets to generate [default=%default]")
+    parser.add_option("-s", "--sample-rate", type="float", default=5e6,
+                      help="Sample rate, a multiple of 1 MHz [default=%default]")
+    parser.add_option("-d", "--density", type="float", default=500.0,
+                      help="Packets per second [default=%default]")
+    parser.add_option("--snr", type="float", default=20.0,
+                      help="Signal to noise ratio (dB) [default=%default]")
+    parser.add_option("--cfo", type="float", default=0.0,
+                      help="Carrier frequency offset (Hz) [default=%default]")
+    parser.add_option("-f", "--freq-offset", type="float", default=1e6,
+                      help="Offset of the capture center above the BLE channel [default=%default]")
+    parser.add_option("-c", "--channel", type="int", default=37,
+                      help="BLE channel [default=%default]")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Random seed [default=%default]")
+    (opts, _) = parser.parse_args()
+    if not opts.iq_file:
+        print('\nerror: please specify IQ output file (-o)')
+        exit(1)
+
+    iq_samples, truth = synth_capture(opts.packets, opts.sample_rate, opts.density, opts.snr, opts.cfo,
+                                      opts.freq_offset, opts.channel, opts.seed)
+    iq_from_complex(iq_samples, iq_format(opts.iq_file, opts.iq_format)).tofile(opts.iq_file)
+    write_truth(truth_file(opts.iq_file), truth)
+    # Channel of the capture for gfsk_demod.py and ble_dump.py -r
+    with open(hops_file(opts.iq_file), 'w') as hops_fd:
+        writer = csv.writer(hops_fd)
+        writer.writerow(['Start_trame', 'Channel', 'Freq_offset'])
+        writer.writerow([0, opts.channel, opts.freq_offset])
+    print('{:d} packets, {:d} samples ({:.2f}s) written into: {}'.format(
+        len(truth), len(iq_samples), len(iq_samples) / opts.sample_rate, opts.iq_file))
+    print('Generated packets recorded into:', truth_file(opts.iq_file))
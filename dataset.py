@@ -0,0 +1,183 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+#  ble-dump: tagged SigMF dataset built while capturing
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from __future__ import print_function
+
+import os
+import threading
+from collections import deque, namedtuple
+
+import numpy as np
+
+from get_robot_position import HTTPException, RobotPoller
+from proto import IQ_FORMATS, IQ_FORMAT_DEFAULT, iq_from_complex, time_ns
+from sigmf_recording import SigMFStreamWriter, recording_global_info, write_archive
+from tag_iq_data import interpolate_positions, load_robot_positions
+
+DatasetPacket = namedtuple('DatasetPacket', ['start_frame', 'end_frame', 'frequency', 'sample_rate', 'time_ns'])
+
+
+class FilePositions(object):
+    """
+     Robot positions recorded by get_robot_position.py, interpolated at the packet times.
+    """
+
+    def __init__(self, robot_csvfile):
+        self.positions = load_robot_positions(robot_csvfile)
+
+    @property
+    def nodes(self):
+        return sorted(self.positions)
+
+    # (X, Y) of a robot at a time in ns, None if the robot is unknown
+    def position(self, robot_node, timestamp_ns):
+        if robot_node not in self.positions:
+            return None
+        x, y = interpolate_positions(np.array([timestamp_ns], dtype=np.int64), self.positions[robot_node])
+        return int(x[0]), int(y[0])
+
+    def close(self):
+        pass
+
+
+class LivePositions(object):
+    """
+     Robot positions polled from the position server by a background thread.
+     The last 'history' samples of each robot are kept and interpolated at the
+     packet times, node 0 is a static emitter at (0, 0).
+
+            period      --- sampling period (seconds)
+    """
+
+    def __init__(self, poller, robot_nodes, period=0.1, history=1000):
+        self.poller = poller
+        self.nodes = list(robot_nodes)
+        self.period = period
+        self._samples = dict((robot_node, deque(maxlen=history)) for robot_node in self.nodes)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time_ns()
+            try:
+                locations, latency = self.poller.fetch()
+            except (HTTPException, IOError) as err:
+                print("Position request failed: {}".format(err))
+                locations, latency = {}, 0.0
+            # Middle of the request
+            timestamp_ns = started + int(latency * 1e9) // 2
+            with self._lock:
+                for robot_node in self.nodes:
+                    robot = {'x': 0, 'y': 0} if robot_node == 0 else locations.get(robot_node)
+                    if robot is not None and robot.get('x') is not None and robot.get('y') is not None:
+                        self._samples[robot_node].append((timestamp_ns, float(robot['x']), float(robot['y'])))
+            self._stop.wait(max(0, self.period - (time_ns() - started) / 1e9))
+
+    def position(self, robot_node, timestamp_ns):
+        with self._lock:
+            samples = list(self._samples.get(robot_node, ()))
+        if not samples:
+            return None
+        times, x, y = (np.array(values) for values in zip(*samples))
+        x, y = interpolate_positions(np.array([timestamp_ns], dtype=np.int64), (times.astype(np.int64), x, y))
+        return int(x[0]), int(y[0])
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.poller.close()
+
+
+# Position source of the command line options: a robot csv file or the position server
+
+
+def open_positions(robot_csv='', robot_url='', robot_nodes=(5,), period=0.1):
+    if robot_csv:
+        return FilePositions(robot_csv)
+    if robot_url:
+        return LivePositions(RobotPoller(robot_url), robot_nodes, period)
+    return None
+
+
+class LiveDataset(object):
+    """
+     Tagged SigMF archive written while capturing: the IQ samples of each decoded
+     packet are copied from the sample ring (see ring_buffer.SampleRing) to the
+     SigMF data file and annotated with the robot positions at the packet time.
+     This replaces the iq_save.py, tag_iq_data.py and sigmf_recording.py passes.
+
+            archive_name    --- path of the archive without its .sigmf extension
+            positions       --- FilePositions, LivePositions or None (no annotations)
+            fmt             --- IQ format of the SigMF data (proto.IQ_FORMATS)
+    """
+
+    def __init__(self, archive_name, positions=None, robot_nodes=None, fmt=IQ_FORMATS[IQ_FORMAT_DEFAULT]):
+        self.archive_name = archive_name
+        self.positions = positions
+        self.robot_nodes = robot_nodes if robot_nodes is not None else (positions.nodes if positions else [])
+        self.data_file = archive_name + '.sigmf-data'
+        self.meta_file = archive_name + '.sigmf-meta'
+        self.fmt = fmt
+        self.packets = 0
+        self.lost = 0
+        self.offset = 0
+
+        base = os.path.dirname(archive_name)
+        if base and not os.path.exists(base):
+            os.makedirs(base)
+        self._data = open(self.data_file, 'wb')
+        self._meta = SigMFStreamWriter(self.meta_file, recording_global_info(fmt))
+        self._pending = deque()
+
+    # Queue a decoded packet, its samples are copied by process() once received
+    def add_packet(self, start_frame, end_frame, frequency, sample_rate, timestamp_ns):
+        self._pending.append(DatasetPacket(int(start_frame), int(end_frame), int(frequency),
+                                           int(sample_rate), timestamp_ns))
+
+    # Copy the queued packets whose samples are in the sample ring. Packets whose
+    # samples were already overwritten are counted as lost
+    def process(self, sample_ring):
+        while self._pending and self._pending[0].end_frame <= sample_ring.end:
+            packet = self._pending.popleft()
+            samples = sample_ring.read(packet.start_frame, packet.end_frame)
+            if samples is None:
+                self.lost += 1
+                continue
+            self._write(packet, samples)
+
+    def _write(self, packet, samples):
+        self._data.write(iq_from_complex(samples, self.fmt).tobytes())
+        start_frame = self.offset
+        end_frame = start_frame + len(samples)
+        self._meta.add_capture(start_frame, packet.sample_rate, packet.frequency, packet.time_ns)
+        for robot_node in self.robot_nodes:
+            position = self.positions.position(robot_node, packet.time_ns)
+            if position is not None:
+                self._meta.add_annotation(start_frame, end_frame, position[0], position[1], robot_node)
+        self.offset = end_frame
+        self.packets += 1
+
+    # Copy the last packets, build the archive and return its path
+    def close(self, sample_ring):
+        self.process(sample_ring)
+        self.lost += len(self._pending)
+        self._pending.clear()
+        if self.positions:
+            self.positions.close()
+        self._data.close()
+        self._meta.close()
+        archive_path = write_archive(self.archive_name, self.meta_file, self.data_file)
+        os.remove(self.meta_file)
+        os.remove(self.data_file)
+        return archive_path
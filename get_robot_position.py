@@ -1,52 +1,193 @@
 #!/usr/bin/python -u
 
+from __future__ import print_function
+
 import csv
-import urllib2
 from datetime import datetime, timedelta
 from optparse import OptionGroup, OptionParser
+from time import sleep, time
+
+try:
+    from httplib import HTTPConnection, HTTPException
+    from urlparse import urlsplit
+except ImportError:
+    from http.client import HTTPConnection, HTTPException
+    from urllib.parse import urlsplit
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Position server of the w-iLab.2 robots
+ROBOT_LOCATIONS_URL = 'http://robotcontrol.wilab2.ilabt.iminds.be:5056/Robot/LocationsYaml'
+
+ROBOT_CSV_FIELDS = ['Time', 'Robot_node', 'X', 'Y', 'Angle', 'Latency']
+
+
+# Parse scalar YAML values (numbers, else strings)
+
+
+def parse_scalar(value):
+    value = value.strip().strip('\'"')
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
 
-# Get BLE emitter positions
-def get_robot_position(robot_node, robot_csv_file):
+
+# Parse the list of robot locations (YAML list of mappings, keys may be Ruby symbols such as ':id')
+# into {robot id: {key: value}}. PyYAML is used when installed, the flat
+# format of the position server is parsed without it
+
+
+def parse_locations(text):
+    if yaml is not None:
+        robots = yaml.safe_load(text) or []
+    else:
+        robots = []
+        for line in text.splitlines():
+            content = line.strip()
+            if not content or content.startswith('#') or content == '---':
+                continue
+            if content.startswith('-'):
+                robots.append({})
+                content = content[1:].strip()
+                if not content:
+                    continue
+            if robots and ':' in content.lstrip(':'):
+                key, value = content.lstrip(':').split(':', 1)
+                robots[-1][key] = parse_scalar(value)
+
+    locations = {}
+    for robot in robots:
+        robot = dict((str(key).lstrip(':'), value) for key, value in robot.items())
+        if 'id' in robot:
+            locations[int(robot['id'])] = robot
+    return locations
+
+
+class RobotPoller(object):
     """
-     Parameters:
-            robot_node        --- target robot node which will  be tracked
-            robot_csv_file    --- csv file path where robot information will be recorded: #Time,Robot_Number,X,Y,Angle
+     Fetch the robot locations over one persistent (keep-alive) HTTP connection,
+     reconnecting after errors.
+
+            url         --- position server returning the locations of all robots as YAML
+            timeout     --- socket timeout (seconds)
     """
 
-    timestamp = datetime.now()
-    if int(robot_node) == int(0) :
-            location = [0,0,0]
-    else:
-            robot_num = '  '+':id: '+str(robot_node)
-            position = urllib2.urlopen(
-                'http://robotcontrol.wilab2.ilabt.iminds.be:5056/Robot/LocationsYaml')
-            read_position = position.read()
-            extract_information = read_position.split('\n')
-            robot_information_index = extract_information.index(robot_num)
-            location = [extract_information[robot_information_index+1][6:],
-                        extract_information[robot_information_index+2][6:],
-                        extract_information[robot_information_index+6][10:]]
-    
-    with open(robot_csv_file, 'a+') as csvfile:
+    def __init__(self, url=ROBOT_LOCATIONS_URL, timeout=2.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path + ('?' + parts.query if parts.query else '')
+        self.timeout = timeout
+        self.requests = 0
+        self.errors = 0
+        self._connection = None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Locations of all robots, returns ({robot id: {key: value}}, request latency in seconds)
+    def fetch(self):
+        # A kept-alive connection closed by the server is retried once on a new connection
+        reused = self._connection is not None
+        if not reused:
+            self._connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        started = time()
+        try:
+            self._connection.request('GET', self.path, headers={'Connection': 'keep-alive'})
+            response = self._connection.getresponse()
+            body = response.read()
+        except (HTTPException, IOError):
+            self.close()
+            if reused:
+                return self.fetch()
+            self.errors += 1
+            raise
+        latency = time() - started
+        self.requests += 1
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+        if response.status != 200:
+            self.errors += 1
+            raise IOError('position server returned HTTP {:d}'.format(response.status))
+        return parse_locations(body.decode('utf-8')), latency
+
+
+# Poll the positions of 'robot_nodes' every 'period' seconds and record them into 'robot_csv_file',
+# flushed every 'flush_interval' seconds. Node 0 is a static emitter at (0, 0)
+
+
+def record_robot_positions(poller, robot_nodes, robot_csv_file, period=0.1, flush_interval=1.0, count=None):
+    """
+     Parameters:
+            robot_nodes       --- target robot nodes which will be tracked
+            robot_csv_file    --- csv file path where robot information will be recorded: #Time,Robot_node,X,Y,Angle,Latency
+                                  Time is the middle of the request, Latency its duration (seconds)
+    """
+    with open(robot_csv_file, 'w') as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow([timestamp, robot_node, location[0],
-                         location[1], location[2]])
-  
+        writer.writerow(ROBOT_CSV_FIELDS)
+
+        samples = 0
+        started = next_poll = last_flush = time()
+        while count is None or samples < count:
+            # Fixed sampling grid, late polls are skipped instead of piling up
+            delay = next_poll - time()
+            if delay > 0:
+                sleep(delay)
+            next_poll += period * max(1, int((time() - next_poll) / period) + 1)
+
+            timestamp = datetime.now()
+            try:
+                locations, latency = poller.fetch() if any(robot_nodes) else ({}, 0.0)
+            except (HTTPException, IOError) as err:
+                print("Position request failed: {}".format(err))
+                continue
+            timestamp += timedelta(seconds=latency / 2)
+
+            for robot_node in robot_nodes:
+                if robot_node == 0:
+                    location = [0, 0, 0]
+                elif robot_node in locations:
+                    robot = locations[robot_node]
+                    location = [robot.get('x'), robot.get('y'), robot.get('angle')]
+                else:
+                    continue
+                writer.writerow([timestamp, robot_node] + location + ['{:.6f}'.format(latency)])
+            samples += 1
+
+            if time() - last_flush >= flush_interval:
+                csvfile.flush()
+                last_flush = time()
+    return samples, time() - started
+
 
 if __name__ == '__main__':
     parser = OptionParser()
-    parser.add_option("-r", "--robot-node", type="int", default=5,
-                      help="Robot node corresponding to the  BLE emitter [default=%default]")
+    parser.add_option("-r", "--robot-node", type="string", default='5',
+                      help="Robot nodes corresponding to the BLE emitters, comma separated [default=%default]")
     parser.add_option("-o", "--csv-file", type="string", default='',
-                      help="csv file path where will be recorded: #Timestamp,Robot_node,X,Y,Angle")
+                      help="csv file path where will be recorded: #Timestamp,Robot_node,X,Y,Angle,Latency")
+    parser.add_option("-p", "--period", type="float", default=0.1,
+                      help="Sampling period (seconds) [default=%default]")
+    parser.add_option("-u", "--url", type="string", default=ROBOT_LOCATIONS_URL,
+                      help="Position server URL [default=%default]")
+    parser.add_option("-t", "--timeout", type="float", default=2.0,
+                      help="Request timeout (seconds) [default=%default]")
     (opts, _) = parser.parse_args()
-    with open(opts.csv_file, 'w') as csvfile:
-        fieldnames = ['Time', 'Robot_node', 'X', 'Y', 'Angle']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+    robot_nodes = [int(x) for x in opts.robot_node.split(',') if x]
+    poller = RobotPoller(opts.url, opts.timeout)
     try:
-        while True:
-            get_robot_position(opts.robot_node, opts.csv_file)
+        record_robot_positions(poller, robot_nodes, opts.csv_file, opts.period)
     except KeyboardInterrupt:
         print("Finished recording...")
         pass
+    poller.close()
+    print("{:d} requests, {:d} errors".format(poller.requests, poller.errors))
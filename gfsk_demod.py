@@ -0,0 +1,489 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+#  ble-dump: GFSK demodulation and BLE decoding of recorded IQ files without Gnu Radio
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+from __future__ import print_function
+
+import os
+from bisect import bisect_right
+from multiprocessing import Pool, cpu_count
+from optparse import OptionGroup, OptionParser
+from time import time
+
+import numpy as np
+
+from packet_store import PacketStore
+from proto import *
+
+# Samples read per chunk, memory use is a small multiple of it
+CHUNK_SAMPLES = 1 << 20
+
+# Samples decoded by one job of the parallel mode
+SEGMENT_SAMPLES = 1 << 24
+
+# Symbols per block of the symbol timing estimate, see symbol_instants
+TIMING_BLOCK_SYMBOLS = 8
+
+# A block whose power is below this fraction of the power two blocks before or
+# after starts a new burst, and a new symbol timing estimate
+TIMING_SQUELCH = 0.1
+
+
+# Low-pass filter taps, same design as Gnu Radio firdes.low_pass with a Hamming window
+
+
+def low_pass_taps(sample_rate, cutoff_freq, transition_width):
+    ntaps = int(53 * sample_rate / (22.0 * transition_width))
+    if ntaps % 2 == 0:
+        ntaps += 1
+    n = np.arange(ntaps) - (ntaps - 1) // 2
+    window = 0.54 - 0.46 * np.cos(2 * np.pi * np.arange(ntaps) / (ntaps - 1))
+    taps = 2 * cutoff_freq / sample_rate * np.sinc(2 * cutoff_freq / sample_rate * n) * window
+    return (taps / taps.sum()).astype(np.float32)
+
+
+class GfskDemodulator(object):
+    """
+     Vectorized GFSK demodulator: frequency translation folded into band-pass
+     filter taps, and a differential detector over one symbol period (the
+     quadrature demodulator followed by the symbol matched filter). The symbol
+     timing is estimated by BleDecoder, see symbol_instants.
+
+            sample_rate         --- IQ sample rate
+            freq_offset         --- the BLE channel is 'freq_offset' Hz below the capture center
+            offsets             --- (start sample, freq_offset) tuples of a capture retuned digitally,
+                                    see proto.read_hop_offsets, instead of 'freq_offset'
+    """
+
+    def __init__(self, sample_rate, data_rate=1e6, freq_offset=1e6, cutoff_freq=850e3, transition_width=300e3,
+                 offsets=None):
+        self.sample_rate = sample_rate
+        self.sps = int(sample_rate / data_rate)
+        self.freq_offset = freq_offset
+        self.offsets = [(int(round(start)), offset) for start, offset in offsets or []]
+        self.offset_starts = [start for start, _ in self.offsets]
+        self.taps = low_pass_taps(sample_rate, cutoff_freq, transition_width)
+
+        # Samples needed before/after the demodulated range, centered on the filter and detector delays
+        span = len(self.taps) - 1 + self.sps
+        self.history = (span + 1) // 2
+        self.lookahead = span - self.history
+
+        self._band_pass = {}
+
+    # (start, stop, freq_offset) spans of samples [first, last) with the same frequency offset
+    def offset_spans(self, first, last):
+        if not self.offsets:
+            return [(first, last, self.freq_offset)]
+        spans = []
+        index = max(0, bisect_right(self.offset_starts, first) - 1)
+        while first < last:
+            stop = last if index + 1 >= len(self.offsets) else min(last, max(first, self.offset_starts[index + 1]))
+            if stop > first:
+                spans.append((first, stop, self.offsets[index][1]))
+            first = stop
+            index += 1
+        return spans
+
+    # Low-pass taps shifted to 'freq_offset', and the phase turn of that frequency over one symbol.
+    # Mixing then filtering equals filtering with the shifted taps, up to a phase that turns
+    # by a constant step per sample, which the differential detector removes
+    def band_pass(self, freq_offset):
+        if freq_offset not in self._band_pass:
+            step = 2 * np.pi * freq_offset / self.sample_rate
+            taps = (self.taps * np.exp(-1j * step * np.arange(len(self.taps)))).astype(np.complex64)
+            turn = np.exp(1j * step * self.sps)
+            self._band_pass[freq_offset] = taps, np.float32(turn.real), np.float32(turn.imag)
+        return self._band_pass[freq_offset]
+
+    # Demodulate 'samples' covering [first - history, first + n + lookahead) into n soft values
+    # for samples [first, first + n): the imaginary part of the filtered signal times its conjugate
+    # one symbol earlier, positive for a '1' bit and weighted by the signal power
+    def demodulate(self, samples, first):
+        sps = self.sps
+        count = len(samples) - len(self.taps) + 1 - sps
+        soft = np.empty(max(count, 0), dtype=np.float32)
+        # Filter outputs belong to the frequency offset of their first sample
+        for start, stop, freq_offset in self.offset_spans(first - self.history, first - self.history + count):
+            taps, turn_re, turn_im = self.band_pass(freq_offset)
+            lo = start - first + self.history
+            hi = stop - first + self.history
+            filtered = np.convolve(samples[lo:hi + sps + len(taps) - 1], taps, 'valid')
+            product = filtered[sps:] * np.conj(filtered[:-sps])
+            soft[lo:hi] = turn_im * product.real + turn_re * product.imag
+        return soft
+
+
+# Sampling instant (index into 'soft') of every symbol period of the soft values of GfskDemodulator,
+# 'first' being the sample index of soft[0], a multiple of sps. The timing phase is the feedforward
+# (Oerder-Meyr) estimate from the symbol rate line of soft ** 2, accumulated from the start of each
+# burst: the values are weighted by the signal power, the preamble leads the estimate and the noise
+# before a burst barely counts. The phase is unwrapped within a burst, so that no symbol is slipped
+# or repeated, and wrapped to the symbol period before it. The blocks are aligned on the symbol
+# periods of the capture, the instants do not depend on how the samples are chunked
+
+
+def symbol_instants(soft, sps, first=0, block=TIMING_BLOCK_SYMBOLS, squelch=TIMING_SQUELCH):
+    n = len(soft) // sps
+    if not n:
+        return np.zeros(0, dtype=np.intp)
+    lead = first // sps % block
+    blocks = (lead + n + block - 1) // block
+    power = np.zeros(blocks * block * sps, dtype=np.float32)
+    power[lead * sps:(lead + n) * sps] = soft[:n * sps]
+    power *= power
+
+    # Symbol rate line and power of each block
+    angle = 2 * np.pi * np.arange(sps) / sps
+    basis = np.array([np.cos(angle), -np.sin(angle), np.ones(sps)], dtype=np.float32).T
+    sums = power.reshape(-1, sps).dot(basis).reshape(blocks, block, 3).sum(axis=1).astype(np.float64)
+    line = sums[:, 0] + 1j * sums[:, 1]
+    level = sums[:, 2] + np.r_[0, sums[:-1, 2]] + np.r_[sums[1:, 2], 0]
+
+    # Bursts start after a block much weaker than the blocks around it
+    around = np.maximum(np.r_[level[2:], level[-1:], level[-1:]], np.r_[level[:1], level[:1], level[:-2]])
+    quiet = level < squelch * around
+    quiet[0] = True
+    index = np.arange(blocks)
+    burst = np.maximum.accumulate(np.where(quiet, index, 0))
+
+    # Estimate over the burst so far and the next block
+    total = np.r_[0, np.cumsum(line)]
+    estimate = total[np.minimum(index + 2, blocks)] - total[burst]
+    phase = -np.unwrap(np.angle(estimate)) * (sps / (2 * np.pi))
+    wrapped = phase % sps
+    offset = np.rint(phase - phase[burst] + wrapped[burst]).astype(np.intp)
+
+    instants = np.arange(n) * sps + np.repeat(offset, block)[lead:lead + n]
+    return np.clip(instants, 0, len(soft) - 1)
+
+
+class BleDecoder(object):
+    """
+     Find and decode BLE packets in the soft output of GfskDemodulator. The soft
+     values are sliced once per symbol at the instants of symbol_instants, and the
+     bits are correlated with the preamble and access addresses.
+
+            hops        --- (start sample, BLE channel) tuples, see proto.read_hops
+    """
+
+    def __init__(self, sps, hops, access_addresses=(BLE_ACCESS_ADDR,), max_bit_errors=1,
+                 dewhiten=True, check_crc=True, crc_init=BLE_CRC_INIT):
+        self.sps = sps
+        self.hops = hops
+        self.hop_starts = [start for start, _ in hops]
+        self.access_addresses = access_addresses
+        self.max_bit_errors = max_bit_errors
+        self.dewhiten = dewhiten
+        self.check_crc = check_crc
+        self.crc_init = crc_init
+        self.reset()
+
+    # Forget the decoding state. Only packets starting in samples [start, stop)
+    # are counted and returned, the others are still parsed to skip overlapping detections
+    def reset(self, start=0, stop=None):
+        self.stat = dict((name, 0) for name in ['sync', 'ok', 'err_crc', 'err_len', 'err_pdu', 'err_llid'])
+        self.window_start = start
+        self.window_stop = stop
+
+        # Soft values not searched yet (one maximum packet length) after up to one maximum packet
+        # length of timing history, sample index of the first one and index of the first unsearched one
+        self._tail = np.zeros(0, dtype=np.float32)
+        self._tail_first = 0
+        self._tail_begin = 0
+        self._last_end = -1
+
+    # Feed soft values of samples [first, first + len(soft)), first being a multiple of sps.
+    # Yields (start sample, end sample, channel, packet) tuples, packets starting in the
+    # last maximum packet length are decoded on the next call (or by flush)
+    def feed(self, soft, first):
+        if len(self._tail):
+            soft = np.concatenate((self._tail, soft))
+            first = self._tail_first
+        limit = max(0, len(soft) - BLE_MAX_PACKET_BITS * self.sps) // self.sps * self.sps
+
+        for packet in self._decode(soft, first, self._tail_begin, limit):
+            yield packet
+
+        keep = max(0, limit - BLE_MAX_PACKET_BITS * self.sps)
+        self._tail = soft[keep:]
+        self._tail_first = first + keep
+        self._tail_begin = limit - keep
+
+    # Decode packets starting in the remaining tail
+    def flush(self):
+        for packet in self._decode(self._tail, self._tail_first, self._tail_begin, len(self._tail)):
+            yield packet
+        self._tail = np.zeros(0, dtype=np.float32)
+        self._tail_begin = 0
+
+    # Decode packets whose symbol period starts in soft values [begin, limit)
+    def _decode(self, soft, first, begin, limit):
+        instants = symbol_instants(soft, self.sps, first)
+        bits = (soft[instants] > 0).astype(np.uint8)
+        begin = (begin + self.sps - 1) // self.sps
+        stop = (limit + self.sps - 1) // self.sps
+        candidates = sorted((int(pos), access_address) for access_address in self.access_addresses
+                            for pos in find_access_address(bits, access_address, self.max_bit_errors, stop)
+                            if pos >= begin)
+
+        n = 0
+        while n < len(candidates):
+            # Detections of the same packet with several access addresses
+            group = [candidates[n]]
+            n += 1
+            while n < len(candidates) and candidates[n][0] == group[0][0]:
+                group.append(candidates[n])
+                n += 1
+
+            pos = group[0][0]
+            start = first + int(instants[pos])
+            if self.window_stop is not None and start >= self.window_stop:
+                break
+            if start < self._last_end:
+                continue
+            counted = start >= self.window_start
+            if counted:
+                self.stat['sync'] += 1
+
+            channel = hop_channel(self.hops, self.hop_starts, start)
+            status = None
+            for _, access_address in group:
+                result, packet = parse_packet(bits, pos, channel, self.dewhiten,
+                                              self.check_crc, self.crc_init, access_address=access_address)
+                if status is None or result == 'ok':
+                    status = result
+                if result == 'ok':
+                    end = start + packet_bits(packet) * self.sps
+                    self._last_end = end
+                    break
+            if counted:
+                self.stat[status] += 1
+                if status == 'ok':
+                    yield start, end, channel, packet
+
+
+# Map an IQ file (cf32, sc16 or sc8, see proto.IQ_FORMATS) without loading it
+
+
+def open_iq(iq_file, fmt=None):
+    return map_iq(iq_file, fmt)
+
+
+# Read samples [start, stop) of an IQ mapping as complex64, zero padded outside of the file
+
+
+def read_samples(iq_data, start, stop, fmt=IQ_FORMATS[IQ_FORMAT_DEFAULT]):
+    samples = np.zeros(stop - start, dtype=np.complex64)
+    lo = max(start, 0)
+    hi = min(stop, len(iq_data))
+    if hi > lo:
+        samples[lo - start:hi - start] = iq_to_complex(iq_data[lo:hi], fmt)
+    return samples
+
+
+# Demodulate and decode samples [start, stop) of an IQ file
+# Yields (start sample, end sample, channel, packet) tuples, in sample order
+
+
+def decode_iq(iq_data, demod, decoder, start=0, stop=None, chunk_samples=CHUNK_SAMPLES,
+              fmt=IQ_FORMATS[IQ_FORMAT_DEFAULT]):
+    sps = demod.sps
+    stop = len(iq_data) if stop is None else min(stop, len(iq_data))
+    chunk_samples = max(sps, chunk_samples // sps * sps)
+    first = start // sps * sps
+    while first < stop:
+        last = min(first + chunk_samples, stop)
+        last = first + (last - first + sps - 1) // sps * sps
+        samples = read_samples(iq_data, first - demod.history, last + demod.lookahead, fmt)
+        for packet in decoder.feed(demod.demodulate(samples, first), first):
+            yield packet
+        first = last
+    for packet in decoder.flush():
+        yield packet
+
+
+# Samples around a segment decoded by the parallel mode, so that every packet
+# starting in the segment is complete and overlapping detections are skipped the same way
+
+
+def segment_overlap(sps):
+    return (BLE_MAX_PACKET_BITS + 1) * sps
+
+
+# Demodulator, decoder and IQ mapping of a parallel mode worker process
+_worker = {}
+
+
+def _init_worker(opts):
+    _worker['demod'], _worker['decoder'] = make_decoder(opts)
+    _worker['iq_data'] = open_iq(opts.iq_file, opts.iq_format)
+    _worker['chunk_samples'] = opts.chunk_samples
+    _worker['iq_format'] = opts.iq_format
+
+
+# Decode the packets starting in samples [start, stop), run in a worker process
+
+
+def _decode_segment(segment):
+    start, stop = segment
+    demod, decoder = _worker['demod'], _worker['decoder']
+    overlap = segment_overlap(demod.sps)
+    decoder.reset(start, stop)
+    packets = list(decode_iq(_worker['iq_data'], demod, decoder, max(0, start - overlap), stop + overlap,
+                             _worker['chunk_samples'], _worker['iq_format']))
+    return packets, decoder.stat
+
+
+# Decode an IQ file with 'jobs' processes, each one mapping the file and decoding
+# segments of 'segment_samples'. Yields the same tuples as decode_iq, in sample order,
+# and sums the decoding statistics into 'stat'
+
+
+def decode_iq_parallel(opts, sps, iq_samples, stat, jobs, segment_samples=SEGMENT_SAMPLES):
+    segment_samples = max(sps, segment_samples // sps * sps)
+    segments = [(start, min(start + segment_samples, iq_samples))
+                for start in range(0, iq_samples, segment_samples)]
+    pool = Pool(jobs, _init_worker, (opts,))
+    try:
+        last_end = -1
+        for packets, segment_stat in pool.imap(_decode_segment, segments):
+            for name, value in segment_stat.items():
+                stat[name] += value
+            for packet in packets:
+                # Already returned with the previous segment
+                if packet[0] < last_end:
+                    continue
+                last_end = packet[1]
+                yield packet
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Write decoded packets to a PcapWriter, a PacketIndexWriter and a PacketStore (if any), the
+# same way as ble_dump. 'start_ns' is the capture time of sample 0 in nanoseconds
+
+
+def write_packets(packets, pcap, packet_index, sample_rate, start_ns, store=None):
+    count = 0
+    for start_frame, end_frame, channel, packet in packets:
+        timestamp_ns = sample_time_ns(start_ns, start_frame, sample_rate)
+        pcap.write(channel, packet.access_address, packet.data, timestamp_ns,
+                   'IQ samples {:d}-{:d}'.format(start_frame, end_frame), packet.aa_errors)
+        packet_index.write(start_frame, end_frame, int(ble_channel_freq(channel)), int(sample_rate),
+                           timestamp_ns, channel, adv_address(packet))
+        if store:
+            store.write(packet, channel, start_frame, end_frame, int(ble_channel_freq(channel)), timestamp_ns)
+        count += 1
+    return count
+
+
+# Build demodulator and decoder from command line options
+
+
+def make_decoder(opts):
+    demod = GfskDemodulator(opts.sample_rate, freq_offset=opts.freq_offset,
+                            cutoff_freq=opts.cutoff_freq, transition_width=opts.transition_width,
+                            offsets=read_hop_offsets(opts.iq_file))
+    hops = read_hops(opts.iq_file) or [(0, opts.channel)]
+    decoder = BleDecoder(demod.sps, hops, opts.access_addresses, opts.max_bit_errors,
+                         not opts.disable_dewhitening, not opts.disable_crc, opts.crc_init)
+    return demod, decoder
+
+
+def init_opts():
+    parser = OptionParser(usage="%prog: [opts]")
+    parser.add_option("-i", "--iq-file", type="string", default='',
+                      help="IQ file recorded by ble_dump.py")
+    parser.add_option("-F", "--iq-format", type="choice", choices=sorted(IQ_FORMATS), default=None,
+                      help="IQ file format: cf32, sc16 or sc8 [default=from the file extension, else cf32]")
+    parser.add_option("-o", "--pcap_file", type="string", default='',
+                      help="PCAP output file")
+    parser.add_option("-g", "--pcapng", action="store_true", default=False,
+                      help="Write PCAPNG with nanosecond timestamps and the IQ sample index of each packet [default=%default]")
+    parser.add_option("-p", "--packetcsv-file", type="string", default='',
+                      help="csv file path where are recorded: #time,start_frame,end_frame,frequency,sample_rate [default=<iq-file>-decoded.csv]")
+    parser.add_option("-b", "--binary-index", action="store_true", default=False,
+                      help="Record the packet index as fixed-width binary records [default=<iq-file>-decoded.idx]")
+    parser.add_option("-d", "--store", type="string", default='',
+                      help="Also record the packets into this SQLite packet store, queried by ble_query.py")
+    parser.add_option("-s", "--sample-rate", type="float", default=5e6,
+                      help="Sample rate [default=%default]")
+    parser.add_option("-f", "--freq-offset", type="float", default=1e6,
+                      help="Offset of the capture center above the BLE channel, unless the hop file "
+                      "records it [default=%default]")
+    parser.add_option("-C", "--cutoff_freq", type="float", default=850e3,
+                      help="Filter cutoff [default=%default]")
+    parser.add_option("-T", "--transition_width", type="float", default=300e3,
+                      help="Filter transition width [default=%default]")
+    parser.add_option("-n", "--chunk-samples", type="int", default=CHUNK_SAMPLES,
+                      help="Samples demodulated at once [default=%default]")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="Decoding processes, 0 for one per CPU [default=%default]")
+    parser.add_option("-S", "--segment-samples", type="int", default=SEGMENT_SAMPLES,
+                      help="Samples decoded by one job with --jobs [default=%default]")
+
+    ble = OptionGroup(parser, 'Bluetooth LE:')
+    ble.add_option("-c", "--channel", type="int", default=37,
+                   help="BLE channel when the capture has no hop information [default=%default]")
+    ble.add_option("-a", "--access_addresses", type="string", default='0x8e89bed6',
+                   help="Access addresses to detect (comma separated) [default=%default]")
+    ble.add_option("-e", "--max_bit_errors", type="int", default=1,
+                   help="Bit errors allowed in preamble and access address [default=%default]")
+    ble.add_option("-k", "--crc_init", type="int", default=BLE_CRC_INIT,
+                   help="CRC init value of data channel packets [default=0x555555]")
+    ble.add_option("-x", "--disable_crc", action="store_true",
+                   default=False, help="Disable CRC verification [default=%default]")
+    ble.add_option("-y", "--disable_dewhitening", action="store_true",
+                   default=False, help="Disable De-Whitening [default=%default]")
+    parser.add_option_group(ble)
+
+    (opts, args) = parser.parse_args()
+    opts.access_addresses = [int(x, 0) for x in opts.access_addresses.split(',')]
+    opts.iq_format = iq_format(opts.iq_file, opts.iq_format)
+    if not opts.packetcsv_file:
+        opts.packetcsv_file = opts.iq_file.split('.')[0] + ('-decoded.idx' if opts.binary_index else '-decoded.csv')
+    if opts.jobs < 1:
+        opts.jobs = cpu_count()
+    return opts, args
+
+
+if __name__ == '__main__':
+    (opts, _) = init_opts()
+    if not opts.iq_file or not opts.pcap_file:
+        print('\nerror: please specify IQ input file (-i) and pcap output file (-o)')
+        exit(1)
+
+    demod, decoder = make_decoder(opts)
+    iq_data = open_iq(opts.iq_file, opts.iq_format)
+    packet_index = PacketIndexWriter(opts.packetcsv_file, opts.binary_index)
+    pcap = PcapWriter(opts.pcap_file, opts.pcapng)
+
+    started = time()
+    if opts.jobs > 1:
+        packets = decode_iq_parallel(opts, demod.sps, len(iq_data), decoder.stat, opts.jobs, opts.segment_samples)
+    else:
+        packets = decode_iq(iq_data, demod, decoder, chunk_samples=opts.chunk_samples, fmt=opts.iq_format)
+    start_ns = int(capture_start(opts.iq_file, opts.sample_rate, opts.iq_format) * 1e6) * 1000
+    store = None
+    if opts.store:
+        store = PacketStore(opts.store)
+        store.add_capture(os.path.abspath(opts.iq_file), opts.iq_format.name, opts.sample_rate, start_ns)
+    count = write_packets(packets, pcap, packet_index, opts.sample_rate, start_ns, store)
+    pcap.close()
+    packet_index.close()
+    if store:
+        store.close()
+    elapsed = time() - started
+
+    print('Decoded {:d} packets from {:d} samples in {:.2f}s with {:d} jobs ({:.0f} samples/s, {:.1f}x real time)'.format(
+        count, len(iq_data), elapsed, opts.jobs, len(iq_data) / elapsed, len(iq_data) / opts.sample_rate / elapsed))
+    print(', '.join('{}:{}'.format(name, value) for name, value in sorted(decoder.stat.items())))
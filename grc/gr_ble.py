@@ -5,6 +5,7 @@
 # Title: Bluetooth LE Receiver
 # Author: Jan Wagner
 # Generated: Fri Jan 17 17:44:20 2020
+# Maintained by hand since, this file is the source of truth of the flow graph
 ##################################################
 
 from gnuradio import analog
@@ -16,83 +17,169 @@ from gnuradio import gr
 from gnuradio import uhd
 from gnuradio.eng_option import eng_option
 from gnuradio.filter import firdes
+try:
+    from .gr_iq_file import iq_file_sink, iq_file_source
+    from .gr_stream_tags import sample_tagger, tagged_gmsk_demod, tagged_message_sink
+except (ValueError, ImportError):
+    # Run as a script
+    from gr_iq_file import iq_file_sink, iq_file_source
+    from gr_stream_tags import sample_tagger, tagged_gmsk_demod, tagged_message_sink
 from optparse import OptionParser
 import time
 
+# Retune modes: 'lo' moves the USRP LO on every channel change, 'digital' only moves the
+# frequency translating filter while the channel is inside the captured band
+RETUNE_MODES = ('lo', 'digital')
+
 
 class gr_ble(gr.top_block):
 
-    def __init__(self):
+    # Default values of the variables, readable before the flowgraph is built
+    transition_width = 300e3
+    sample_rate = 5e6
+    data_rate = 1e6
+    duration_seconds = 10
+    cutoff_freq = 850e3
+    ble_channel_spacing = 2e6
+    ble_channel = 12
+    ble_base_freq = 2402e6
+    squelch_threshold = -70
+    rf_gain = 30
+    iq_output = "/dev/null"
+    gmsk_sps = int(sample_rate / data_rate)
+    gmsk_omega_limit = 0.035
+    gmsk_mu = 0.5
+    gmsk_gain_mu = 0.7
+    freq_offset = 1e6
+    queue_depth = 2
+    iq_queue_depth = 16
+    tag_period = 1024
+    retune = 'lo'
+    # Timed LO retunes are issued this far ahead of the USRP time (seconds)
+    retune_lead = 2e-3
+    lo_lock_timeout = 0.05
+
+    def __init__(self, iq_input='', throttle=False, iq_tap=False, iq_file_sink=True, iq_format='cf32',
+                 queue_depth=None, retune=None):
         gr.top_block.__init__(self, "Bluetooth LE Receiver")
 
+        ##################################################
+        # Parameters
+        ##################################################
+        self.iq_input = iq_input
+        self.throttle = throttle
+        # Also send the IQ samples to iq_queue (blocking, sample indexes stay exact)
+        self.iq_tap = iq_tap
+        # Write every captured sample to iq_output (off when the IQ data is recorded from the tap)
+        self.iq_file_sink = iq_file_sink
+        # Format of the IQ files: cf32, sc16 or sc8
+        self.iq_format = iq_format
+        # Messages of demodulated bits held by message_queue
+        self.queue_depth = gr_ble.queue_depth if queue_depth is None else queue_depth
+        # Channel changes: USRP LO retune or digital retune (see RETUNE_MODES)
+        self.retune = gr_ble.retune if retune is None else retune
+        # Mode, host latency (seconds) and samples lost of the last retune
+        self.last_retune = None
+        # Where the last retune takes effect: IQ sample index, or USRP time (ns) of a timed command
+        self.retune_sample = 0
+        self.retune_time_ns = None
+
         ##################################################
         # Variables
         ##################################################
-        self.transition_width = transition_width = 300e3
-        self.sample_rate = sample_rate = 5e6
-        self.data_rate = data_rate = 1e6
-        self.duration_seconds = duration_seconds = 10
-        self.cutoff_freq = cutoff_freq = 850e3
-        self.ble_channel_spacing = ble_channel_spacing = 2e6
-        self.ble_channel = ble_channel = 12
-        self.ble_base_freq = ble_base_freq = 2402e6
-        self.squelch_threshold = squelch_threshold = -70
-        self.rf_gain = rf_gain = 30
+        self.transition_width = transition_width = gr_ble.transition_width
+        self.sample_rate = sample_rate = gr_ble.sample_rate
+        self.data_rate = data_rate = gr_ble.data_rate
+        self.duration_seconds = duration_seconds = gr_ble.duration_seconds
+        self.cutoff_freq = cutoff_freq = gr_ble.cutoff_freq
+        self.ble_channel_spacing = ble_channel_spacing = gr_ble.ble_channel_spacing
+        self.ble_channel = ble_channel = gr_ble.ble_channel
+        self.ble_base_freq = ble_base_freq = gr_ble.ble_base_freq
+        self.squelch_threshold = squelch_threshold = gr_ble.squelch_threshold
+        self.rf_gain = rf_gain = gr_ble.rf_gain
         self.num_samples = num_samples = duration_seconds*sample_rate
         self.lowpass_filter = lowpass_filter = firdes.low_pass(1, sample_rate, cutoff_freq, transition_width, firdes.WIN_HAMMING, 6.76)
-        self.iq_output = iq_output = "/dev/null"
+        self.iq_output = iq_output = gr_ble.iq_output
         self.gmsk_sps = gmsk_sps = int(sample_rate / data_rate)
-        self.gmsk_omega_limit = gmsk_omega_limit = 0.035
-        self.gmsk_mu = gmsk_mu = 0.5
-        self.gmsk_gain_mu = gmsk_gain_mu = 0.7
-        self.freq_offset = freq_offset = 1e6
+        self.gmsk_omega_limit = gmsk_omega_limit = gr_ble.gmsk_omega_limit
+        self.gmsk_mu = gmsk_mu = gr_ble.gmsk_mu
+        self.gmsk_gain_mu = gmsk_gain_mu = gr_ble.gmsk_gain_mu
+        self.freq_offset = freq_offset = gr_ble.freq_offset
         self.freq = freq = ble_base_freq+(ble_channel_spacing * ble_channel)
+        self.lo_freq = lo_freq = freq+freq_offset
 
         ##################################################
         # Message Queues
         ##################################################
-        self.message_queue = message_queue = gr.msg_queue(2)
+        self.message_queue = message_queue = gr.msg_queue(self.queue_depth)
+        self.iq_queue = gr.msg_queue(gr_ble.iq_queue_depth) if iq_tap else None
 
         ##################################################
         # Blocks
         ##################################################
-        self.unpacked_to_packed = blocks.unpacked_to_packed_bb(1, gr.GR_LSB_FIRST)
-        self.uhd_usrp_source_0 = uhd.usrp_source(
-        	",".join(("", "")),
-        	uhd.stream_args(
-        		cpu_format="fc32",
-        		channels=range(1),
-        	),
-        )
-        self.uhd_usrp_source_0.set_samp_rate(sample_rate)
-        self.uhd_usrp_source_0.set_center_freq(freq+freq_offset, 0)
-        self.uhd_usrp_source_0.set_gain(rf_gain, 0)
-        self.uhd_usrp_source_0.set_antenna('J2', 0)
-        self.message_sink = blocks.message_sink(gr.sizeof_char*1, self.message_queue, True)
+        if self.iq_input:
+            # Replay mode: recorded IQ data instead of the USRP, nothing is written back
+            self.uhd_usrp_source_0 = None
+            self.blocks_file_source_0 = iq_file_source(iq_input, iq_format)
+            self.blocks_throttle_0 = blocks.throttle(gr.sizeof_gr_complex*1, sample_rate, True)
+        else:
+            self.uhd_usrp_source_0 = uhd.usrp_source(
+            	",".join(("", "")),
+            	uhd.stream_args(
+            		cpu_format="fc32",
+            		channels=range(1),
+            	),
+            )
+            self.uhd_usrp_source_0.set_samp_rate(sample_rate)
+            self.uhd_usrp_source_0.set_center_freq(lo_freq, 0)
+            self.uhd_usrp_source_0.set_gain(rf_gain, 0)
+            self.uhd_usrp_source_0.set_antenna('J2', 0)
+            # rx_time tags in host time, counted by the USRP clock from there
+            self.uhd_usrp_source_0.set_time_now(uhd.time_spec(time.time()), uhd.ALL_MBOARDS)
+        # Sample index tags, carried with rx_time to the demodulated bits
+        self.sample_tagger_0 = sample_tagger(gr_ble.tag_period)
+        # Blocking: the queue is drained by a reader thread, no bits are dropped here
+        self.message_sink = tagged_message_sink(self.message_queue)
         self.freq_xlating_fir_filter_lp = filter.freq_xlating_fir_filter_ccc(1, (lowpass_filter), -freq_offset, sample_rate)
-        self.digital_gmsk_demod_0 = digital.gmsk_demod(
+        self.digital_gmsk_demod_0 = tagged_gmsk_demod(
         	samples_per_symbol=gmsk_sps,
         	gain_mu=gmsk_gain_mu,
         	mu=gmsk_mu,
         	omega_relative_limit=gmsk_omega_limit,
-        	freq_error=0.0,
-        	verbose=False,
-        	log=False,
         )
-	self.blocks_head_0 = blocks.head(gr.sizeof_gr_complex*1, int(num_samples))
-        self.blocks_file_sink_0 = blocks.file_sink(gr.sizeof_gr_complex*1, iq_output, False)
-        self.blocks_file_sink_0.set_unbuffered(False)
+        self.blocks_head_0 = blocks.head(gr.sizeof_gr_complex*1, int(num_samples))
+        if self.iq_input or not self.iq_file_sink:
+            self.blocks_file_sink_0 = None
+        else:
+            self.blocks_file_sink_0 = iq_file_sink(iq_output, iq_format)
         self.analog_simple_squelch = analog.simple_squelch_cc(squelch_threshold, 0.1)
+        if self.iq_tap:
+            self.blocks_message_sink_iq = blocks.message_sink(gr.sizeof_gr_complex*1, self.iq_queue, False)
         ##################################################
         # Connections
         ##################################################
+        self.connect((self.sample_tagger_0, 0), (self.analog_simple_squelch, 0))
         self.connect((self.analog_simple_squelch, 0), (self.freq_xlating_fir_filter_lp, 0))    
-        self.connect((self.digital_gmsk_demod_0, 0), (self.unpacked_to_packed, 0))    
+        self.connect((self.digital_gmsk_demod_0, 0), (self.message_sink, 0))    
         self.connect((self.freq_xlating_fir_filter_lp, 0), (self.digital_gmsk_demod_0, 0))    
-        self.connect((self.blocks_head_0, 0), (self.analog_simple_squelch, 0))    
-        self.connect((self.blocks_head_0, 0), (self.blocks_file_sink_0, 0))
-	self.connect((self.uhd_usrp_source_0, 0), (self.blocks_head_0, 0))
-        self.connect((self.unpacked_to_packed, 0), (self.message_sink, 0))    
+        if self.iq_input:
+            if self.throttle:
+                self.connect((self.blocks_file_source_0, 0), (self.blocks_throttle_0, 0))
+                self.connect((self.blocks_throttle_0, 0), (self.sample_tagger_0, 0))
+            else:
+                self.connect((self.blocks_file_source_0, 0), (self.sample_tagger_0, 0))
+        else:
+            self.connect((self.blocks_head_0, 0), (self.sample_tagger_0, 0))
+            if self.blocks_file_sink_0:
+                self.connect((self.blocks_head_0, 0), (self.blocks_file_sink_0, 0))
+            self.connect((self.uhd_usrp_source_0, 0), (self.blocks_head_0, 0))
+        if self.iq_tap:
+            if not self.iq_input:
+                self.connect((self.blocks_head_0, 0), (self.blocks_message_sink_iq, 0))
+            elif self.throttle:
+                self.connect((self.blocks_throttle_0, 0), (self.blocks_message_sink_iq, 0))
+            else:
+                self.connect((self.blocks_file_source_0, 0), (self.blocks_message_sink_iq, 0))
 
     def get_transition_width(self):
         return self.transition_width
@@ -106,10 +193,13 @@ class gr_ble(gr.top_block):
 
     def set_sample_rate(self, sample_rate):
         self.sample_rate = sample_rate
-	self.set_gmsk_sps(int(self.sample_rate / self.data_rate))
+        self.set_gmsk_sps(int(self.sample_rate / self.data_rate))
         self.set_lowpass_filter(firdes.low_pass(1, self.sample_rate, self.cutoff_freq, self.transition_width, firdes.WIN_HAMMING, 6.76))
-	self.set_num_samples(self.duration_seconds*self.sample_rate)
-        self.uhd_usrp_source_0.set_samp_rate(self.sample_rate)
+        self.set_num_samples(self.duration_seconds*self.sample_rate)
+        if self.uhd_usrp_source_0:
+            self.uhd_usrp_source_0.set_samp_rate(self.sample_rate)
+        else:
+            self.blocks_throttle_0.set_sample_rate(self.sample_rate)
 
     def get_duration_seconds(self):
         return self.duration_seconds
@@ -165,7 +255,8 @@ class gr_ble(gr.top_block):
 
     def set_rf_gain(self, rf_gain):
         self.rf_gain = rf_gain
-        self.uhd_usrp_source_0.set_gain(self.rf_gain, 0)
+        if self.uhd_usrp_source_0:
+            self.uhd_usrp_source_0.set_gain(self.rf_gain, 0)
 
     def get_num_samples(self):
         return self.num_samples
@@ -181,12 +272,17 @@ class gr_ble(gr.top_block):
         self.lowpass_filter = lowpass_filter
         self.freq_xlating_fir_filter_lp.set_taps((self.lowpass_filter))
 
+    # Delay (samples) of the low pass filter between the tagged samples and the demodulator
+    def get_sample_delay(self):
+        return (len(self.lowpass_filter) - 1) // 2
+
     def get_iq_output(self):
         return self.iq_output
 
     def set_iq_output(self, iq_output):
         self.iq_output = iq_output
-        self.blocks_file_sink_0.open(self.iq_output)
+        if self.blocks_file_sink_0:
+            self.blocks_file_sink_0.open(self.iq_output)
 
     def get_gmsk_sps(self):
         return self.gmsk_sps
@@ -217,7 +313,7 @@ class gr_ble(gr.top_block):
 
     def set_freq_offset(self, freq_offset):
         self.freq_offset = freq_offset
-        self.uhd_usrp_source_0.set_center_freq(self.freq+self.freq_offset, 0)
+        self.set_lo_freq(self.freq+self.freq_offset)
         self.freq_xlating_fir_filter_lp.set_center_freq(-self.freq_offset)
 
     def get_freq(self):
@@ -225,7 +321,68 @@ class gr_ble(gr.top_block):
 
     def set_freq(self, freq):
         self.freq = freq
-        self.uhd_usrp_source_0.set_center_freq(self.freq+self.freq_offset, 0)
+        started = time.time()
+        # The filter moves to the new frequency on its next input sample
+        self.retune_sample = self.freq_xlating_fir_filter_lp.nitems_read(0)
+        self.retune_time_ns = None
+        if self.retune == 'digital' and self.in_band(self.freq):
+            # Same front-end, only the filter transient is lost
+            self.freq_xlating_fir_filter_lp.set_center_freq(self.freq-self.lo_freq)
+            self.last_retune = ('digital', time.time() - started, len(self.lowpass_filter) - 1)
+        else:
+            lost = self.set_lo_freq(self.freq+self.freq_offset)
+            self.freq_xlating_fir_filter_lp.set_center_freq(-self.freq_offset)
+            self.last_retune = ('lo', time.time() - started, lost + len(self.lowpass_filter) - 1)
+
+    def get_lo_freq(self):
+        return self.lo_freq
+
+    # Retune the USRP LO with a timed command, returns the samples lost until the LO is locked
+    def set_lo_freq(self, lo_freq):
+        self.lo_freq = lo_freq
+        if not self.uhd_usrp_source_0:
+            return 0
+        usrp = self.uhd_usrp_source_0
+        command_spec = usrp.get_time_now() + uhd.time_spec(self.retune_lead)
+        usrp.set_command_time(command_spec)
+        usrp.set_center_freq(self.lo_freq, 0)
+        usrp.clear_command_time()
+        command_time = command_spec.get_real_secs()
+        self.retune_time_ns = command_spec.get_full_secs() * 1000000000 + int(round(command_spec.get_frac_secs() * 1e9))
+        lock_sensor = 'lo_locked' in usrp.get_sensor_names(0)
+        locked_time = command_time
+        deadline = time.time() + self.retune_lead + self.lo_lock_timeout
+        while time.time() < deadline:
+            now = usrp.get_time_now().get_real_secs()
+            if now >= command_time and (not lock_sensor or usrp.get_sensor('lo_locked', 0).to_bool()):
+                locked_time = now
+                break
+            time.sleep(1e-4)
+        return int((locked_time - command_time) * self.sample_rate)
+
+    # A channel can be retuned digitally when it is inside the captured band with its filter
+    # transition, and away from the LO leakage at DC
+    def in_band(self, freq):
+        offset = abs(freq - self.lo_freq)
+        return offset >= self.cutoff_freq and offset + self.cutoff_freq + self.transition_width <= self.sample_rate / 2
+
+    # Mode ('lo' or 'digital'), host latency (seconds) and samples lost of the last retune
+    def get_last_retune(self):
+        return self.last_retune
+
+    # Where the last retune takes effect: (IQ sample index, None), or (None, USRP time in ns)
+    # for a timed LO retune, to be converted with the rx_time of the samples
+    def get_retune_start(self):
+        if self.retune_time_ns is not None:
+            return None, self.retune_time_ns
+        return self.retune_sample, None
+
+    def notify_eof(self):
+        # Post an EOF message (type 1) to the message queues once the flowgraph is done
+        self.wait()
+        self.message_queue.insert_tail(gr.message(1))
+        if self.iq_queue is not None:
+            self.iq_queue.insert_tail(gr.message(1))
 
 
 def main(top_block_cls=gr_ble, options=None):
@@ -0,0 +1,216 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+##################################################
+# GNU Radio Python Flow Graph
+# Title: Bluetooth LE Wideband Receiver
+# Author: Jan Wagner
+##################################################
+
+from gnuradio import blocks
+from gnuradio import digital
+from gnuradio import filter
+from gnuradio import gr
+from gnuradio import uhd
+from gnuradio.filter import firdes
+try:
+    from .gr_iq_file import iq_file_sink, iq_file_source
+    from .gr_stream_tags import sample_tagger, tagged_gmsk_demod, tagged_message_sink
+except (ValueError, ImportError):
+    # Run as a script
+    from gr_iq_file import iq_file_sink, iq_file_source
+    from gr_stream_tags import sample_tagger, tagged_gmsk_demod, tagged_message_sink
+from gnuradio.filter import pfb
+import time
+
+
+class gr_ble_wideband(gr.top_block):
+    """
+     Capture one band covering all the selected BLE channels, split it with a
+     polyphase filterbank channelizer and demodulate every selected channel.
+     The bits of channel n go to message_queues[n].
+    """
+
+    # Default values of the variables, readable before the flowgraph is built
+    ble_base_freq = 2402e6
+    ble_channel_spacing = 2e6
+    data_rate = 1e6
+    oversample_rate = 2
+    duration_seconds = 10
+    rf_gain = 30
+    iq_output = "/dev/null"
+    gmsk_omega_limit = 0.035
+    gmsk_mu = 0.5
+    gmsk_gain_mu = 0.7
+    queue_depth = 2
+    tag_period = 512
+
+    def __init__(self, ble_channels=(0, 12, 39), iq_input='', throttle=False, iq_format='cf32', queue_depth=None):
+        gr.top_block.__init__(self, "Bluetooth LE Wideband Receiver")
+
+        ##################################################
+        # Parameters
+        ##################################################
+        # Channel indexes (0 = 2402 MHz), see proto.BLE_CHANS
+        self.ble_channels = ble_channels = list(ble_channels)
+        self.iq_input = iq_input
+        self.throttle = throttle
+        # Format of the IQ files: cf32, sc16 or sc8
+        self.iq_format = iq_format
+        # Messages of demodulated bits held by each message queue
+        self.queue_depth = gr_ble_wideband.queue_depth if queue_depth is None else queue_depth
+
+        ##################################################
+        # Variables
+        ##################################################
+        self.ble_base_freq = ble_base_freq = gr_ble_wideband.ble_base_freq
+        self.ble_channel_spacing = ble_channel_spacing = gr_ble_wideband.ble_channel_spacing
+        self.data_rate = data_rate = gr_ble_wideband.data_rate
+        self.oversample_rate = oversample_rate = gr_ble_wideband.oversample_rate
+        self.duration_seconds = duration_seconds = gr_ble_wideband.duration_seconds
+        self.rf_gain = rf_gain = gr_ble_wideband.rf_gain
+        self.iq_output = iq_output = gr_ble_wideband.iq_output
+        self.gmsk_omega_limit = gmsk_omega_limit = gr_ble_wideband.gmsk_omega_limit
+        self.gmsk_mu = gmsk_mu = gr_ble_wideband.gmsk_mu
+        self.gmsk_gain_mu = gmsk_gain_mu = gr_ble_wideband.gmsk_gain_mu
+        # Even number of channelizer bins covering all the selected channels
+        self.num_chans = num_chans = (max(ble_channels) - min(ble_channels) + 2) // 2 * 2
+        self.center_index = center_index = min(ble_channels) + num_chans // 2
+        self.freq = freq = ble_base_freq + ble_channel_spacing * center_index
+        self.sample_rate = sample_rate = ble_channel_spacing * num_chans
+        self.num_samples = num_samples = duration_seconds*sample_rate
+        self.gmsk_sps = gmsk_sps = int(ble_channel_spacing * oversample_rate / data_rate)
+        self.channelizer_taps = channelizer_taps = firdes.low_pass_2(1, sample_rate, 850e3, 300e3, 60, firdes.WIN_BLACKMAN_HARRIS)
+
+        ##################################################
+        # Message Queues
+        ##################################################
+        self.message_queues = [gr.msg_queue(self.queue_depth) for _ in ble_channels]
+
+        ##################################################
+        # Blocks
+        ##################################################
+        if self.iq_input:
+            self.uhd_usrp_source_0 = None
+            self.blocks_file_source_0 = iq_file_source(iq_input, iq_format)
+            self.blocks_throttle_0 = blocks.throttle(gr.sizeof_gr_complex*1, sample_rate, True)
+            self.blocks_file_sink_0 = None
+        else:
+            self.uhd_usrp_source_0 = uhd.usrp_source(
+                ",".join(("", "")),
+                uhd.stream_args(
+                    cpu_format="fc32",
+                    channels=range(1),
+                ),
+            )
+            self.uhd_usrp_source_0.set_samp_rate(sample_rate)
+            self.uhd_usrp_source_0.set_center_freq(freq, 0)
+            self.uhd_usrp_source_0.set_gain(rf_gain, 0)
+            self.uhd_usrp_source_0.set_antenna('J2', 0)
+            # rx_time tags in host time, counted by the USRP clock from there
+            self.uhd_usrp_source_0.set_time_now(uhd.time_spec(time.time()), uhd.ALL_MBOARDS)
+            self.blocks_file_sink_0 = iq_file_sink(iq_output, iq_format)
+        self.blocks_head_0 = blocks.head(gr.sizeof_gr_complex*1, int(num_samples))
+        self.pfb_channelizer_ccf_0 = pfb.channelizer_ccf(
+            num_chans,
+            (channelizer_taps),
+            oversample_rate,
+            100)
+        self.sample_taggers = []
+        self.digital_gmsk_demods = []
+        self.message_sinks = []
+        for n in range(len(ble_channels)):
+            # Sample index tags in wideband samples, a channelizer output sample spans num_chans / oversample_rate
+            self.sample_taggers.append(sample_tagger(gr_ble_wideband.tag_period, num_chans // oversample_rate))
+            self.digital_gmsk_demods.append(tagged_gmsk_demod(
+                samples_per_symbol=gmsk_sps,
+                gain_mu=gmsk_gain_mu,
+                mu=gmsk_mu,
+                omega_relative_limit=gmsk_omega_limit,
+            ))
+            # Blocking: the queues are drained by reader threads, no bits are dropped here
+            self.message_sinks.append(tagged_message_sink(self.message_queues[n]))
+        self.blocks_null_sink_0 = blocks.null_sink(gr.sizeof_gr_complex*1)
+
+        ##################################################
+        # Connections
+        ##################################################
+        if self.iq_input:
+            if self.throttle:
+                self.connect((self.blocks_file_source_0, 0), (self.blocks_throttle_0, 0))
+                self.connect((self.blocks_throttle_0, 0), (self.pfb_channelizer_ccf_0, 0))
+            else:
+                self.connect((self.blocks_file_source_0, 0), (self.pfb_channelizer_ccf_0, 0))
+        else:
+            self.connect((self.uhd_usrp_source_0, 0), (self.blocks_head_0, 0))
+            self.connect((self.blocks_head_0, 0), (self.blocks_file_sink_0, 0))
+            self.connect((self.blocks_head_0, 0), (self.pfb_channelizer_ccf_0, 0))
+        for n in range(len(ble_channels)):
+            self.connect((self.pfb_channelizer_ccf_0, self.get_channel_output(ble_channels[n])), (self.sample_taggers[n], 0))
+            self.connect((self.sample_taggers[n], 0), (self.digital_gmsk_demods[n], 0))
+            self.connect((self.digital_gmsk_demods[n], 0), (self.message_sinks[n], 0))
+        used = [self.get_channel_output(channel) for channel in ble_channels]
+        unused = [output for output in range(num_chans) if output not in used]
+        for n in range(len(unused)):
+            self.connect((self.pfb_channelizer_ccf_0, unused[n]), (self.blocks_null_sink_0, n))
+
+    # Channelizer output of a BLE channel index (outputs are in FFT order)
+    def get_channel_output(self, ble_channel):
+        return (ble_channel - self.center_index) % self.num_chans
+
+    def get_ble_channels(self):
+        return self.ble_channels
+
+    def get_num_chans(self):
+        return self.num_chans
+
+    def get_sample_rate(self):
+        return self.sample_rate
+
+    def get_freq(self):
+        return self.freq
+
+    def get_gmsk_sps(self):
+        return self.gmsk_sps
+
+    # Delay (wideband samples) of the channelizer filter between the captured samples and the demodulators
+    def get_sample_delay(self):
+        return (len(self.channelizer_taps) - 1) // 2
+
+    def get_data_rate(self):
+        return self.data_rate
+
+    def get_rf_gain(self):
+        return self.rf_gain
+
+    def set_rf_gain(self, rf_gain):
+        self.rf_gain = rf_gain
+        if self.uhd_usrp_source_0:
+            self.uhd_usrp_source_0.set_gain(self.rf_gain, 0)
+
+    def get_duration_seconds(self):
+        return self.duration_seconds
+
+    def set_duration_seconds(self, duration_seconds):
+        self.duration_seconds = duration_seconds
+        self.set_num_samples(self.duration_seconds*self.sample_rate)
+
+    def get_num_samples(self):
+        return self.num_samples
+
+    def set_num_samples(self, num_samples):
+        self.num_samples = num_samples
+        self.blocks_head_0.set_length(int(self.num_samples))
+
+    def get_iq_output(self):
+        return self.iq_output
+
+    def set_iq_output(self, iq_output):
+        self.iq_output = iq_output
+        if self.blocks_file_sink_0:
+            self.blocks_file_sink_0.open(self.iq_output)
+
+    def notify_eof(self):
+        # Post an EOF message (type 1) to every message queue once the flowgraph is done
+        self.wait()
+        for message_queue in self.message_queues:
+            message_queue.insert_tail(gr.message(1))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+##################################################
+# GNU Radio Python Hier Blocks
+# Title: IQ file source and sink (cf32, sc16, sc8)
+##################################################
+
+from gnuradio import blocks
+from gnuradio import gr
+
+# A sample of magnitude 1.0 is stored as +/-scale in the integer formats (same as proto.IQ_FORMATS)
+IQ_SCALES = {'sc16': 32767.0, 'sc8': 127.0}
+
+
+class iq_file_sink(gr.hier_block2):
+    """
+     Write complex samples to an IQ file as cf32, or scaled to interleaved
+     16 bit (sc16) or 8 bit (sc8) integers.
+    """
+
+    def __init__(self, iq_file, iq_format='cf32'):
+        gr.hier_block2.__init__(
+            self, "IQ File Sink",
+            gr.io_signature(1, 1, gr.sizeof_gr_complex*1),
+            gr.io_signature(0, 0, 0),
+        )
+        self.iq_format = iq_format
+
+        ##################################################
+        # Blocks
+        ##################################################
+        if iq_format == 'cf32':
+            self.blocks_file_sink_0 = blocks.file_sink(gr.sizeof_gr_complex*1, iq_file, False)
+        else:
+            self.blocks_multiply_const_0 = blocks.multiply_const_vcc((IQ_SCALES[iq_format], ))
+            if iq_format == 'sc16':
+                self.blocks_complex_to_interleaved_0 = blocks.complex_to_interleaved_short(False)
+                self.blocks_file_sink_0 = blocks.file_sink(gr.sizeof_short*1, iq_file, False)
+            else:
+                self.blocks_complex_to_interleaved_0 = blocks.complex_to_interleaved_char(False)
+                self.blocks_file_sink_0 = blocks.file_sink(gr.sizeof_char*1, iq_file, False)
+        self.blocks_file_sink_0.set_unbuffered(False)
+
+        ##################################################
+        # Connections
+        ##################################################
+        if iq_format == 'cf32':
+            self.connect((self, 0), (self.blocks_file_sink_0, 0))
+        else:
+            self.connect((self, 0), (self.blocks_multiply_const_0, 0))
+            self.connect((self.blocks_multiply_const_0, 0), (self.blocks_complex_to_interleaved_0, 0))
+            self.connect((self.blocks_complex_to_interleaved_0, 0), (self.blocks_file_sink_0, 0))
+
+    def open(self, iq_file):
+        self.blocks_file_sink_0.open(iq_file)
+
+
+class iq_file_source(gr.hier_block2):
+    """
+     Read complex samples from an IQ file written by iq_file_sink.
+    """
+
+    def __init__(self, iq_file, iq_format='cf32'):
+        gr.hier_block2.__init__(
+            self, "IQ File Source",
+            gr.io_signature(0, 0, 0),
+            gr.io_signature(1, 1, gr.sizeof_gr_complex*1),
+        )
+        self.iq_format = iq_format
+
+        ##################################################
+        # Blocks
+        ##################################################
+        if iq_format == 'cf32':
+            self.blocks_file_source_0 = blocks.file_source(gr.sizeof_gr_complex*1, iq_file, False)
+        else:
+            if iq_format == 'sc16':
+                self.blocks_file_source_0 = blocks.file_source(gr.sizeof_short*1, iq_file, False)
+                self.blocks_interleaved_to_complex_0 = blocks.interleaved_short_to_complex(False, False)
+            else:
+                self.blocks_file_source_0 = blocks.file_source(gr.sizeof_char*1, iq_file, False)
+                self.blocks_interleaved_to_complex_0 = blocks.interleaved_char_to_complex(False)
+            self.blocks_multiply_const_0 = blocks.multiply_const_vcc((1.0 / IQ_SCALES[iq_format], ))
+
+        ##################################################
+        # Connections
+        ##################################################
+        if iq_format == 'cf32':
+            self.connect((self.blocks_file_source_0, 0), (self, 0))
+        else:
+            self.connect((self.blocks_file_source_0, 0), (self.blocks_interleaved_to_complex_0, 0))
+            self.connect((self.blocks_interleaved_to_complex_0, 0), (self.blocks_multiply_const_0, 0))
+            self.connect((self.blocks_multiply_const_0, 0), (self, 0))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+##################################################
+# GNU Radio Python Blocks
+# Title: IQ sample index and rx_time stream tags
+##################################################
+
+from math import pi
+import struct
+
+import numpy
+import pmt
+from gnuradio import analog
+from gnuradio import digital
+from gnuradio import gr
+
+SAMPLE_INDEX_TAG = 'sample_index'
+RX_TIME_TAG = 'rx_time'
+
+# Message type of the anchors sent with the demodulated bits, 1 being the end of the stream
+# Anchor: bit index, IQ sample index, rx_time in ns (-1 if unknown), same as ble_parser
+TAG_MESSAGE = 2
+ANCHOR_FORMAT = '<QQq'
+
+
+class sample_tagger(gr.sync_block):
+    """
+     Tag the IQ stream with the index of its samples: every 'period' samples and
+     on the UHD rx_time tags (first sample, after an overflow), so that the sample
+     index and the hardware time of a sample travel together through the demodulator.
+     On a channelizer output, 'decimation' is the number of input samples per output sample.
+    """
+
+    def __init__(self, period=1024, decimation=1):
+        gr.sync_block.__init__(self, name="Sample Tagger", in_sig=[numpy.complex64], out_sig=[numpy.complex64])
+        self.period = period
+        self.decimation = decimation
+        self.key = pmt.intern(SAMPLE_INDEX_TAG)
+        self.srcid = pmt.intern(self.name())
+
+    def work(self, input_items, output_items):
+        count = len(input_items[0])
+        output_items[0][:] = input_items[0]
+        first = self.nitems_read(0)
+        offsets = set(range(-first % self.period, count, self.period))
+        for tag in self.get_tags_in_window(0, 0, count, pmt.intern(RX_TIME_TAG)):
+            offsets.add(tag.offset - first)
+        for offset in sorted(offsets):
+            self.add_item_tag(0, first + offset, self.key, pmt.from_uint64((first + offset) * self.decimation),
+                              self.srcid)
+        return count
+
+
+class tagged_message_sink(gr.sync_block):
+    """
+     Message sink of the demodulated bits (one bit per byte) which also sends the
+     sample index tags reaching it as anchor messages (TAG_MESSAGE), with the rx_time
+     tag of the same sample. Blocks when the message queue is full.
+    """
+
+    def __init__(self, message_queue):
+        gr.sync_block.__init__(self, name="Tagged Message Sink", in_sig=[numpy.uint8], out_sig=None)
+        self.message_queue = message_queue
+
+    def work(self, input_items, output_items):
+        data = input_items[0]
+        first = self.nitems_read(0)
+        anchors = {}
+        for tag in self.get_tags_in_window(0, 0, len(data)):
+            key = pmt.symbol_to_string(tag.key)
+            if key == SAMPLE_INDEX_TAG:
+                anchors.setdefault(tag.offset, [None, -1])[0] = pmt.to_uint64(tag.value)
+            elif key == RX_TIME_TAG:
+                time_ns = (pmt.to_uint64(pmt.tuple_ref(tag.value, 0)) * 1000000000 +
+                           int(round(pmt.to_double(pmt.tuple_ref(tag.value, 1)) * 1e9)))
+                anchors.setdefault(tag.offset, [None, -1])[1] = time_ns
+        for offset in sorted(anchors):
+            sample_index, time_ns = anchors[offset]
+            if sample_index is not None:
+                self.message_queue.insert_tail(gr.message_from_string(
+                    struct.pack(ANCHOR_FORMAT, offset, sample_index, time_ns), TAG_MESSAGE, 0, 0))
+        self.message_queue.insert_tail(gr.message_from_string(data.tobytes(), 0, 0, 0))
+        return len(data)
+
+
+class tagged_gmsk_demod(gr.hier_block2):
+    """
+     GMSK demodulator with the parameters of digital.gmsk_demod whose clock recovery
+     moves the stream tags with the symbols. The M&M clock recovery of gmsk_demod
+     places tags at their sample offset scaled by the nominal rate, they drift with
+     the recovered clock; symbol_sync_ff (Gnu Radio 3.7.11) propagates each tag to the
+     symbol interpolated nearest to it. Older versions fall back to gmsk_demod.
+    """
+
+    def __init__(self, samples_per_symbol=2, gain_mu=0.175, mu=0.5, omega_relative_limit=0.005):
+        gr.hier_block2.__init__(
+            self, "Tagged GMSK Demod",
+            gr.io_signature(1, 1, gr.sizeof_gr_complex*1),
+            gr.io_signature(1, 1, gr.sizeof_char*1),
+        )
+
+        ##################################################
+        # Blocks
+        ##################################################
+        self.exact_tags = hasattr(digital, 'symbol_sync_ff')
+        if not self.exact_tags:
+            self.digital_gmsk_demod_0 = digital.gmsk_demod(
+                samples_per_symbol=samples_per_symbol,
+                gain_mu=gain_mu,
+                mu=mu,
+                omega_relative_limit=omega_relative_limit,
+                freq_error=0.0,
+                verbose=False,
+                log=False,
+            )
+            self.connect((self, 0), (self.digital_gmsk_demod_0, 0))
+            self.connect((self.digital_gmsk_demod_0, 0), (self, 0))
+            return
+
+        # Same FM demodulation gain as gmsk_demod: +/-1 for +/-pi/2 per symbol
+        self.analog_quadrature_demod_0 = analog.quadrature_demod_cf(samples_per_symbol / (pi / 2))
+        # Loop bandwidth from the M&M gain, maximum deviation (samples) from its omega limit
+        self.digital_symbol_sync_0 = digital.symbol_sync_ff(
+            digital.TED_MUELLER_AND_MULLER,
+            samples_per_symbol,
+            gain_mu / (2 * pi),
+            1.0,
+            1.0,
+            omega_relative_limit * samples_per_symbol,
+            1,
+            digital.constellation_bpsk().base(),
+            digital.IR_MMSE_8TAP,
+            128,
+            [],
+        )
+        self.digital_binary_slicer_0 = digital.binary_slicer_fb()
+
+        ##################################################
+        # Connections
+        ##################################################
+        self.connect((self, 0), (self.analog_quadrature_demod_0, 0))
+        self.connect((self.analog_quadrature_demod_0, 0), (self.digital_symbol_sync_0, 0))
+        self.connect((self.digital_symbol_sync_0, 0), (self.digital_binary_slicer_0, 0))
+        self.connect((self.digital_binary_slicer_0, 0), (self, 0))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  ble-dump: activity-aware BLE channel hopping
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import binascii
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2: no monotonic clock in the standard library
+    from time import time as monotonic
+
+HOP_POLICIES = ('fixed', 'adaptive')
+
+
+# Advertiser addresses ('aa:bb:cc:dd:ee:ff', comma separated) as proto.adv_address returns them
+
+
+def parse_addresses(addresses):
+    return set(binascii.unhexlify(address.strip().replace(':', '')) for address in addresses.split(',')
+               if address.strip())
+
+
+class ChannelStat(object):
+    """
+     Decoding statistics of a scanned channel.
+
+            packets, targets --- valid packets and packets of a target device, over the capture
+            pending_packets, pending_targets --- the same during the current dwell
+            dwell       --- seconds spent on the channel, over the capture
+            score       --- smoothed yield of the last dwells: packets per second, a target hit
+                            counting as 'target_weight' packets
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.targets = 0
+        self.dwell = 0.0
+        self.score = None
+        self.pending_packets = 0
+        self.pending_targets = 0
+
+    @property
+    def yield_rate(self):
+        return self.packets / self.dwell if self.dwell else 0.0
+
+
+class HopScheduler(object):
+    """
+     Round-robin over the scanned channels with a dwell time per channel. With the
+     fixed policy every channel gets 'window' seconds; with the adaptive policy a
+     scan cycle (window seconds per channel) is shared according to the channel
+     scores, each dwell staying within [min_dwell, max_dwell] so that quiet channels
+     are still visited. Deadlines are taken from a monotonic clock on Python 3.
+     Python 2 has none: the wall clock is used, and a step between two readings
+     (backwards, or longer than the longest dwell) is left out of the dwell times
+     instead of stalling or skipping hops.
+    """
+
+    def __init__(self, channels, window, min_dwell=None, max_dwell=None, policy='fixed', targets=(),
+                 target_weight=10.0, smoothing=0.3, clock=monotonic):
+        if policy not in HOP_POLICIES:
+            raise ValueError('unknown hop policy: {}'.format(policy))
+        self.channels = list(channels)
+        self.window = window
+        self.min_dwell = window / 4.0 if min_dwell is None else min_dwell
+        self.max_dwell = window * len(self.channels) if max_dwell is None else max_dwell
+        self.policy = policy
+        self.targets = set(targets)
+        self.target_weight = target_weight
+        self.smoothing = smoothing
+        self.stats = dict((channel, ChannelStat()) for channel in self.channels)
+        self.hops = 0
+        self.index = 0
+        self._clock = clock
+        self._hop_time = self._last = clock()
+        self.deadline = self._hop_time + self.dwell(self.channel)
+
+    @property
+    def channel(self):
+        return self.channels[self.index]
+
+    def due(self):
+        return self._now() >= self.deadline
+
+    # Clock time, the current dwell is shifted by a clock step (Python 2 wall clock)
+    def _now(self):
+        now = self._clock()
+        step = now - self._last
+        if step < 0 or step > max(self.max_dwell, self.window) + self.window:
+            self._hop_time += step
+            self.deadline += step
+        self._last = now
+        return now
+
+    # Count a valid packet decoded on a channel
+    def record(self, channel, address=None):
+        stat = self.stats.get(channel)
+        if stat is None:
+            return
+        stat.pending_packets += 1
+        if address is not None and address in self.targets:
+            stat.pending_targets += 1
+
+    # Dwell time of a channel in the next scan cycle
+    def dwell(self, channel):
+        scores = [self.stats[c].score for c in self.channels]
+        if self.policy == 'fixed' or None in scores or not sum(scores):
+            return self.window
+        share = self.stats[channel].score / sum(scores)
+        return min(self.max_dwell, max(self.min_dwell, share * self.window * len(self.channels)))
+
+    # End the dwell on the current channel, its packets are added to the channel statistics
+    def stop(self):
+        now = self._now()
+        stat = self.stats[self.channel]
+        elapsed = max(now - self._hop_time, 1e-3)
+        rate = (stat.pending_packets + self.target_weight * stat.pending_targets) / elapsed
+        stat.score = rate if stat.score is None else (1 - self.smoothing) * stat.score + self.smoothing * rate
+        stat.packets += stat.pending_packets
+        stat.targets += stat.pending_targets
+        stat.dwell += elapsed
+        stat.pending_packets = stat.pending_targets = 0
+        self._hop_time = now
+        return now
+
+    # End the dwell on the current channel and move to the next one, returns it
+    def hop(self):
+        now = self.stop()
+        self.hops += 1
+        self.index = (self.index + 1) % len(self.channels)
+        self.deadline = now + self.dwell(self.channel)
+        return self.channel
+
+    # Seconds to spend on the current channel
+    @property
+    def current_dwell(self):
+        return self.deadline - self._hop_time
+
+    # Valid packets per second of air time over all channels
+    @property
+    def yield_rate(self):
+        dwell = sum(stat.dwell for stat in self.stats.values())
+        return sum(stat.packets for stat in self.stats.values()) / dwell if dwell else 0.0
+
+    def summary(self):
+        return ', '.join('{:d}: {:.1f} pkt/s ({:d} targets, {:.1f}s)'.format(
+            channel, self.stats[channel].yield_rate, self.stats[channel].targets, self.stats[channel].dwell)
+            for channel in self.channels) + ', total: {:.1f} pkt/s'.format(self.yield_rate)
@@ -0,0 +1,98 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+#  ble-dump: triggered IQ recording around decoded packets
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import csv
+from collections import deque
+
+from proto import IQ_FORMATS, IQ_FORMAT_DEFAULT, iq_from_complex
+
+WINDOW_CSV_FIELDS = ['Start_trame', 'End_trame', 'Offset']
+
+
+# Window index of a triggered IQ recording
+
+
+def windows_file(iq_file):
+    return iq_file.split('.')[0] + '-windows.csv'
+
+
+# Read the window index of a triggered IQ recording as (start sample, end sample, offset) tuples
+
+
+def read_windows(iq_file):
+    with open(windows_file(iq_file)) as csvfile:
+        return [(int(row['Start_trame']), int(row['End_trame']), int(row['Offset']))
+                for row in csv.DictReader(csvfile)]
+
+
+class TriggeredRecorder(object):
+    """
+     Record only the IQ samples around validated packets instead of the whole
+     capture. Each packet opens a window from 'pre_samples' before its start to
+     'post_samples' after its end, overlapping windows are merged. The samples
+     are read back from the sample ring (see ring_buffer.SampleRing), the window
+     index (-windows.csv) maps each window to its sample position in the capture.
+
+            fmt         --- IQ file format (proto.IQ_FORMATS)
+            offset      --- samples written to the IQ file
+    """
+
+    def __init__(self, iq_file, pre_samples, post_samples, fmt=IQ_FORMATS[IQ_FORMAT_DEFAULT]):
+        self.iq_file = iq_file
+        self.pre_samples = int(pre_samples)
+        self.post_samples = int(post_samples)
+        self.fmt = fmt
+        self.offset = 0
+        self.windows = 0
+        self.truncated = 0
+
+        self._fd = open(iq_file, 'wb')
+        self._index_fd = open(windows_file(iq_file), 'w')
+        self._index = csv.writer(self._index_fd)
+        self._index.writerow(WINDOW_CSV_FIELDS)
+        self._pending = deque()
+        self._written_end = 0
+
+    # Open (or extend) the window of a packet
+    def add_packet(self, start_frame, end_frame):
+        start = max(0, int(start_frame) - self.pre_samples, self._written_end)
+        end = int(end_frame) + self.post_samples
+        if self._pending and start <= self._pending[-1][1]:
+            self._pending[-1][1] = max(self._pending[-1][1], end)
+        elif end > start:
+            self._pending.append([start, end])
+
+    # Write the windows whose samples were all received. Samples which already
+    # left the sample ring are missing from the start of their window
+    def process(self, sample_ring, stream_end=False):
+        while self._pending and (stream_end or self._pending[0][1] <= sample_ring.end):
+            start, end = self._pending.popleft()
+            end = min(end, sample_ring.end)
+            if start < sample_ring.start:
+                self.truncated += 1
+                start = sample_ring.start
+            samples = sample_ring.read(start, end)
+            if samples is None or not len(samples):
+                continue
+            self._fd.write(iq_from_complex(samples, self.fmt).tobytes())
+            self._index.writerow([start, end, self.offset])
+            self.offset += len(samples)
+            self.windows += 1
+            self._written_end = end
+
+    def flush(self):
+        self._fd.flush()
+        self._index_fd.flush()
+
+    # Write the last windows, up to the end of the stream
+    def close(self, sample_ring):
+        self.process(sample_ring, stream_end=True)
+        self._fd.close()
+        self._index_fd.close()
@@ -1,45 +1,146 @@
 #!/usr/bin/python -u
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
 
 import csv
 import os
+from multiprocessing import Pool, cpu_count
 from optparse import OptionGroup, OptionParser
 import numpy as np
 
+from proto import IQ_FORMATS, iq_format, iq_from_complex, iq_sample_size, iq_to_complex, map_iq, read_packet_index
+
+
+# Samples gathered before one write to the output file
+WRITE_SAMPLES = 1 << 20
+
+
+# Packet windows of a packet index in IQ sample order, clamped to the IQ file.
+# Returns packet index rows, start and end samples, and sample offsets in the output
+
+
+def packet_windows(index, iq_samples):
+    starts = np.clip(index['start_frame'].astype(np.int64), 0, iq_samples)
+    ends = np.maximum(np.clip(index['end_frame'].astype(np.int64), 0, iq_samples), starts)
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    ends = ends[order]
+    offsets = np.zeros(len(order), dtype=np.int64)
+    np.cumsum((ends - starts)[:-1], out=offsets[1:])
+    return order, starts, ends, offsets
+
+
+# Copy the windows [starts, ends) of the IQ file to the output file from sample 'offset' on,
+# converted from the IQ file format 'fmt' to 'out_fmt' when they differ
+
+
+def extract_windows(iq_file, data_file, starts, ends, offset, fmt, out_fmt):
+    iq_data = map_iq(iq_file, fmt)
+    with open(data_file, 'r+b') as data_to_file:
+        data_to_file.seek(offset * iq_sample_size(out_fmt))
+        pending = []
+        pending_samples = 0
+        for start, end in zip(starts, ends):
+            pending.append(iq_data[start:end])
+            pending_samples += end - start
+            if pending_samples >= WRITE_SAMPLES:
+                write_samples(data_to_file, np.concatenate(pending), fmt, out_fmt)
+                pending = []
+                pending_samples = 0
+        if pending:
+            write_samples(data_to_file, np.concatenate(pending), fmt, out_fmt)
+
+
+# Write IQ values of format 'fmt' to the output file in format 'out_fmt'
+
+
+def write_samples(data_to_file, values, fmt, out_fmt):
+    if out_fmt != fmt:
+        values = iq_from_complex(iq_to_complex(values, fmt), out_fmt)
+    data_to_file.write(values.tobytes())
+
+
+def _extract_windows(args):
+    extract_windows(*args)
+
+
+# Write the offsets table: packet index row, IQ samples and position in the extracted data
+
+
+def write_offsets(offsets_file, order, starts, ends, offsets):
+    with open(offsets_file, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Index', 'Start_trame', 'End_trame', 'Offset', 'Sample_count'])
+        for row in zip(order, starts, ends, offsets, ends - starts):
+            writer.writerow([int(x) for x in row])
+
 
 # Extract BLE IQ data and save it  into a .sigmf-data
-def iq_save(csv_file, iq_file):
+
+
+def iq_save(csv_file, iq_file, jobs=1, fmt=None, out_fmt=None, output=None):
     """
      Parameters:
-            csv-file    --- csv file path where are recorded: #Time,Robot_Number,X,Y,Angle,Start_trame,End_trame,Channel_frequency,Sample_rate
-            data-file   --- Sigmf-data file path
+            csv-file    --- packet index, csv file path where are recorded: #Time,Robot_Number,X,Y,Angle,Start_trame,End_trame,Channel_frequency,Sample_rate
+                            or binary packet index (ble_dump.py -b)
+            data-file   --- IQ file the packets were detected in
+            jobs        --- processes copying the packets, each one writes its own part of the output
+            fmt         --- IQ file format (proto.IQ_FORMATS), by default from the file extension
+            out_fmt     --- format of the extracted data, by default the IQ file format
+            output      --- path of the output files without extension, by default <data-file>-BLE_IQ
 
+     The packets are written in IQ sample order into <output>.sigmf-data, the offsets table
+     (<output>-offsets.csv) gives the position of each packet index row in the extracted data.
     """
-    data_file_sigmfdata = iq_file.split('.')[0]+'-BLE_IQ.sigmf-data'
+    output = output or os.path.splitext(iq_file)[0] + '-BLE_IQ'
+    data_file_sigmfdata = output + '.sigmf-data'
+    offsets_file = output + '-offsets.csv'
     base_data = os.path.dirname(data_file_sigmfdata)
-    if not os.path.exists(base_data):
+    if base_data and not os.path.exists(base_data):
         os.makedirs(base_data)
-    with open(data_file_sigmfdata, 'a+') as data_to_file:    
-        with open(csv_file) as csvfile:
-            reader_csv = csv.DictReader(csvfile)
-            for row in reader_csv:
-                print(row)
-                start_frame = int(row['Start_trame'])
-                end_frame = int(row['End_trame'])
-                iq_data = np.memmap(iq_file, dtype=np.complex64, mode='r',
-                                offset=start_frame, shape=end_frame-start_frame)
-                data_to_file.write(iq_data.tobytes())
-    print('BLE IQ data are extracted and saved into:', data_file_sigmfdata)
-    print('Run sigmf_recording.py with extracted BLE data file to get a sigmf archive')
+
+    fmt = fmt or iq_format(iq_file)
+    out_fmt = out_fmt or fmt
+    iq_samples = os.path.getsize(iq_file) // iq_sample_size(fmt)
+    order, starts, ends, offsets = packet_windows(read_packet_index(csv_file), iq_samples)
+    total = int(ends[-1] - starts[-1] + offsets[-1]) if len(order) else 0
+    with open(data_file_sigmfdata, 'wb') as data_to_file:
+        data_to_file.truncate(total * iq_sample_size(out_fmt))
+
+    if jobs > 1 and len(order) > jobs:
+        # Contiguous groups of packets with about the same number of samples
+        bounds = np.searchsorted(offsets, np.arange(1, jobs) * total // jobs)
+        groups = np.split(np.arange(len(order)), bounds)
+        pool = Pool(jobs)
+        pool.map(_extract_windows, [(iq_file, data_file_sigmfdata, starts[group], ends[group], offsets[group[0]],
+                                     fmt, out_fmt) for group in groups if len(group)])
+        pool.close()
+        pool.join()
+    elif len(order):
+        extract_windows(iq_file, data_file_sigmfdata, starts, ends, 0, fmt, out_fmt)
+
+    write_offsets(offsets_file, order, starts, ends, offsets)
+    print('{:d} BLE packets ({:d} {} IQ samples) are extracted and saved into:'.format(len(order), total, out_fmt.name),
+          data_file_sigmfdata)
+    print('Packet offsets in the extracted data are recorded into:', offsets_file)
+    print('Run sigmf_recording.py with extracted BLE data file (-F {}) to get a sigmf archive'.format(out_fmt.name))
 
 
 if __name__ == '__main__':
     parser = OptionParser()
     #csv and data file path
     parser.add_option("-c", "--csv-file", type="string", default='',
-                     help="csv file path where are recorded: #time,start_trame,endtrame,frequency,sample_rate")
+                     help="csv file path where are recorded: #time,start_trame,endtrame,frequency,sample_rate (or binary packet index)")
     parser.add_option("-d", "--data-file", type="string", default='',
                      help="IQ file path to be used to extract BLE IQ data")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                     help="Processes copying the packets, 0 for one per CPU [default=%default]")
+    parser.add_option("-F", "--iq-format", type="choice", choices=sorted(IQ_FORMATS), default=None,
+                     help="IQ file format: cf32, sc16 or sc8 [default=from the file extension, else cf32]")
+    parser.add_option("-O", "--output-format", type="choice", choices=sorted(IQ_FORMATS), default=None,
+                     help="Format of the extracted IQ data [default=the IQ file format]")
     (opts, _) = parser.parse_args()
-    iq_save(opts.csv_file, opts.data_file)
+    fmt = iq_format(opts.data_file, opts.iq_format)
+    out_fmt = IQ_FORMATS[opts.output_format] if opts.output_format else fmt
+    iq_save(opts.csv_file, opts.data_file, opts.jobs if opts.jobs > 0 else cpu_count(), fmt, out_fmt)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  ble-dump: pipeline metrics, exported as JSON lines and in Prometheus text format
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import json
+import threading
+from bisect import bisect_left
+from time import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+# Upper bounds (seconds) of the stage timing buckets, the last bucket is +Inf
+STAGE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+METRICS_INTERVAL = 10.0
+
+
+class Histogram(object):
+    """
+     Fixed-bucket histogram: one bisection and three additions per value.
+
+            buckets     --- values per bucket (not cumulative), the last one above all bounds
+    """
+
+    def __init__(self, bounds=STAGE_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+# Metric key of a name and its labels
+
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+
+# Metric name with its labels, as written by Prometheus
+
+
+def metric_name(key, extra=()):
+    name, labels = key
+    labels = labels + tuple(extra)
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(label, value) for label, value in labels))
+
+
+class Metrics(object):
+    """
+     Counters, gauges and stage timing histograms of the capture pipeline, updated
+     by the parser threads. An update is a lock and a dictionary lookup, cheap
+     enough to stay on during long captures. Stage timings are in seconds.
+    """
+
+    def __init__(self, prefix='ble_dump'):
+        self.prefix = prefix
+        self.started = time()
+        self._counters = {}
+        self._gauges = {}
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    # Add to a counter
+    def add(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # Set a gauge
+    def set(self, name, value, **labels):
+        self._gauges[metric_key(name, labels)] = value
+
+    # Record the duration of a pipeline stage
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    # Copy of the current values: ({key: counter}, {key: gauge}, {stage: (count, sum, buckets)})
+    def values(self):
+        with self._lock:
+            return (dict(self._counters), dict(self._gauges),
+                    dict((stage, (h.count, h.sum, list(h.buckets))) for stage, h in self._stages.items()))
+
+    # Current values in Prometheus text format
+    def prometheus(self):
+        counters, gauges, stages = self.values()
+        lines = []
+        for kind, suffix, metrics in (('counter', '_total', counters), ('gauge', '', gauges)):
+            for name in sorted(set(key[0] for key in metrics)):
+                full_name = self.prefix + '_' + name + suffix
+                lines.append('# TYPE {} {}'.format(full_name, kind))
+                for key in sorted(key for key in metrics if key[0] == name):
+                    lines.append('{} {}'.format(metric_name((full_name, key[1])), metrics[key]))
+        if stages:
+            name = self.prefix + '_stage_seconds'
+            lines.append('# TYPE {} histogram'.format(name))
+            for stage in sorted(stages):
+                count, total, buckets = stages[stage]
+                labels = (('stage', stage), )
+                cumulative = 0
+                for bound, value in zip(STAGE_BUCKETS + ('+Inf', ), buckets):
+                    cumulative += value
+                    lines.append('{} {}'.format(metric_name((name + '_bucket', labels), [('le', bound)]), cumulative))
+                lines.append('{} {}'.format(metric_name((name + '_sum', labels)), repr(total)))
+                lines.append('{} {}'.format(metric_name((name + '_count', labels)), count))
+        lines.append('{} {}'.format(metric_name((self.prefix + '_uptime_seconds', ())), repr(time() - self.started)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsLog(object):
+    """
+     Write the metrics as one JSON object per line every 'interval' seconds, with
+     the counter rates over the interval, the stage timing counts, means and
+     histograms over the interval, and the gauges.
+    """
+
+    def __init__(self, filename, metrics, interval=METRICS_INTERVAL):
+        self.filename = filename
+        self.metrics = metrics
+        self.interval = interval
+        self._fd = open(filename, 'a')
+        self._last = (time(), {}, {})
+
+    def poll(self):
+        if time() - self._last[0] >= self.interval:
+            self.write()
+
+    def write(self):
+        now = time()
+        counters, gauges, stages = self.metrics.values()
+        last_time, last_counters, last_stages = self._last
+        elapsed = max(now - last_time, 1e-9)
+        record = {
+            'time': now,
+            'interval': elapsed,
+            'counters': dict((metric_name(key), value) for key, value in counters.items()),
+            'rates': dict((metric_name(key), (value - last_counters.get(key, 0)) / elapsed)
+                          for key, value in counters.items()),
+            'gauges': dict((metric_name(key), value) for key, value in gauges.items()),
+            'stages': {},
+        }
+        for stage, (count, total, buckets) in stages.items():
+            last_count, last_total, last_buckets = last_stages.get(stage, (0, 0.0, [0] * len(buckets)))
+            count -= last_count
+            record['stages'][stage] = {
+                'count': count,
+                'mean': (total - last_total) / count if count else 0.0,
+                'buckets': [value - last for value, last in zip(buckets, last_buckets)],
+            }
+        self._fd.write(json.dumps(record, sort_keys=True) + '\n')
+        self._fd.flush()
+        self._last = (now, counters, stages)
+
+    def close(self):
+        if not self._fd.closed:
+            self.write()
+            self._fd.close()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Serve the metrics in Prometheus text format on http://host:port/metrics from a
+# background thread, returns the server (shutdown() stops it)
+
+
+def start_metrics_server(metrics, port, host='127.0.0.1'):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
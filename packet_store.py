@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  ble-dump: indexed packet store (SQLite)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import sqlite3
+from collections import namedtuple
+from time import time
+
+from proto import BLE_ACCESS_ADDR, BLE_CRC_LEN, PCAP_FLUSH_INTERVAL, adv_address
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    iq_file TEXT,
+    iq_format TEXT,
+    sample_rate INTEGER,
+    start_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS packets (
+    time_ns INTEGER NOT NULL,
+    capture INTEGER,
+    channel INTEGER,
+    access_address INTEGER,
+    pdu_type INTEGER,
+    adv_address BLOB,
+    pdu BLOB,
+    start_frame INTEGER,
+    end_frame INTEGER,
+    frequency INTEGER
+);
+CREATE INDEX IF NOT EXISTS packets_adv_address ON packets (adv_address, time_ns);
+CREATE INDEX IF NOT EXISTS packets_time ON packets (time_ns);
+CREATE INDEX IF NOT EXISTS packets_channel ON packets (channel, time_ns);
+"""
+
+# Packets inserted per transaction
+STORE_FLUSH_PACKETS = 1000
+
+STORE_FIELDS = ['time_ns', 'capture', 'channel', 'access_address', 'pdu_type', 'adv_address', 'pdu',
+                'start_frame', 'end_frame', 'frequency']
+
+# A stored packet: reception time (ns), capture id, BLE channel, access address, PDU type
+# (advertising packets, else None), advertiser address (MSB first, or None), PDU without
+# CRC, IQ samples [start_frame, end_frame) in the capture and channel frequency
+StoredPacket = namedtuple('StoredPacket', STORE_FIELDS)
+
+# A capture: IQ file holding the packet samples (None if not recorded), its format,
+# sample rate and time of its first sample (ns)
+Capture = namedtuple('Capture', ['id', 'iq_file', 'iq_format', 'sample_rate', 'start_ns'])
+
+
+def _blob(value):
+    return None if value is None else sqlite3.Binary(value)
+
+
+def _bytes(value):
+    return None if value is None else bytes(value)
+
+
+class PacketStore(object):
+    """
+     SQLite store of the decoded packets, indexed on the advertiser address, the
+     reception time and the channel. Packets are inserted in transactions of
+     'flush_packets' packets, at least every 'flush_interval' seconds; readers
+     (ble_query.py) can query the store while it is written (WAL journal).
+    """
+
+    def __init__(self, filename, flush_packets=STORE_FLUSH_PACKETS, flush_interval=PCAP_FLUSH_INTERVAL):
+        self.filename = filename
+        self.flush_packets = flush_packets
+        self.flush_interval = flush_interval
+        self.packets = 0
+        self.capture = None
+
+        self._pending = []
+        self._last_flush = time()
+        # Parser threads write under the capture lock, one connection is shared
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(STORE_SCHEMA)
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Start a capture, the following packets belong to it
+    def add_capture(self, iq_file, iq_format, sample_rate, start_ns):
+        cursor = self._db.execute('INSERT INTO captures (iq_file, iq_format, sample_rate, start_ns) VALUES (?, ?, ?, ?)',
+                                  (iq_file or None, iq_format, int(sample_rate), int(start_ns)))
+        self._db.commit()
+        self.capture = cursor.lastrowid
+        return self.capture
+
+    # Add a decoded packet (proto.parse_packet) received at 'timestamp_ns'
+    def write(self, packet, channel, start_frame, end_frame, freq, timestamp_ns):
+        address = adv_address(packet)
+        self._pending.append((int(timestamp_ns), self.capture, channel, packet.access_address,
+                              packet.pdu_type if packet.access_address == BLE_ACCESS_ADDR else None,
+                              _blob(address), _blob(bytes(bytearray(packet.data[:-BLE_CRC_LEN]))),
+                              int(start_frame), int(end_frame), int(freq)))
+        self.packets += 1
+        if len(self._pending) >= self.flush_packets:
+            self.flush()
+        else:
+            self.poll()
+
+    # Flush if the flush interval elapsed, to be called regularly by capture loops
+    def poll(self):
+        if self._pending and time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            with self._db:
+                self._db.executemany('INSERT INTO packets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self._pending)
+            self._pending = []
+        self._last_flush = time()
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+            print("{:d} BLE packets recorded into: {}".format(self.packets, self.filename))
+
+    def captures(self):
+        return dict((row[0], Capture(*row)) for row in self._db.execute('SELECT * FROM captures'))
+
+    # Packets matching all the given criteria, in time order
+    #
+    #       addresses   --- advertiser addresses (MSB first bytes, see hop_scheduler.parse_addresses)
+    #       channels, pdu_types, captures --- lists of accepted values
+    #       start_ns, end_ns --- reception time range [start_ns, end_ns)
+    def query(self, addresses=None, channels=None, start_ns=None, end_ns=None, pdu_types=None, access_address=None,
+              captures=None, limit=None):
+        where, args = self._where(addresses, channels, start_ns, end_ns, pdu_types, access_address, captures)
+        sql = 'SELECT * FROM packets' + where + ' ORDER BY time_ns'
+        if limit:
+            sql += ' LIMIT {:d}'.format(int(limit))
+        return [StoredPacket(row[0], row[1], row[2], row[3], row[4], _bytes(row[5]), _bytes(row[6]),
+                             row[7], row[8], row[9]) for row in self._db.execute(sql, args)]
+
+    # Number of packets matching the criteria of query()
+    def count(self, addresses=None, channels=None, start_ns=None, end_ns=None, pdu_types=None, access_address=None,
+              captures=None):
+        where, args = self._where(addresses, channels, start_ns, end_ns, pdu_types, access_address, captures)
+        return self._db.execute('SELECT COUNT(*) FROM packets' + where, args).fetchone()[0]
+
+    # Index and WHERE clause of a query: the most selective index of the criteria is forced,
+    # the query planner has no statistics on a store being written
+    @staticmethod
+    def _where(addresses, channels, start_ns, end_ns, pdu_types, access_address, captures):
+        clauses = []
+        args = []
+        if addresses:
+            index = ' INDEXED BY packets_adv_address'
+        elif channels:
+            index = ' INDEXED BY packets_channel'
+        elif start_ns is not None or end_ns is not None:
+            index = ' INDEXED BY packets_time'
+        else:
+            index = ''
+        for column, values in (('adv_address', [_blob(address) for address in addresses or []]),
+                               ('channel', channels), ('pdu_type', pdu_types), ('capture', captures)):
+            if values:
+                clauses.append('{} IN ({})'.format(column, ', '.join('?' * len(values))))
+                args.extend(values)
+        if start_ns is not None:
+            clauses.append('time_ns >= ?')
+            args.append(int(start_ns))
+        if end_ns is not None:
+            clauses.append('time_ns < ?')
+            args.append(int(end_ns))
+        if access_address is not None:
+            clauses.append('access_address = ?')
+            args.append(access_address)
+        return index + (' WHERE ' + ' AND '.join(clauses) if clauses else ''), args
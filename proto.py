@@ -12,10 +12,12 @@
 
 import csv
 import os
-import urllib2
+from bisect import bisect_right
+from collections import namedtuple
 from datetime import datetime, timedelta
+from stat import S_ISFIFO
 from struct import pack, unpack
-from time import time
+from time import mktime, time
 
 import numpy as np
 
@@ -38,6 +40,9 @@ BLE_PDU_TYPE['SCAN_RSP'] = 0b0100
 BLE_PDU_TYPE['CONNECT_REQ'] = 0b0101
 BLE_PDU_TYPE['ADV_SCAN_IND'] = 0b0110
 
+BLE_BASE_FREQ = 2402e6
+BLE_CHANNEL_SPACING = 2e6
+
 BLE_CHANS = {37: 0, 0: 1, 1: 2, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7, 7: 8, 8: 9, 9: 10, 10: 11, 38: 12, 11: 13, 12: 14, 13: 15, 14: 16, 15: 17, 16: 18, 17: 19, 18: 20,
              19: 21, 20: 22, 21: 23, 22: 24, 23: 25, 24: 26, 25: 27, 26: 28, 27: 29, 28: 30, 29: 31, 30: 32, 31: 33, 32: 34, 33: 35, 34: 36, 35: 37, 36: 38, 39: 39}
 
@@ -47,57 +52,324 @@ BLE_CHANS = {37: 0, 0: 1, 1: 2, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7, 7: 8, 8: 9, 9: 10,
 def swap_bits(value):
     return (value * 0x0202020202 & 0x010884422010) % 1023
 
-# (De)Whiten data based on BLE channel
+# Longest PDU payload (BLE 5 extended length)
+BLE_MAX_PDU_LEN = 255
 
+# Whitening covers the PDU header, payload and CRC
+BLE_WHITENING_LEN = BLE_PDU_HDR_LEN + BLE_MAX_PDU_LEN + BLE_CRC_LEN
 
-def dewhitening(data, channel):
-    ret = []
+BLE_CHANNELS_COUNT = 40
+
+# Compute the whitening keystream of a BLE channel with the bit-level LFSR
+
+
+def whitening_keystream(channel, length=BLE_WHITENING_LEN):
+    keystream = np.zeros(length, dtype=np.uint8)
     lfsr = swap_bits(channel) | 2
 
-    for d in data:
-        d = swap_bits(ord(d[:1]))
+    for n in range(length):
+        d = 0
         for i in 128, 64, 32, 16, 8, 4, 2, 1:
             if lfsr & 0x80:
                 lfsr ^= 0x11
                 d ^= i
 
-            lfsr <<= 1
-            i >>= 1
-        ret.append(swap_bits(d))
+            lfsr = (lfsr << 1) & 0xff
+        keystream[n] = swap_bits(d)
 
-    return ret
+    return keystream
+
+
+# Whitening keystreams of all BLE channels, built once on first use
+_whitening_table = None
+_whitening_extra = {}
+
+
+def whitening_table():
+    global _whitening_table
+
+    if _whitening_table is None:
+        _whitening_table = np.vstack([whitening_keystream(channel)
+                                      for channel in range(BLE_CHANNELS_COUNT)])
+        _whitening_table.flags.writeable = False
+    return _whitening_table
+
+# Get (at least) 'length' bytes of the cached keystream of a BLE channel
+
+
+def _cached_keystream(channel, length):
+    if 0 <= channel < BLE_CHANNELS_COUNT and length <= BLE_WHITENING_LEN:
+        return whitening_table()[channel]
+
+    keystream = _whitening_extra.get(channel)
+    if keystream is None or len(keystream) < length:
+        keystream = whitening_keystream(channel, max(length, BLE_WHITENING_LEN))
+        _whitening_extra[channel] = keystream
+    return keystream
+
+# View received data (str/bytes, bytearray, list or NumPy array) as uint8 array
+
+
+def as_bytes_array(data):
+    if isinstance(data, np.ndarray):
+        return data.astype(np.uint8, copy=False)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return np.frombuffer(data, dtype=np.uint8)
+    if isinstance(data, str):
+        return np.frombuffer(data.encode('latin-1'), dtype=np.uint8)
+    return np.array([ord(d) if isinstance(d, (bytes, str)) else d for d in data],
+                    dtype=np.uint8)
+
+# (De)Whiten data based on BLE channel, returns a uint8 array
+
+
+def dewhiten_array(data, channel):
+    data = as_bytes_array(data)
+    return data ^ _cached_keystream(channel, data.shape[-1])[:data.shape[-1]]
+
+# (De)Whiten a batch of candidates (2-D array, one candidate per row)
+
+
+def dewhiten_batch(data, channel):
+    if isinstance(data, np.ndarray):
+        data = np.atleast_2d(as_bytes_array(data))
+    else:
+        data = np.vstack([as_bytes_array(d) for d in data])
+    return dewhiten_array(data, channel)
+
+# (De)Whiten data based on BLE channel
+
+
+def dewhitening(data, channel):
+    return dewhiten_array(data, channel).tolist()
+
+# 24-bit CRC (polynomial x^24 + x^10 + x^9 + x^6 + x^4 + x^3 + x + 1)
+BLE_CRC_INIT = 0x555555
+BLE_CRC_POLY = 0x00065b
+
+# Byte-wise CRC lookup table, input bytes are fed LSB first
+
+
+def _crc_table():
+    table = np.zeros(256, dtype=np.uint32)
+    for n in range(256):
+        value = n << 16
+        for _ in range(8):
+            if value & 0x800000:
+                value = (value << 1) ^ BLE_CRC_POLY
+            else:
+                value <<= 1
+        table[n] = value & 0xffffff
+    return table
 
-# 24-bit CRC function
 
+CRC_TABLE = _crc_table()
+CRC_TABLE.flags.writeable = False
 
-def crc(data, length, init=0x555555):
-    ret = [(init >> 16) & 0xff, (init >> 8) & 0xff, init & 0xff]
+# Bit reversal of all 8-bit values
+SWAP_BITS_TABLE = np.array([swap_bits(n) for n in range(256)], dtype=np.uint8)
+SWAP_BITS_TABLE.flags.writeable = False
+
+# Plain lists are faster than NumPy scalars for the per-packet path
+_crc_table_list = CRC_TABLE.tolist()
+_swap_bits_list = SWAP_BITS_TABLE.tolist()
+
+# Compute the raw 24-bit CRC register (MSB first) over data[:length]
+
+
+def crc24(data, length, init=BLE_CRC_INIT):
+    table = _crc_table_list
+    swap = _swap_bits_list
+    value = init & 0xffffff
+
+    if not isinstance(data, list):
+        data = as_bytes_array(data).tolist()
 
     for d in data[:length]:
-        for v in range(8):
-            t = (ret[0] >> 7) & 1
+        value = ((value << 8) & 0xffffff) ^ table[(value >> 16) ^ swap[d]]
+
+    return value
+
+# Convert a CRC register into the 3 bytes sent over the air
+
+
+def crc_bytes(value):
+    return [swap_bits((value >> 16) & 0xff), swap_bits((value >> 8) & 0xff), swap_bits(value & 0xff)]
+
+# 24-bit CRC function
+
+
+def crc(data, length, init=BLE_CRC_INIT):
+    return crc_bytes(crc24(data, length, init))
+
+# Check the CRC of a batch of candidate PDUs at once
+#   pdus:    2-D uint8 array, one dewhitened candidate per row (header, payload, CRC)
+#   lengths: header + payload length of each candidate (CRC follows)
+# Returns a boolean pass/fail mask
+
+
+def crc_check_batch(pdus, lengths, init=BLE_CRC_INIT):
+    pdus = np.atleast_2d(as_bytes_array(pdus))
+    lengths = np.asarray(lengths, dtype=np.intp)
+    rows = np.arange(pdus.shape[0])
+
+    valid = lengths + BLE_CRC_LEN <= pdus.shape[1]
+    if not valid.any():
+        return valid
+    lengths = np.where(valid, lengths, 0)
+
+    value = np.full(pdus.shape[0], init & 0xffffff, dtype=np.uint32)
+    for n in range(int(lengths.max()) if len(lengths) else 0):
+        active = n < lengths
+        index = (value >> 16) ^ SWAP_BITS_TABLE[pdus[:, n]]
+        update = ((value << 8) & 0xffffff) ^ CRC_TABLE[index]
+        value = np.where(active, update, value)
+
+    received = np.zeros(pdus.shape[0], dtype=np.uint32)
+    for n in range(BLE_CRC_LEN):
+        column = np.minimum(lengths + n, pdus.shape[1] - 1)
+        byte = SWAP_BITS_TABLE[pdus[rows, column]].astype(np.uint32)
+        received |= byte << (8 * (BLE_CRC_LEN - 1 - n))
+
+    return valid & (received == value)
+
+
+# Packet layout in bits, as sent over the air (each byte LSB first)
+BLE_SYNC_BITS = (BLE_PREAMBLE_LEN + BLE_ADDR_LEN) * 8
+BLE_MAX_PACKET_BITS = (BLE_PREAMBLE_LEN + BLE_ADDR_LEN +
+                       BLE_PDU_HDR_LEN + BLE_MAX_PDU_LEN + BLE_CRC_LEN) * 8
+
+# Number of leading sync bits checked on every offset before the full match
+_SYNC_PREFILTER_BITS = 16
+
+BLE_ADV_PDU_TYPES = [BLE_PDU_TYPE[t]
+                     for t in ['ADV_IND', 'ADV_DIRECT_IND', 'ADV_NONCONN_IND']]
+
+BlePacket = namedtuple('BlePacket', ['bit_index', 'access_address', 'pdu_type', 'length', 'data', 'aa_errors'])
+
+# Pack unpacked bits (one bit per byte, LSB first) into bytes
+
+
+def pack_bits(bits):
+    bits = as_bytes_array(bits)
+    bits = bits[:len(bits) // 8 * 8].reshape(-1, 8)
+    return np.packbits(bits[:, ::-1], axis=1).ravel()
+
+# Unpack bytes into bits (one bit per byte, LSB first)
+
+
+def unpack_bits(data):
+    data = as_bytes_array(data)
+    return np.unpackbits(data.reshape(-1, 1), axis=1)[:, ::-1].ravel()
+
+# Preamble and access address bits, the preamble alternates with the first access address bit
+
+
+def sync_bits(access_address=BLE_ACCESS_ADDR):
+    preamble = 0x55 if access_address & 1 else 0xAA
+    return unpack_bits(bytearray(pack('<BI', preamble, access_address)))
 
-            ret[0] <<= 1
-            if ret[1] & 0x80:
-                ret[0] |= 1
+# Find the bit offsets of preamble + access address patterns with at most
+# 'max_errors' bit errors, only offsets below 'stop' are reported
 
-            ret[1] <<= 1
-            if ret[2] & 0x80:
-                ret[1] |= 1
 
-            ret[2] <<= 1
+def find_access_address(bits, access_address=BLE_ACCESS_ADDR, max_errors=0, stop=None):
+    bits = as_bytes_array(bits)
+    pattern = sync_bits(access_address)
+    count = len(bits) - BLE_SYNC_BITS + 1
+    if stop is not None:
+        count = min(count, stop)
+    if count <= 0:
+        return np.zeros(0, dtype=np.intp)
 
-            if d & 1 != t:
-                ret[2] ^= 0x5b
-                ret[1] ^= 0x06
+    # Access address bits are the most selective, start with the first ones on every offset
+    errors = np.zeros(count, dtype=np.uint8)
+    first = BLE_PREAMBLE_LEN * 8
+    for n in range(first, first + _SYNC_PREFILTER_BITS):
+        errors += bits[n:n + count] != pattern[n]
+    candidates = np.flatnonzero(errors <= max_errors)
+    if not len(candidates):
+        return candidates
 
-            d >>= 1
+    # Check the remaining bits on the candidates only
+    rest = np.r_[0:first, first + _SYNC_PREFILTER_BITS:BLE_SYNC_BITS]
+    window = bits[candidates[:, None] + rest[None, :]]
+    errors = errors[candidates] + np.count_nonzero(window != pattern[rest], axis=1)
+    return candidates[errors <= max_errors]
 
-    ret[0] = swap_bits((ret[0] & 0xFF))
-    ret[1] = swap_bits((ret[1] & 0xFF))
-    ret[2] = swap_bits((ret[2] & 0xFF))
+# Decode the BLE packet starting (preamble) at bit offset 'pos', 'access_address' being the
+# access address find_access_address matched there: it classifies the packet, the received
+# one may differ by the tolerated bit errors (counted into BlePacket.aa_errors)
+# Returns a (status, packet) tuple, status being 'ok' or the error name. The
+# dewhitening and CRC times are recorded into 'metrics' (see metrics.Metrics) if given
 
-    return ret
+
+def parse_packet(bits, pos, channel, dewhiten=True, check_crc=True, crc_init=BLE_CRC_INIT, metrics=None,
+                 access_address=BLE_ACCESS_ADDR):
+    bits = as_bytes_array(bits)
+    pos = int(pos)
+    hdr_pos = pos + BLE_SYNC_BITS
+
+    if len(bits) < hdr_pos + BLE_PDU_HDR_LEN * 8:
+        return 'err_len', None
+
+    # Bit errors of the received BLE Access Address
+    received_access_address = unpack('<I', pack_bits(bits[pos + BLE_PREAMBLE_LEN * 8:hdr_pos]).tobytes())[0]
+    ble_aa_errors = bin(received_access_address ^ access_address).count('1')
+
+    # Dewhitening received BLE Header
+    ble_header = pack_bits(bits[hdr_pos:hdr_pos + BLE_PDU_HDR_LEN * 8])
+    if dewhiten:
+        ble_header = dewhiten_array(ble_header, channel)
+
+    # Check BLE PDU type
+    ble_pdu_type = int(ble_header[0]) & 0x0f
+    if ble_pdu_type not in BLE_PDU_TYPE.values():
+        return 'err_pdu', None
+
+    if access_address == BLE_ACCESS_ADDR:
+        # Extract BLE Length
+        ble_len = int(ble_header[1]) & 0x3f
+    else:
+        ble_llid = int(ble_header[0]) & 0x3
+        if ble_llid == 0:
+            return 'err_llid', None
+
+        # Extract BLE Length
+        ble_len = int(ble_header[1]) & 0x1f
+
+    # Verify BLE data length
+    end = hdr_pos + (BLE_PDU_HDR_LEN + ble_len + BLE_CRC_LEN) * 8
+    if len(bits) < end:
+        return 'err_len', None
+
+    # Dewhitening BLE packet
+    started = time() if metrics else 0
+    ble_data = pack_bits(bits[hdr_pos:end])
+    if dewhiten:
+        ble_data = dewhiten_array(ble_data, channel)
+    ble_data = ble_data.tolist()
+    if metrics:
+        metrics.observe('dewhiten', time() - started)
+
+    # Verify BLE packet checksum
+    if check_crc:
+        if access_address == BLE_ACCESS_ADDR:
+            crc_init = BLE_CRC_INIT
+        started = time() if metrics else 0
+        valid = ble_data[-3:] == crc(ble_data, BLE_PDU_HDR_LEN + ble_len, crc_init)
+        if metrics:
+            metrics.observe('crc', time() - started)
+        if not valid:
+            return 'err_crc', None
+
+    return 'ok', BlePacket(pos, access_address, ble_pdu_type, ble_len, ble_data, ble_aa_errors)
+
+# Length of a BLE packet in bits, from the preamble to the CRC
+
+
+def packet_bits(packet):
+    return (BLE_PREAMBLE_LEN + BLE_ADDR_LEN + BLE_PDU_HDR_LEN + BLE_CRC_LEN + packet.length) * 8
 
 
 # PCAP Header constants
@@ -109,43 +381,408 @@ PCAP_SIG = 0
 PCAP_SNAPLEN = 0xffff
 PCAP_NETWORK = 256
 
-# Open PCAP file descriptor
+# PCAPNG block types and options
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_COMMENT = 1
+PCAPNG_IF_TSRESOL = 9
 
+# Default flush policy of PcapWriter
+PCAP_FLUSH_PACKETS = 64
+PCAP_FLUSH_BYTES = 1 << 16
+PCAP_FLUSH_INTERVAL = 1.0
 
-def open_pcap(filename):
-    pcap_fd = open(filename, 'wb')
+# PCAP file header
 
-    # Write PCAP file header
-    pcap_fd.write(pack('<LHHLLLL', PCAP_MAGIC, PCAP_MAJOR,
-                       PCAP_MINOR, PCAP_ZONE, PCAP_SIG, PCAP_SNAPLEN, PCAP_NETWORK))
-    return pcap_fd
 
-# Write BLE packet to PCAP fd
+def pcap_header():
+    return pack('<LHHLLLL', PCAP_MAGIC, PCAP_MAJOR,
+                PCAP_MINOR, PCAP_ZONE, PCAP_SIG, PCAP_SNAPLEN, PCAP_NETWORK)
 
+# BLE pseudo header and packet (PCAP_NETWORK link type), 'aa_errors' being the
+# access address offenses (bit errors of the received access address)
 
-def write_pcap(fd, ble_channel, ble_access_address, ble_data):
-    now = time()
-    sec = int(now)
-    usec = int((now - sec) * 1000000)
-    ble_len = int(len(ble_data) + 14)
+
+def pcap_packet(ble_channel, ble_access_address, ble_data, aa_errors=0):
     ble_flags = 0x3c37
+    return pack('<BBBBLHL', BLE_CHANS[ble_channel], 0xff, 0xff, min(aa_errors, 0xff), ble_access_address,
+                ble_flags, ble_access_address) + bytes(bytearray(ble_data))
+
+# PCAPNG option, padded to 32 bits
+
+
+def pcapng_option(code, value):
+    return pack('<HH', code, len(value)) + value + b'\0' * (-len(value) % 4)
+
+# PCAPNG block with its type and total length around the body
+
+
+def pcapng_block(block_type, body):
+    length = len(body) + 12
+    return pack('<LL', block_type, length) + body + pack('<L', length)
+
+# PCAPNG section header and BLE interface with nanosecond timestamps
+
 
-    # Write PCAP packet header
-    fd.write(pack('<LLLLBBBBLHL', sec, usec, ble_len, ble_len,
-                  BLE_CHANS[ble_channel], 0xff, 0xff, 0x00, ble_access_address, ble_flags, ble_access_address))
+def pcapng_header():
+    shb = pcapng_block(PCAPNG_SHB, pack('<LHHq', PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1))
+    idb = pcapng_block(PCAPNG_IDB, pack('<HHL', PCAP_NETWORK, 0, PCAP_SNAPLEN) +
+                       pcapng_option(PCAPNG_IF_TSRESOL, pack('<B', 9)) +
+                       pcapng_option(PCAPNG_OPT_ENDOFOPT, b''))
+    return shb + idb
+
+# PCAPNG enhanced packet block of a BLE packet, 'timestamp_ns' in nanoseconds
+
+
+def pcapng_record(ble_channel, ble_access_address, ble_data, timestamp_ns, comment=None, aa_errors=0):
+    data = pcap_packet(ble_channel, ble_access_address, ble_data, aa_errors)
+    body = pack('<LLLLL', 0, timestamp_ns >> 32, timestamp_ns & 0xffffffff, len(data), len(data))
+    body += data + b'\0' * (-len(data) % 4)
+    if comment:
+        body += pcapng_option(PCAPNG_OPT_COMMENT, comment.encode('utf-8')) + \
+            pcapng_option(PCAPNG_OPT_ENDOFOPT, b'')
+    return pcapng_block(PCAPNG_EPB, body)
+
+# Current time in nanoseconds
+
+
+def time_ns():
+    return int(time() * 1000000) * 1000
+
+# Time in nanoseconds of an IQ sample, 'start_ns' being the time of sample 0
+
+
+def sample_time_ns(start_ns, sample, sample_rate):
+    return start_ns + int(sample) * 1000000000 // int(sample_rate)
+
+
+class PcapWriter(object):
+    """
+     Buffered PCAP or PCAPNG writer. Records are written once 'flush_packets'
+     packets or 'flush_bytes' bytes are pending or 'flush_interval' seconds
+     passed since the last write. Named pipes (FIFO) read by Wireshark are
+     flushed on every packet unless 'low_latency' is set to False.
 
-    # Write BLE packet
-    fd.write(''.join(chr(x) for x in ble_data))
-    fd.flush()
+            pcapng      --- PCAPNG output, nanosecond timestamps and packet comments
+    """
 
-# Record start/end of BLE packets, channel frequency and sample rate  into a csv file
-def record_ble_iq_information(start_frame, end_frame, freq, sample_rate, csv_file):
-    try:
-        t = datetime.now()
-        with open(csv_file, 'a+') as file:
-            writer = csv.writer(file)
+    def __init__(self, filename, pcapng=False, flush_packets=PCAP_FLUSH_PACKETS, flush_bytes=PCAP_FLUSH_BYTES,
+                 flush_interval=PCAP_FLUSH_INTERVAL, low_latency=None):
+        if low_latency is None:
+            low_latency = os.path.exists(filename) and S_ISFIFO(os.stat(filename).st_mode)
+        self.pcapng = pcapng
+        self.flush_packets = 1 if low_latency else flush_packets
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.packets = 0
+        self.bytes = 0
+
+        self._fd = open(filename, 'wb')
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = time()
+        self._fd.write(pcapng_header() if pcapng else pcap_header())
+        self._fd.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Add a BLE packet, 'timestamp_ns' being its reception time (nanoseconds since the epoch).
+    # The comment (e.g. the IQ sample index) is only written to PCAPNG files, 'aa_errors'
+    # goes to the access address offenses of the pseudo header
+    def write(self, ble_channel, ble_access_address, ble_data, timestamp_ns=None, comment=None, aa_errors=0):
+        timestamp_ns = time_ns() if timestamp_ns is None else timestamp_ns
+        if self.pcapng:
+            record = pcapng_record(ble_channel, ble_access_address, ble_data, timestamp_ns, comment, aa_errors)
+        else:
+            data = pcap_packet(ble_channel, ble_access_address, ble_data, aa_errors)
+            record = pack('<LLLL', timestamp_ns // 1000000000, timestamp_ns % 1000000000 // 1000,
+                          len(data), len(data)) + data
+        self._pending.append(record)
+        self._pending_bytes += len(record)
+        self.packets += 1
+        self.bytes += len(record)
+        if len(self._pending) >= self.flush_packets or self._pending_bytes >= self.flush_bytes:
+            self.flush()
+        else:
+            self.poll()
+
+    # Flush if the flush interval elapsed, to be called regularly by capture loops
+    def poll(self):
+        if self._pending and time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._fd.write(b''.join(self._pending))
+            self._pending = []
+            self._pending_bytes = 0
+        self._fd.flush()
+        self._last_flush = time()
+
+    def close(self):
+        if not self._fd.closed:
+            self.flush()
+            self._fd.close()
+
+# Packet index: CSV columns, and record of the binary format (little endian, fixed width)
+# which can be memory-mapped after its magic
+PACKET_CSV_FIELDS = ['Time', 'Start_trame', 'End_trame', 'Channel_frequency', 'Sample_rate']
+PACKET_INDEX_MAGIC = b'BLEIDX01'
+PACKET_INDEX_FORMAT = '<qqqLLBx6s'
+PACKET_INDEX_DTYPE = np.dtype([('time_ns', '<i8'), ('start_frame', '<i8'), ('end_frame', '<i8'),
+                               ('frequency', '<u4'), ('sample_rate', '<u4'), ('channel', 'u1'),
+                               ('reserved', 'u1'), ('adv_address', 'u1', (6,))])
+PACKET_INDEX_NO_CHANNEL = 0xff
+
+# Advertiser address (AdvA) of an advertising channel PDU, most significant byte first
+
+
+def adv_address(packet):
+    if packet.access_address != BLE_ACCESS_ADDR:
+        return None
+    # SCAN_REQ and CONNECT_REQ start with the address of the scanner/initiator
+    pos = 8 if packet.pdu_type in (BLE_PDU_TYPE['SCAN_REQ'], BLE_PDU_TYPE['CONNECT_REQ']) else 2
+    address = bytearray(packet.data[pos:pos + 6])
+    if len(address) < 6:
+        return None
+    return bytes(bytearray(reversed(address)))
+
+# Local time of a timestamp in nanoseconds, and back
+
+
+def ns_to_datetime(timestamp_ns):
+    return datetime.fromtimestamp(timestamp_ns // 1000000000) + \
+        timedelta(microseconds=timestamp_ns % 1000000000 // 1000)
+
+
+def datetime_to_ns(t):
+    return int(mktime(t.timetuple())) * 1000000000 + t.microsecond * 1000
+
+
+# Local times ('%Y-%m-%d %H:%M:%S[.%f]' strings) as nanoseconds since the epoch, parsed
+# at once. The UTC offset is looked up once per distinct hour
+
+
+def parse_times_ns(times):
+    local = np.array(times, dtype='datetime64[us]')
+    hours, inverse = np.unique(local.astype('datetime64[h]'), return_inverse=True)
+    offsets = np.array([int(mktime(hour.item().timetuple())) * 1000000 - hour.astype('datetime64[us]').astype(np.int64)
+                        for hour in hours], dtype=np.int64)
+    return (local.astype(np.int64) + offsets[inverse.ravel()]) * 1000
+
+
+class PacketIndexWriter(object):
+    """
+     Long-lived writer of the packet index (start/end sample, channel frequency and
+     sample rate of each decoded packet). The file is kept open and flushed every
+     'flush_packets' packets or 'flush_interval' seconds.
+
+            binary      --- fixed-width PACKET_INDEX_FORMAT records instead of CSV rows,
+                            see read_packet_index
+    """
+
+    def __init__(self, filename, binary=False, flush_packets=PCAP_FLUSH_PACKETS, flush_interval=PCAP_FLUSH_INTERVAL):
+        self.filename = filename
+        self.binary = binary
+        self.flush_packets = flush_packets
+        self.flush_interval = flush_interval
+        self.packets = 0
+
+        self._pending = 0
+        self._last_flush = time()
+        if binary:
+            self._fd = open(filename, 'wb')
+            self._fd.write(PACKET_INDEX_MAGIC)
+        else:
+            self._fd = open(filename, 'w')
+            self._writer = csv.writer(self._fd)
+            self._writer.writerow(PACKET_CSV_FIELDS)
+        self._fd.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Add a packet, 'timestamp_ns' being its reception time (nanoseconds since the epoch).
+    # BLE channel and advertiser address are only recorded in the binary format
+    def write(self, start_frame, end_frame, freq, sample_rate, timestamp_ns=None, channel=PACKET_INDEX_NO_CHANNEL, address=None):
+        timestamp_ns = time_ns() if timestamp_ns is None else timestamp_ns
+        if self.binary:
+            self._fd.write(pack(PACKET_INDEX_FORMAT, timestamp_ns, int(start_frame), int(end_frame), int(freq),
+                                int(sample_rate), channel, address or b'\0' * 6))
+        else:
             # time,start_frame,end_frame,frequency,sample_rate
-            writer.writerow([t,start_frame, end_frame, freq, sample_rate])
-        print(" BLE packet information recorded into:", csv_file)
-    except IOError:
-        pass
+            self._writer.writerow([ns_to_datetime(timestamp_ns), start_frame, end_frame, freq, sample_rate])
+        self.packets += 1
+        self._pending += 1
+        if self._pending >= self.flush_packets:
+            self.flush()
+        else:
+            self.poll()
+
+    # Flush if the flush interval elapsed, to be called regularly by capture loops
+    def poll(self):
+        if self._pending and time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._fd.flush()
+        self._pending = 0
+        self._last_flush = time()
+
+    def close(self):
+        if not self._fd.closed:
+            self._fd.close()
+            print("{:d} BLE packet information recorded into: {}".format(self.packets, self.filename))
+
+# Read a packet index, binary (memory-mapped) or CSV, as a PACKET_INDEX_DTYPE array
+
+
+def read_packet_index(filename):
+    with open(filename, 'rb') as fd:
+        binary = fd.read(len(PACKET_INDEX_MAGIC)) == PACKET_INDEX_MAGIC
+    if binary:
+        if os.path.getsize(filename) == len(PACKET_INDEX_MAGIC):
+            return np.zeros(0, dtype=PACKET_INDEX_DTYPE)
+        return np.memmap(filename, dtype=PACKET_INDEX_DTYPE, mode='r', offset=len(PACKET_INDEX_MAGIC))
+
+    channels = dict((int(ble_channel_freq(channel)), channel) for channel in BLE_CHANS)
+    with open(filename) as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    index = np.zeros(len(rows), dtype=PACKET_INDEX_DTYPE)
+    if rows:
+        index['time_ns'] = parse_times_ns([row['Time'] for row in rows])
+        index['start_frame'] = np.array([row['Start_trame'] for row in rows], dtype=np.float64)
+        index['end_frame'] = np.array([row['End_trame'] for row in rows], dtype=np.float64)
+        index['frequency'] = np.array([row['Channel_frequency'] for row in rows], dtype=np.float64)
+        index['sample_rate'] = np.array([row['Sample_rate'] for row in rows], dtype=np.float64)
+        index['channel'] = [channels.get(freq, PACKET_INDEX_NO_CHANNEL) for freq in index['frequency']]
+    return index
+
+# IQ file formats: interleaved I/Q values of 'dtype', a sample of magnitude 1.0
+# is stored as +/-'scale' (the USRP conversion of sc16/sc8 samples to fc32)
+IqFormat = namedtuple('IqFormat', ['name', 'dtype', 'scale', 'sigmf_datatype'])
+
+IQ_FORMATS = {
+    'cf32': IqFormat('cf32', np.dtype('<f4'), 1.0, 'cf32_le'),
+    'sc16': IqFormat('sc16', np.dtype('<i2'), 32767.0, 'ci16_le'),
+    'sc8': IqFormat('sc8', np.dtype('i1'), 127.0, 'ci8'),
+}
+IQ_FORMAT_DEFAULT = 'cf32'
+
+# Format of an IQ file, given by 'name' or else by the file extension (.cf32, .sc16, .sc8)
+
+
+def iq_format(iq_file='', name=None):
+    if not name:
+        name = os.path.splitext(iq_file)[1].lstrip('.').lower()
+        if name not in IQ_FORMATS:
+            name = IQ_FORMAT_DEFAULT
+    return IQ_FORMATS[name]
+
+# Bytes per IQ sample of a format
+
+
+def iq_sample_size(fmt):
+    return 2 * fmt.dtype.itemsize
+
+# Convert interleaved I/Q values of a format to complex64 samples
+
+
+def iq_to_complex(values, fmt):
+    values = np.ascontiguousarray(values).reshape(-1)
+    if fmt.dtype == np.float32:
+        return values.view(np.complex64)
+    return (values.astype(np.float32) * np.float32(1.0 / fmt.scale)).view(np.complex64)
+
+# Convert complex samples to interleaved I/Q values of a format, rounded and clipped
+
+
+def iq_from_complex(samples, fmt):
+    values = np.ascontiguousarray(samples, dtype=np.complex64).reshape(-1).view(np.float32)
+    if fmt.dtype == np.float32:
+        return values
+    limits = np.iinfo(fmt.dtype)
+    return np.clip(np.rint(values * np.float32(fmt.scale)), limits.min, limits.max).astype(fmt.dtype)
+
+# Map an IQ file without loading it, as a (samples, 2) array of I/Q values
+
+
+def map_iq(iq_file, fmt=None):
+    fmt = fmt or iq_format(iq_file)
+    samples = os.path.getsize(iq_file) // iq_sample_size(fmt)
+    if not samples:
+        return np.zeros((0, 2), dtype=fmt.dtype)
+    return np.memmap(iq_file, dtype=fmt.dtype, mode='r', shape=(samples, 2))
+
+# Capture start time of an IQ file, estimated from its modification time
+
+
+def capture_start(iq_file, sample_rate, fmt=None):
+    fmt = fmt or iq_format(iq_file)
+    return os.path.getmtime(iq_file) - os.path.getsize(iq_file) / float(iq_sample_size(fmt)) / sample_rate
+
+# Center frequency of a BLE channel
+
+
+def ble_channel_freq(channel):
+    return BLE_BASE_FREQ + BLE_CHANNEL_SPACING * BLE_CHANS[channel]
+
+# File recording the channel hops of an IQ capture
+
+
+def hops_file(iq_file):
+    return iq_file.split('.')[0] + '-hops.csv'
+
+# Packet index file of an IQ capture (CSV or binary)
+
+
+def packet_index_file(iq_file, binary=False):
+    return iq_file.split('.')[0] + ('.idx' if binary else '.csv')
+
+# Read the channel hops of an IQ capture as (start sample, BLE channel) tuples,
+# from its hop file or else deduced from the packets recorded in its packet index
+
+
+def read_hops(iq_file):
+    hops = []
+    packets_files = [name for name in (packet_index_file(iq_file), packet_index_file(iq_file, True))
+                     if os.path.exists(name)]
+    if os.path.exists(hops_file(iq_file)):
+        with open(hops_file(iq_file)) as csvfile:
+            for row in csv.DictReader(csvfile):
+                hops.append((float(row['Start_trame']), int(row['Channel'])))
+    elif packets_files:
+        for record in read_packet_index(packets_files[0]):
+            channel = int(record['channel'])
+            if channel != PACKET_INDEX_NO_CHANNEL and (not hops or hops[-1][1] != channel):
+                hops.append((float(record['start_frame']), channel))
+    return hops
+
+# Frequency offsets of the BLE channel below the capture center at each hop of an IQ capture,
+# as (start sample, offset) tuples; empty if its hop file does not record them
+
+
+def read_hop_offsets(iq_file):
+    offsets = []
+    if os.path.exists(hops_file(iq_file)):
+        with open(hops_file(iq_file)) as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row.get('Freq_offset'):
+                    offsets.append((float(row['Start_trame']), float(row['Freq_offset'])))
+    return offsets
+
+# BLE channel of a capture at a given sample, 'starts' being the hop start samples
+
+
+def hop_channel(hops, starts, sample):
+    return hops[max(0, bisect_right(starts, sample) - 1)][1]
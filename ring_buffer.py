@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  ble-dump: receive buffer for the Gnu Radio message queue
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import threading
+from collections import deque
+
+import numpy as np
+
+# What MessageReader does with a message when its buffer is full
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+
+class RingBuffer(object):
+    """
+     Preallocated ring buffer of bytes for a continuous stream, keeping a carry-over
+     tail of 'tail_len' bytes between two parsing passes. Every byte is stored twice,
+     at its ring position and one capacity further (mirror), so that the buffered
+     bytes are always contiguous: array() is a view, consume() only moves the head.
+
+            offset      --- stream index of the first buffered byte
+    """
+
+    def __init__(self, tail_len, capacity=1 << 16):
+        self.tail_len = tail_len
+        self.offset = 0
+        self._head = 0
+        self._length = 0
+        self._allocate(max(capacity, 2 * tail_len))
+
+    # Allocate a ring of 'capacity' bytes (and its mirror), the buffered bytes move to its start
+    def _allocate(self, capacity):
+        data = bytearray(2 * capacity)
+        if self._length:
+            data[:self._length] = self._data[self._head:self._head + self._length]
+            data[capacity:capacity + self._length] = data[:self._length]
+        self._capacity = capacity
+        self._head = 0
+        self._data = data
+        self._view = memoryview(data)
+        self._array = np.frombuffer(data, dtype=np.uint8)
+
+    def __len__(self):
+        return self._length
+
+    # Number of bytes which can be parsed, the tail is kept for the next pass
+    @property
+    def ready(self):
+        return max(0, self._length - self.tail_len)
+
+    # Append received data (str/bytes, bytearray, memoryview or NumPy array)
+    def append(self, data):
+        count = len(data)
+        if self._length + count > self._capacity:
+            # Only grows up to the largest message plus the tail
+            self._allocate(max(2 * self._capacity, self._length + count))
+        capacity = self._capacity
+        tail = (self._head + self._length) % capacity
+        first = min(count, capacity - tail)
+        for start in (tail, tail + capacity):
+            self._view[start:start + first] = data[:first]
+        if count > first:
+            for start in (0, capacity):
+                self._view[start:start + count - first] = data[first:]
+        self._length += count
+
+    # Buffered data as uint8 array, valid until the next append/consume
+    def array(self):
+        return self._array[self._head:self._head + self._length]
+
+    # Drop the first 'count' bytes
+    def consume(self, count):
+        count = min(count, self._length)
+        self._head = (self._head + count) % self._capacity
+        self._length -= count
+        self.offset += count
+
+    # Skip 'count' bytes lost from the stream, once the buffer is empty
+    def skip(self, count):
+        assert not self._length
+        self.offset += count
+
+
+class MessageReader(object):
+    """
+     Reader thread draining a Gnu Radio message queue into a buffer of 'depth'
+     messages read by the parser, so that parser stalls do not hold up the
+     flowgraph. When the buffer is full, 'policy' decides:
+
+            block       --- the reader waits, the flowgraph waits behind it
+            drop-oldest --- the oldest buffered message is dropped
+            drop-newest --- the received message is dropped
+
+     get() returns the bytes dropped before each message, stream indexes stay exact.
+     Messages of 'tag_type' (stream tags sent along the data) are never dropped, they
+     are appended to 'tags'.
+
+            dropped_messages, dropped_bytes --- messages dropped by the policy
+            high_water      --- largest number of buffered messages
+    """
+
+    def __init__(self, message_queue, depth=256, policy='block', tag_type=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy: {}'.format(policy))
+        self.message_queue = message_queue
+        self.depth = max(1, depth)
+        self.policy = policy
+        self.tag_type = tag_type
+        self.tags = deque()
+        self.messages = 0
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.high_water = 0
+
+        # [data, bytes dropped before data]
+        self._buffer = deque()
+        self._gap = 0
+        self._eof = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _run(self):
+        while True:
+            message = self.message_queue.delete_head()
+            with self._cond:
+                if message.type() == 1:
+                    self._eof = True
+                    self._cond.notify_all()
+                    return
+                if message.type() == self.tag_type:
+                    self.tags.append(message.to_string())
+                    continue
+                self._put(message.to_string())
+                self._cond.notify_all()
+
+    def _put(self, data):
+        self.messages += 1
+        if len(self._buffer) >= self.depth:
+            if self.policy == 'block':
+                while len(self._buffer) >= self.depth:
+                    self._cond.wait()
+            elif self.policy == 'drop-newest':
+                self._drop(len(data))
+                self._gap += len(data)
+                return
+            else:
+                old, gap = self._buffer.popleft()
+                self._drop(len(old))
+                if self._buffer:
+                    self._buffer[0][1] += gap + len(old)
+                else:
+                    self._gap += gap + len(old)
+        self._buffer.append([data, self._gap])
+        self._gap = 0
+        self.high_water = max(self.high_water, len(self._buffer))
+
+    def _drop(self, count):
+        self.dropped_messages += 1
+        self.dropped_bytes += count
+
+    # Next message as (data, bytes dropped before it), (None, 0) at the end of the stream
+    def get(self):
+        with self._cond:
+            while not self._buffer:
+                if self._eof:
+                    return None, 0
+                # Timeout: a plain wait cannot be interrupted (Python 2)
+                self._cond.wait(0.5)
+            data, gap = self._buffer.popleft()
+            self._cond.notify_all()
+            return data, gap
+
+    # Put a message back in front of the buffer
+    def unget(self, data, gap=0):
+        with self._cond:
+            self._buffer.appendleft([data, gap])
+
+
+class SampleRing(object):
+    """
+     Circular buffer holding the last 'capacity' IQ samples of a stream, filled by
+     a reader thread while packets are read back by the parser.
+
+            end         --- stream index of the next sample
+    """
+
+    def __init__(self, capacity, dtype=np.complex64):
+        self.capacity = capacity
+        self.end = 0
+        self._data = np.zeros(capacity, dtype=dtype)
+        self._lock = threading.Lock()
+
+    # Append samples (NumPy array or raw bytes of the ring dtype)
+    def append(self, samples):
+        if not isinstance(samples, np.ndarray):
+            samples = np.frombuffer(samples, dtype=self._data.dtype)
+        with self._lock:
+            # Only the last 'capacity' samples are kept
+            first = self.end + max(0, len(samples) - self.capacity)
+            samples = samples[-self.capacity:]
+            pos = first % self.capacity
+            count = min(len(samples), self.capacity - pos)
+            self._data[pos:pos + count] = samples[:count]
+            self._data[:len(samples) - count] = samples[count:]
+            self.end = first + len(samples)
+
+    # Stream index of the oldest held sample
+    @property
+    def start(self):
+        return max(0, self.end - self.capacity)
+
+    # Copy of samples [start, stop), None if they are not all held
+    def read(self, start, stop):
+        with self._lock:
+            if start < self.start or stop > self.end or stop < start:
+                return None
+            pos = start % self.capacity
+            count = stop - start
+            if pos + count <= self.capacity:
+                return self._data[pos:pos + count].copy()
+            return np.concatenate((self._data[pos:], self._data[:pos + count - self.capacity]))
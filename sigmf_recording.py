@@ -1,74 +1,219 @@
 #!/usr/bin/python3 -u
 
 import csv
+import json
+import os
+import tarfile
+import tempfile
+from datetime import datetime, timedelta
 from optparse import OptionGroup, OptionParser
-import sigmf
-from sigmf import sigmffile, utils
-from sigmf.sigmffile import SigMFFile, fromarchive
+
+import numpy as np
+
+from proto import IQ_FORMATS, IQ_FORMAT_DEFAULT, parse_times_ns
 
 # SigMF fields for global info
 global_info = {
-    'core:datatype': 'cf32',
+    'core:datatype': 'cf32_le',
     'core:version': '0.0.1',
     'core:description': 'Metadafile for a SigMF recording of BLE Advertising packets.'
 }
 
-# Add Capture settings to SigMfile
+
+# SigMF global info of a recording in an IQ format (proto.IQ_FORMATS). Integer
+# samples record their scale: a sample of magnitude 1.0 is stored as +/-scale
+
+
+def recording_global_info(fmt):
+    info = dict(global_info)
+    info['core:datatype'] = fmt.sigmf_datatype
+    if fmt.dtype.kind == 'i':
+        info['ble_dump:scale'] = fmt.scale
+    return info
+
+
+# SigMF time (UTC, ISO 8601) of a time in ns since the epoch
+
+
+def sigmf_time(timestamp_ns):
+    return (datetime.utcfromtimestamp(timestamp_ns // 1000000000) +
+            timedelta(microseconds=timestamp_ns % 1000000000 // 1000)).isoformat() + 'Z'
+
+
+class SigMFStreamWriter(object):
+    """
+     Write the SigMF metadata of a recording while its packets are read. Consecutive
+     captures with the same frequency and sample rate are merged into one segment,
+     captures and annotations are spooled to temporary files and assembled into
+     the metadata file by close(), memory use does not depend on the packet count.
+
+     The sigmf package is not used: its SigMFFile holds every capture and annotation
+     in memory, and its archive writer copies the data file into a temporary directory.
+     The metadata keeps to the SigMF core namespace (global core:datatype and core:version,
+     captures in core:sample_start order, annotations with core:sample_start and
+     core:sample_count), tests/test_sigmf_recording.py checks the archives written.
+
+            meta_file   --- .sigmf-meta file path
+    """
+
+    def __init__(self, meta_file, global_info=global_info):
+        self.meta_file = meta_file
+        self.global_info = global_info
+        self.captures = 0
+        self.annotations = 0
+        self._captures = tempfile.TemporaryFile('w+')
+        self._annotations = tempfile.TemporaryFile('w+')
+        self._last_capture = None
+        self._capture_start = None
+        self._annotation_start = None
+
+    # Add Capture settings, merged with the previous capture if they are the same.
+    # The capture time is the reception time of its first sample when given
+    def add_capture(self, start_frame, sample_rate, frequency, timestamp_ns=None):
+        settings = (int(sample_rate), int(frequency))
+        if settings == self._last_capture:
+            return
+        self._check_order('capture', start_frame, self._capture_start, strict=True)
+        self._last_capture = settings
+        self._capture_start = int(start_frame)
+        capture_md = {
+            "core:sample_start": int(start_frame),
+            "core:sampling_rate": int(sample_rate),
+            "core:frequency": int(frequency),
+            "core:time": sigmf_time(timestamp_ns) if timestamp_ns is not None else datetime.utcnow().isoformat() + 'Z'
+        }
+        self._spool(self._captures, self.captures, capture_md)
+        self.captures += 1
+
+    # Add robot positions x(latitude), y(longitude)
+    def add_annotation(self, start_frame, end_frame, latitude, longitude, robot_num):
+        self._check_order('annotation', start_frame, self._annotation_start)
+        self._annotation_start = int(start_frame)
+        comment = 'Robot#%d positions at the detection of the BLE Packet' % robot_num
+        annotation_md = {
+            "core:sample_start": int(start_frame),
+            "core:sample_count": int(end_frame - start_frame),
+            "core:latitude": int(latitude),
+            "core:longitude": int(longitude),
+            "core:comment": comment
+        }
+        self._spool(self._annotations, self.annotations, annotation_md)
+        self.annotations += 1
+
+    # SigMF captures and annotations are sorted by sample_start, a packet
+    # annotated for several robots gives annotations with the same start
+    def _check_order(self, segment, start_frame, last_start, strict=False):
+        if last_start is not None and (start_frame < last_start or strict and start_frame == last_start):
+            raise ValueError('{} at sample {:d} after sample {:d}, the packets must be in sample order'.format(
+                segment, int(start_frame), last_start))
+
+    def _spool(self, fd, count, md):
+        fd.write((',\n    ' if count else '\n    ') + json.dumps(md, sort_keys=True))
+
+    # Assemble the metadata file, copying the spooled segments
+    def close(self):
+        with open(self.meta_file, 'w') as meta:
+            meta.write('{\n  "global": ' + json.dumps(self.global_info, sort_keys=True) + ',\n  "captures": [')
+            self._copy(self._captures, meta)
+            meta.write('\n  ],\n  "annotations": [')
+            self._copy(self._annotations, meta)
+            meta.write('\n  ]\n}\n')
+        self._captures.close()
+        self._annotations.close()
+
+    def _copy(self, fd, meta):
+        fd.seek(0)
+        while True:
+            chunk = fd.read(1 << 16)
+            if not chunk:
+                break
+            meta.write(chunk)
+
+
+# Build a SigMF archive (tar of <name>/<name>.sigmf-meta and <name>/<name>.sigmf-data),
+# the data file is streamed into the archive from where it is
+
+
+def write_archive(archive_name, meta_file, data_file):
+    name = os.path.basename(archive_name)
+    archive_path = archive_name + '.sigmf'
+    with tarfile.open(archive_path, 'w') as archive:
+        archive.add(meta_file, arcname=os.path.join(name, name + '.sigmf-meta'))
+        archive.add(data_file, arcname=os.path.join(name, name + '.sigmf-data'))
+    return archive_path
+
+
+# Reception times of the rows of a tagged csv file in ns since the epoch, parsed at once.
+# Returns the times and whether each row has one
+
+
+def read_times_ns(csv_file):
+    with open(csv_file) as csvfile:
+        times = [row.get('Time') or '' for row in csv.DictReader(csvfile)]
+    has_time = np.array([bool(value) for value in times], dtype=bool)
+    times_ns = np.zeros(len(times), dtype=np.int64)
+    if has_time.any():
+        times_ns[has_time] = parse_times_ns([value for value in times if value])
+    return times_ns, has_time
 
 
-def add_capture(sigmf_file, start_frame, sample_rate, frequency):
-    capture_md = {
-        "core:sampling_rate": int(sample_rate),
-        "core:frequency": int(frequency),
-        "core:time": utils.get_sigmf_iso8601_datetime_now()
-    }
-    sigmf_file.add_capture(start_frame, capture_md)
+# Offsets of the packets in the extracted data, from the offsets table of iq_save.py
 
-# Add robot positions x(latitude), y(longitude)  to SigMfile
 
+def read_offsets(data_file):
+    offsets_file = os.path.splitext(data_file)[0] + '-offsets.csv'
+    offsets = {}
+    if os.path.exists(offsets_file):
+        with open(offsets_file) as csvfile:
+            for row in csv.DictReader(csvfile):
+                offsets[(int(row['Start_trame']), int(row['End_trame']))] = int(row['Offset'])
+    return offsets
 
-def add_annotation(sigmf_file, start_frame, end_frame, latitude, longitude, robot_num):
-    comment = 'Robot#%d positions at the detection of the BLE Packet' % robot_num
-    annotation_md = {
-        "core:latitude": int(latitude),
-        "core:longitude": int(longitude),
-        "core:comment": comment
-    }
-    sigmf_file.add_annotation(
-        start_frame, end_frame-start_frame, annotation_md)
 
 # Save Recordings into SigMF format
 
 
-def sigmf_recording(csv_file, data_file):
+def sigmf_recording(csv_file, data_file, fmt=IQ_FORMATS[IQ_FORMAT_DEFAULT]):
     """
      Parameters:
             csv_file    --- csv file path where are recorded: #Time,Robot_Number,X,Y,Angle,Start_trame,End_trame,Channel_frequency,Sample_rate
             data_file   --- Sigmf-data file path
+            fmt         --- IQ format of the data file (proto.IQ_FORMATS)
 
+     Packets are located with the offsets table of iq_save.py when there is one,
+     else they are expected one after the other in the csv order.
     """
-    # Initialize SigMF file
-    sigmf_file = SigMFFile(data_file=data_file, global_info=global_info)
     # Define archive name for SigMF data and metadata files
-    archive_name = csv_file.split('.')[0]
+    archive_name = os.path.splitext(csv_file)[0]
+    meta_file = archive_name + '.sigmf-meta'
+    offsets = read_offsets(data_file)
+    times_ns, has_time = read_times_ns(csv_file)
+    sigmf_file = SigMFStreamWriter(meta_file, recording_global_info(fmt))
     with open(csv_file) as csvfile:
         reader_csv = csv.DictReader(csvfile)
         offset = 0
-        for row in reader_csv:
+        last_packet = None
+        for index, row in enumerate(reader_csv):
             sample_rate = int(row['Sample_rate'])
-            len_packet = int(row['End_trame'])-int(row['Start_trame'])
+            packet = (int(float(row['Start_trame'])), int(float(row['End_trame'])))
             frequency = int(row['Channel_frequency'])
             robot_node = int(row['Robot_node'])
             latitude = int(row['X'])
             longitude = int(row['Y'])
-            start_frame = offset
-            end_frame = offset+len_packet
-            add_capture(sigmf_file, start_frame, sample_rate, frequency)
-            add_annotation(sigmf_file, start_frame, end_frame,
-                           latitude, longitude, robot_node)
-            offset += len_packet
+            # Rows of the same packet (one per robot) share its samples
+            if packet != last_packet and last_packet is not None:
+                offset += last_packet[1] - last_packet[0]
+            last_packet = packet
+            start_frame = offsets.get(packet, offset)
+            end_frame = start_frame + packet[1] - packet[0]
+            timestamp_ns = int(times_ns[index]) if has_time[index] else None
+            sigmf_file.add_capture(start_frame, sample_rate, frequency, timestamp_ns)
+            sigmf_file.add_annotation(start_frame, end_frame,
+                                      latitude, longitude, robot_node)
+    sigmf_file.close()
     # Dump contents to SigMF archive format
-    archive_path = sigmf_file.archive(archive_name)
+    archive_path = write_archive(archive_name, meta_file, data_file)
+    os.remove(meta_file)
     return archive_path
 
 
@@ -79,6 +224,8 @@ if __name__ == '__main__':
                       help="csv file path where are recorded: #time,start_frame,end_frame, frequency, sample_rate,robot node,x,y")
     parser.add_option("-d", "--data-file", type="string",
                       default='', help="BLE IQ Sigmf-data file path")
+    parser.add_option("-F", "--iq-format", type="choice", choices=sorted(IQ_FORMATS), default=IQ_FORMAT_DEFAULT,
+                      help="IQ format of the data file: cf32, sc16 or sc8 [default=%default]")
     (opts, _) = parser.parse_args()
-    archive_path = sigmf_recording(opts.csv_file, opts.data_file)
+    archive_path = sigmf_recording(opts.csv_file, opts.data_file, IQ_FORMATS[opts.iq_format])
     print('The archive path containing sigmf-data and sigmg-meta file is:', archive_path)
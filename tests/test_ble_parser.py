@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#  ble-dump: tests of the packet reporting of ble_parser.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from adv_dedup import AdvertiserCache
+from ble_parser import SampleClock, report_packet
+from ble_synth import advertising_pdu, air_bits
+from metrics import Metrics
+from packet_store import PacketStore
+from proto import PacketIndexWriter, PcapWriter, parse_packet, read_packet_index
+
+
+class SampleClockTest(unittest.TestCase):
+
+    def test_sample_of_time(self):
+        clock = SampleClock(4, 4e6, 0)
+        clock.add_anchor(0, 1000, 5000000000)
+        # A timed retune 1 ms after the rx_time of sample 1000
+        self.assertEqual(clock.sample_of_time(5001000000), 5000)
+        self.assertEqual(clock.time_ns(clock.sample_of_time(5001000000)), 5001000000)
+
+    def test_overflows(self):
+        metrics = Metrics()
+        clock = SampleClock(4, 4e6, 0, 0, metrics)
+        clock.add_anchor(0, 0, 1000)
+        clock.add_anchor(100, 400, 101000)
+        self.assertEqual(clock.overflows, 0)
+        # rx_time after an overflow: 250 us for 100 us of samples
+        clock.add_anchor(200, 800, 451000)
+        self.assertEqual((clock.overflows, clock.dropped_samples), (1, 1000))
+        self.assertIn('ble_dump_dropped_samples_total 1000', metrics.prometheus())
+
+
+class ReportPacketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        pdu = advertising_pdu('ADV_IND', bytearray(range(1, 7)), bytearray(b'ble_dump'))
+        status, self.packet = parse_packet(air_bits(pdu, 37), 0, 37)
+        self.assertEqual(status, 'ok')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Report the same advertising PDU 'copies' times, 1 ms apart (inside the dedup window)
+    def report(self, dedup, copies=3):
+        sample_rate = 4e6
+        clock = SampleClock(4, sample_rate, 0)
+        pcap = PcapWriter(os.path.join(self.directory, 'dump.pcap'))
+        index_file = os.path.join(self.directory, 'dump.csv')
+        packet_index = PacketIndexWriter(index_file)
+        store = PacketStore(os.path.join(self.directory, 'dump.db'))
+        store.add_capture(None, 'cf32', sample_rate, 0)
+        advertisers = AdvertiserCache(1.0)
+        reported = [report_packet(self.packet, 37, n * 1000, clock, sample_rate, pcap, packet_index, Metrics(),
+                                  advertisers, dedup, store) for n in range(copies)]
+        pcap.close()
+        packet_index.close()
+        store.flush()
+        return reported, pcap.packets, len(read_packet_index(index_file)), store.count()
+
+    def test_off(self):
+        reported, pcap_packets, index_packets, store_packets = self.report('off')
+        self.assertEqual((pcap_packets, index_packets, store_packets), (3, 3, 3))
+
+    def test_collapse(self):
+        reported, pcap_packets, index_packets, store_packets = self.report('collapse')
+        self.assertTrue(all(reported))
+        # Duplicates stay in the packet index only
+        self.assertEqual((pcap_packets, index_packets, store_packets), (1, 3, 1))
+
+    def test_suppress(self):
+        reported, pcap_packets, index_packets, store_packets = self.report('suppress')
+        self.assertEqual([r is None for r in reported], [False, True, True])
+        self.assertEqual((pcap_packets, index_packets, store_packets), (1, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
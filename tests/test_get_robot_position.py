@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#  ble-dump: tests of the robot position poller against a local stand-in position server
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from get_robot_position import ROBOT_CSV_FIELDS, RobotPoller, record_robot_positions
+
+LOCATIONS = b"""---
+- :id: 5
+  :x: 1.5
+  :y: 2.25
+  :angle: 90
+- :id: 7
+  :x: 3
+  :y: 4
+  :angle: 0
+"""
+
+
+class PositionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        self.server.connections += 1
+        BaseHTTPRequestHandler.handle(self)
+
+    def do_GET(self):
+        self.server.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/yaml')
+        self.send_header('Content-Length', str(len(LOCATIONS)))
+        self.end_headers()
+        self.wfile.write(LOCATIONS)
+        # Idle keep-alive connection dropped by the server, without 'Connection: close'
+        if self.server.drop:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class PositionServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), PositionHandler)
+        self.connections = 0
+        self.requests = 0
+        self.drop = False
+
+
+class RobotPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PositionServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.poller = RobotPoller('http://127.0.0.1:{:d}/Robot/LocationsYaml'.format(self.server.server_address[1]))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.poller.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            locations, latency = self.poller.fetch()
+        self.assertEqual(locations[5]['x'], 1.5)
+        self.assertEqual(locations[7]['angle'], 0)
+        self.assertGreaterEqual(latency, 0.0)
+        self.assertEqual((self.server.requests, self.server.connections), (5, 1))
+        self.assertEqual((self.poller.requests, self.poller.errors), (5, 0))
+
+    def test_reconnect_after_drop(self):
+        self.server.drop = True
+        self.poller.fetch()
+        # The request on the dropped connection fails, it is retried once on a new one
+        locations, _ = self.poller.fetch()
+        self.assertIn(5, locations)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.poller.errors, 0)
+
+    def test_server_down(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertRaises(IOError, self.poller.fetch)
+        self.assertEqual(self.poller.errors, 1)
+
+    def test_record_count(self):
+        csv_file = os.path.join(self.directory, 'robots.csv')
+        # 'count' polls, each one gives a row per known node (node 0 being the static emitter)
+        samples, _ = record_robot_positions(self.poller, [0, 5, 9], csv_file, period=0.01, count=3)
+        self.assertEqual(samples, 3)
+        with open(csv_file) as csvfile:
+            self.assertEqual(next(csv.reader(csvfile)), ROBOT_CSV_FIELDS)
+        with open(csv_file) as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        self.assertEqual([row['Robot_node'] for row in rows], ['0', '5'] * 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertTrue(all(float(row['Latency']) >= 0 for row in rows))
+        self.assertEqual([row['X'] for row in rows[:2]], ['0', '1.5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
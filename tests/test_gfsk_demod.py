@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#  ble-dump: tests of the NumPy GFSK demodulator and BLE decoder on synthetic captures
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import unittest
+
+import numpy as np
+
+from ble_synth import synth_capture
+from gfsk_demod import BleDecoder, GfskDemodulator, decode_iq
+
+SAMPLE_RATE = 5e6
+
+
+# Decode a capture, returns the (start sample, end sample, PDU) of the packets and the decoder
+
+
+def decode(iq_samples, demod, chunk_samples=1 << 20):
+    decoder = BleDecoder(demod.sps, [(0, 37)])
+    iq_data = iq_samples.view(np.float32).reshape(-1, 2)
+    packets = [(start, end, packet.data) for start, end, _, packet in
+               decode_iq(iq_data, demod, decoder, chunk_samples=chunk_samples)]
+    return packets, decoder
+
+
+class GfskDemodTest(unittest.TestCase):
+
+    def assertDecoded(self, packets, truth, offset=0):
+        self.assertEqual(len(packets), len(truth))
+        for (start, end, data), synth in zip(packets, truth):
+            # The packets start at any sample, one symbol instant is sampled per bit
+            self.assertLessEqual(abs(start - synth.start_frame - offset), 2)
+            self.assertEqual(end - start, synth.end_frame - synth.start_frame)
+            self.assertEqual(bytearray(data[:len(synth.pdu)]), synth.pdu)
+
+    def test_timing_phases(self):
+        iq_samples, truth = synth_capture(40, SAMPLE_RATE, snr_db=12.0, seed=3)
+        demod = GfskDemodulator(SAMPLE_RATE)
+        self.assertEqual(set(packet.start_frame % demod.sps for packet in truth), set(range(demod.sps)))
+        packets, decoder = decode(iq_samples, demod)
+        self.assertDecoded(packets, truth)
+        self.assertEqual(decoder.stat['sync'], len(truth))
+
+    def test_chunking(self):
+        iq_samples, _ = synth_capture(40, SAMPLE_RATE, density=2000.0, snr_db=8.0, seed=4)
+        demod = GfskDemodulator(SAMPLE_RATE)
+        packets, _ = decode(iq_samples, demod)
+        for chunk_samples in 100003, 65536:
+            self.assertEqual(decode(iq_samples, demod, chunk_samples)[0], packets)
+
+    def test_offsets(self):
+        first, first_truth = synth_capture(10, SAMPLE_RATE, freq_offset=1e6, seed=5)
+        second, second_truth = synth_capture(10, SAMPLE_RATE, freq_offset=-1.5e6, seed=6)
+        demod = GfskDemodulator(SAMPLE_RATE, offsets=[(0, 1e6), (len(first), -1.5e6)])
+        packets, _ = decode(np.concatenate((first, second)), demod, 300001)
+        self.assertDecoded(packets[:len(first_truth)], first_truth)
+        self.assertDecoded(packets[len(first_truth):], second_truth, len(first))
+
+
+if __name__ == '__main__':
+    unittest.main()
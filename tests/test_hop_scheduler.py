@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#  ble-dump: tests of the channel hopping scheduler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import unittest
+
+from hop_scheduler import HopScheduler
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class HopSchedulerTest(unittest.TestCase):
+
+    def test_fixed_by_default(self):
+        clock = Clock()
+        scheduler = HopScheduler([37, 38, 39], 2.0, clock=clock)
+        for _ in range(50):
+            scheduler.record(37)
+        clock.now += 2.0
+        self.assertTrue(scheduler.due())
+        scheduler.hop()
+        self.assertEqual(scheduler.current_dwell, 2.0)
+
+    def test_adaptive(self):
+        clock = Clock()
+        scheduler = HopScheduler([37, 38], 1.0, policy='adaptive', clock=clock)
+        for channel, packets in ((37, 90), (38, 10), (37, 90), (38, 10)):
+            for _ in range(packets):
+                scheduler.record(channel)
+            clock.now += scheduler.current_dwell
+            scheduler.hop()
+        # The cycle (window seconds per channel) is shared according to the yields
+        self.assertEqual(scheduler.channel, 37)
+        self.assertGreater(scheduler.current_dwell, 1.5)
+        self.assertGreaterEqual(scheduler.dwell(38), scheduler.min_dwell)
+        self.assertAlmostEqual(scheduler.current_dwell + scheduler.dwell(38), 2.0)
+
+    def test_clock_steps(self):
+        clock = Clock()
+        scheduler = HopScheduler([37, 38], 2.0, clock=clock)
+        clock.now += 1.0
+        self.assertFalse(scheduler.due())
+        # Backwards: the hop is not stalled
+        clock.now -= 3600.0
+        self.assertFalse(scheduler.due())
+        clock.now += 1.0
+        self.assertTrue(scheduler.due())
+        scheduler.hop()
+        self.assertAlmostEqual(scheduler.stats[37].dwell, 2.0)
+        # Forward: the next hop is not taken early
+        clock.now += 0.5
+        self.assertFalse(scheduler.due())
+        clock.now += 3600.0
+        self.assertFalse(scheduler.due())
+        clock.now += 1.5
+        self.assertTrue(scheduler.due())
+        scheduler.hop()
+        self.assertAlmostEqual(scheduler.stats[38].dwell, 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
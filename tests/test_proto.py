@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#  ble-dump: tests of the dewhitening and CRC engines against the bit-level reference
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import unittest
+
+import numpy as np
+
+from proto import (BLE_CHANNELS_COUNT, BLE_CRC_INIT, BLE_CRC_LEN, crc, crc_check_batch, dewhiten_batch, dewhitening,
+                   swap_bits)
+
+# Longest PDU (header + payload) checked
+MAX_LENGTH = 255
+
+
+# Bit-level (de)whitening LFSR, as first implemented
+
+
+def reference_dewhitening(data, channel):
+    ret = []
+    lfsr = swap_bits(channel) | 2
+
+    for d in data:
+        d = swap_bits(d)
+        for i in 128, 64, 32, 16, 8, 4, 2, 1:
+            if lfsr & 0x80:
+                lfsr ^= 0x11
+                d ^= i
+
+            lfsr = (lfsr << 1) & 0xff
+        ret.append(swap_bits(d))
+
+    return ret
+
+
+# Bit-level CRC-24 shift register, as first implemented
+
+
+def reference_crc(data, length, init=BLE_CRC_INIT):
+    ret = [(init >> 16) & 0xff, (init >> 8) & 0xff, init & 0xff]
+
+    for d in data[:length]:
+        for v in range(8):
+            t = (ret[0] >> 7) & 1
+
+            ret[0] <<= 1
+            if ret[1] & 0x80:
+                ret[0] |= 1
+
+            ret[1] <<= 1
+            if ret[2] & 0x80:
+                ret[1] |= 1
+
+            ret[2] <<= 1
+
+            if d & 1 != t:
+                ret[2] ^= 0x5b
+                ret[1] ^= 0x06
+
+            d >>= 1
+
+    return [swap_bits(value & 0xff) for value in ret]
+
+
+class WhiteningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(1)
+
+    def test_reference(self):
+        for channel in range(BLE_CHANNELS_COUNT):
+            data = self.rng.randint(0, 256, MAX_LENGTH).astype(np.uint8)
+            self.assertEqual(dewhitening(data, channel), reference_dewhitening(data.tolist(), channel))
+
+    def test_batch(self):
+        for channel in range(BLE_CHANNELS_COUNT):
+            for length in range(MAX_LENGTH + 1):
+                data = self.rng.randint(0, 256, (3, length)).astype(np.uint8)
+                batch = dewhiten_batch(data, channel)
+                self.assertEqual(batch.shape, (3, length))
+                for row, dewhitened in zip(data, batch):
+                    self.assertEqual(dewhitened.tolist(), dewhitening(row, channel))
+
+    def test_batch_of_buffers(self):
+        rows = [bytes(bytearray(self.rng.randint(0, 256, 40).astype(np.uint8))) for _ in range(4)]
+        batch = dewhiten_batch(rows, 37)
+        for row, dewhitened in zip(rows, batch):
+            self.assertEqual(dewhitened.tolist(), reference_dewhitening(bytearray(row), 37))
+        # Whitening twice gives the data back
+        self.assertEqual(dewhiten_batch(batch, 37).tobytes(), b''.join(rows))
+
+
+class CrcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(2)
+
+    def test_reference(self):
+        for init in (BLE_CRC_INIT, 0x123456, 0xabcdef):
+            for length in range(MAX_LENGTH + 1):
+                data = self.rng.randint(0, 256, length).tolist()
+                self.assertEqual(crc(data, length, init), reference_crc(data, length, init))
+
+    # One candidate per length 0..255, every other one with a corrupted CRC
+    def test_batch(self):
+        for init in (BLE_CRC_INIT, 0x123456):
+            lengths = np.arange(MAX_LENGTH + 1)
+            pdus = self.rng.randint(0, 256, (len(lengths), MAX_LENGTH + BLE_CRC_LEN)).astype(np.uint8)
+            for length in lengths:
+                pdus[length, length:length + BLE_CRC_LEN] = reference_crc(pdus[length].tolist(), length, init)
+                if length % 2:
+                    pdus[length, length + self.rng.randint(BLE_CRC_LEN)] ^= 1 << self.rng.randint(8)
+            valid = crc_check_batch(pdus, lengths, init)
+            expected = [pdus[length, length:length + BLE_CRC_LEN].tolist() == crc(pdus[length].tolist(), length, init)
+                        for length in lengths]
+            self.assertEqual(valid.tolist(), expected)
+            self.assertEqual(valid.tolist(), [length % 2 == 0 for length in lengths])
+
+    def test_batch_too_short(self):
+        pdus = np.zeros((2, 10), dtype=np.uint8)
+        pdus[0, 2:5] = crc([0, 0], 2)
+        # The CRC of the second candidate would end past the row
+        self.assertEqual(crc_check_batch(pdus, [2, 8]).tolist(), [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
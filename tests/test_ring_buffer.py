@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#  ble-dump: tests of the ring buffer of the parser against a plain byte string
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import unittest
+
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def assertBuffered(self, ring, expected, offset):
+        self.assertEqual(len(ring), len(expected))
+        self.assertEqual(bytearray(ring.array().tobytes()), expected)
+        self.assertEqual(ring.offset, offset)
+
+    def test_wraparound(self):
+        ring = RingBuffer(4, capacity=16)
+        expected = bytearray()
+        offset = 0
+        for n in range(50):
+            data = bytearray((n * 7 + k) % 256 for k in range(n % 11))
+            ring.append(bytes(data))
+            expected += data
+            count = max(0, len(expected) - 5)
+            ring.consume(count)
+            expected = expected[count:]
+            offset += count
+            self.assertBuffered(ring, expected, offset)
+        # The head went around the ring several times, without growing it
+        self.assertEqual(len(ring._data), 2 * 16)
+
+    def test_grow_wrapped(self):
+        ring = RingBuffer(2, capacity=8)
+        ring.append(np.arange(6, dtype=np.uint8))
+        ring.consume(5)
+        ring.append(bytearray([6, 7, 8, 9]))
+        self.assertBuffered(ring, bytearray([5, 6, 7, 8, 9]), 5)
+        ring.append(memoryview(bytearray(range(10, 20))))
+        self.assertBuffered(ring, bytearray(range(5, 20)), 5)
+        self.assertEqual(ring.ready, 13)
+
+    def test_skip(self):
+        ring = RingBuffer(2, capacity=8)
+        ring.append(b'\x01\x02\x03')
+        ring.consume(3)
+        ring.skip(100)
+        ring.append(b'\x04')
+        self.assertBuffered(ring, bytearray([4]), 103)
+
+
+if __name__ == '__main__':
+    unittest.main()
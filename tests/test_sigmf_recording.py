@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#  ble-dump: tests of the SigMF archives written without the sigmf package
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+
+import csv
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import numpy as np
+
+import sigmf_recording
+from iq_save import iq_save
+from proto import IQ_FORMATS, PacketIndexWriter, parse_times_ns
+from sigmf_recording import sigmf_recording as write_recording, sigmf_time
+
+TAGGED_FIELDS = ['Time', 'Start_trame', 'End_trame', 'Channel_frequency', 'Sample_rate', 'Robot_node', 'X', 'Y']
+
+# (start sample, end sample, channel frequency) of the packets of the capture
+PACKETS = [(1000, 1400, 2402000000), (3000, 3376, 2402000000), (5000, 5800, 2426000000),
+           (9000, 9100, 2426000000), (12000, 12600, 2480000000)]
+
+SAMPLE_RATE = 5000000
+
+
+class SigMFRecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.iq_file = os.path.join(self.directory, 'capture.cf32')
+        np.zeros(20000, dtype=np.complex64).tofile(self.iq_file)
+        index_file = os.path.join(self.directory, 'capture.csv')
+        with PacketIndexWriter(index_file) as packet_index:
+            for start, end, frequency in PACKETS:
+                packet_index.write(start, end, frequency, SAMPLE_RATE, 0)
+        iq_save(index_file, self.iq_file)
+        self.data_file = os.path.join(self.directory, 'capture-BLE_IQ.sigmf-data')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Tagged csv of the packets, one row per packet and robot, the first row without time
+    def write_tagged(self, packets, robots=(0, 1)):
+        tagged_file = os.path.join(self.directory, 'capture-tagged.csv')
+        with open(tagged_file, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(TAGGED_FIELDS)
+            for n, (start, end, frequency) in enumerate(packets):
+                for robot in robots:
+                    time = '2020-01-17 17:00:{:02d}.{:06d}'.format(n, start) if n or robot else ''
+                    writer.writerow([time, start, end, frequency, SAMPLE_RATE, robot, 10 * robot, n])
+        return tagged_file
+
+    def read_archive(self, archive_path):
+        with tarfile.open(archive_path) as archive:
+            names = archive.getnames()
+            meta = json.loads(archive.extractfile('capture-tagged/capture-tagged.sigmf-meta').read().decode())
+            data_size = archive.getmember('capture-tagged/capture-tagged.sigmf-data').size
+        return names, meta, data_size
+
+    def test_archive(self):
+        archive_path = write_recording(self.write_tagged(PACKETS), self.data_file)
+        names, meta, data_size = self.read_archive(archive_path)
+        self.assertEqual(sorted(names), ['capture-tagged/capture-tagged.sigmf-data',
+                                         'capture-tagged/capture-tagged.sigmf-meta'])
+        self.assertEqual(data_size, os.path.getsize(self.data_file))
+        samples = data_size // 8
+
+        # Required core keys, as sigmf.validate checks them
+        self.assertEqual(sorted(meta), ['annotations', 'captures', 'global'])
+        self.assertEqual(meta['global']['core:datatype'], 'cf32_le')
+        self.assertEqual(meta['global']['core:version'], sigmf_recording.global_info['core:version'])
+        for segment in meta['captures'] + meta['annotations']:
+            self.assertTrue(all(key.startswith('core:') for key in segment))
+            self.assertTrue(isinstance(segment['core:sample_start'], int))
+
+        # Captures: one per run of packets with the same frequency, sorted and non-overlapping
+        captures = meta['captures']
+        self.assertEqual([capture['core:frequency'] for capture in captures], [2402000000, 2426000000, 2480000000])
+        starts = [capture['core:sample_start'] for capture in captures]
+        self.assertEqual(starts, [0, 776, 1676])
+        self.assertEqual(starts, sorted(set(starts)))
+        self.assertTrue(all(capture['core:sampling_rate'] == SAMPLE_RATE for capture in captures))
+        self.assertEqual(captures[1]['core:time'],
+                         sigmf_time(int(parse_times_ns(['2020-01-17 17:00:02.005000'])[0])))
+
+        # Annotations: one per packet and robot, sorted and inside the data
+        annotations = meta['annotations']
+        self.assertEqual(len(annotations), 2 * len(PACKETS))
+        starts = [annotation['core:sample_start'] for annotation in annotations]
+        self.assertEqual(starts, sorted(starts))
+        for annotation, (start, end, _) in zip(annotations[::2], PACKETS):
+            self.assertEqual(annotation['core:sample_count'], end - start)
+        self.assertEqual(max(a['core:sample_start'] + a['core:sample_count'] for a in annotations), samples)
+
+    def test_times_parsed_once(self):
+        calls = []
+
+        def parse(times):
+            calls.append(len(times))
+            return parse_times_ns(times)
+
+        sigmf_recording.parse_times_ns = parse
+        try:
+            write_recording(self.write_tagged(PACKETS), self.data_file)
+        finally:
+            sigmf_recording.parse_times_ns = parse_times_ns
+        self.assertEqual(calls, [2 * len(PACKETS) - 1])
+
+    def test_sample_order(self):
+        tagged_file = self.write_tagged(PACKETS[2:] + PACKETS[:2], robots=(0,))
+        self.assertRaises(ValueError, write_recording, tagged_file, self.data_file, IQ_FORMATS['cf32'])
+
+
+if __name__ == '__main__':
+    unittest.main()